@@ -1,13 +1,19 @@
+import atexit
 import traceback
-from flask import render_template, request, redirect, url_for
+import json
+from flask import render_template, request, redirect, url_for, jsonify
 from config import config
-import pandas as pd
-import numpy as np
 import logging.config
-import pickle
 from flask import Flask
-from run_database import Airbnb
+from run_database import Airbnb, STRING_LENGTHS
 from flask_sqlalchemy import SQLAlchemy
+from src.model_registry import ArtifactRegistry
+from src.compiled_model import load_compiled_model
+from src.predict import cast_listing, vectorize_listings, score_listings, map_bin
+from src.impute import impute_listings
+from src.db_query import listing_page
+from src.db_metrics import engine_options, QueryTimer
+from src.write_behind import WriteBehindQueue
 
 
 # Initialize the Flask application
@@ -18,32 +24,114 @@ app.config.from_pyfile('config/flaskconfig.py')
 
 # Define LOGGING_CONFIG in flask_config.py - path to config file for setting
 # up the logger (e.g. config/logging/local.conf)
-logging.config.fileConfig(app.config["LOGGING_CONFIG"])
+logging.config.fileConfig(app.config["LOGGING_CONFIG"], disable_existing_loggers=False)
 logger = logging.getLogger(app.config["APP_NAME"])
 logger.debug('Test log')
 
-# Initialize the database
+# Initialize the database, with a connection pool for MySQL
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config["SQLALCHEMY_DATABASE_URI"],
+                                                         app.config["DB_POOL_SIZE"],
+                                                         app.config["DB_MAX_OVERFLOW"],
+                                                         app.config["DB_POOL_RECYCLE"],
+                                                         app.config["DB_POOL_PRE_PING"])
 db = SQLAlchemy(app)
 
+# Time the database queries of every request, see /metrics
+query_timer = QueryTimer()
+with app.app_context():
+    query_timer.listen(db.engine)
+
+
+def _insert_listings(rows):
+    """Insert scored listings in one transaction
+
+    :param rows: list of listings (dicts) with their reviews_per_month_bin
+    """
+    with db.engine.begin() as connection:
+        connection.execute(Airbnb.__table__.insert(), rows)
+
+
+# Optionally persist new listings from a background thread, flushed when the process exits
+write_behind = None
+if app.config["WRITE_BEHIND"]:
+    write_behind = WriteBehindQueue(_insert_listings,
+                                    app.config["WRITE_BEHIND_BATCH_SIZE"],
+                                    app.config["WRITE_BEHIND_INTERVAL"],
+                                    app.config["WRITE_BEHIND_MAX_PENDING"],
+                                    max_retry_interval=app.config["WRITE_BEHIND_MAX_RETRY_INTERVAL"],
+                                    dead_letter_path=app.config["WRITE_BEHIND_DEAD_LETTER_PATH"])
+    atexit.register(write_behind.close)
+
+# Load the trained model & feature layout once per process, shared across requests
+registry = ArtifactRegistry(hot_reload=app.config["MODEL_HOT_RELOAD"])
+registry.register("model", config.SAVED_MODEL_LOCATION)
+if app.config["USE_COMPILED_MODEL"]:
+    registry.register("compiled_model", config.COMPILED_MODEL_LOCATION, loader=load_compiled_model)
+registry.register("layout", config.FEATURE_LAYOUT_LOCATION)
+registry.register("imputer", config.IMPUTER_LOCATION)
+registry.preload()
+
+
+@app.before_request
+def _start_query_timer():
+    query_timer.start()
+
+
+@app.after_request
+def _log_query_timer(response):
+    """Log the database time of the request and report it in a Server-Timing header"""
+    timing = query_timer.stop()
+    if timing:
+        response.headers["Server-Timing"] = "db;dur={:.1f}, total;dur={:.1f}".format(
+            timing["db_seconds"] * 1000, timing["request_seconds"] * 1000)
+        if app.config["LOG_DB_TIMING"]:
+            logger.info("%s %s: %d queries, %.1f ms in database, %.1f ms total", request.method, request.path,
+                        timing["queries"], timing["db_seconds"] * 1000, timing["request_seconds"] * 1000)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    """Cumulative request and database timing, and the status of the connection pool
+
+    :return: JSON with the request count, query count, total and mean times, pool status and,
+        in write-behind mode, the queue depth and write counts
+    """
+    summary = query_timer.summary()
+    if write_behind is not None:
+        summary["write_behind"] = write_behind.stats()
+    return jsonify(summary)
+
 
 @app.route('/')
 def index():
-    """Main view that lists songs in the database.
+    """Main view that lists a page of the listings in the database, newest first.
 
-    Create view into index page that uses data queried from Track database and
-    inserts it into the msiapp/templates/index.html template.
+    Create view into index page that uses data queried from the Airbnb table and
+    inserts it into the app/templates/index.html template. The page can be filtered on the
+    INDEX_FILTERS columns (e.g. ``?room_type=Private%20room``), continued with ``?cursor=<next_cursor>``
+    and returned as JSON with ``?format=json``.
 
-    Returns: rendered html template
+    Returns: rendered html template, or JSON with the listings and the next cursor
 
     """
 
     try:
-        listings = db.session.query(Airbnb).limit(app.config["MAX_ROWS_SHOW"]).all()
+        filters = {col: request.args[col] for col in app.config["INDEX_FILTERS"] if request.args.get(col)}
+        cursor = request.args.get("cursor", type=int)
+        listings, next_cursor = listing_page(db.session, Airbnb.__table__, list(app.config["INDEX_COLUMNS"]),
+                                             filters, cursor, app.config["MAX_ROWS_SHOW"])
         logger.debug("Index page accessed")
-        return render_template('index.html', abb_feat_and_resp=listings)
+        if request.args.get("format") == "json":
+            return jsonify(listings=listings, next_cursor=next_cursor)
+        next_url = url_for('index', cursor=next_cursor, **filters) if next_cursor is not None else None
+        return render_template('index.html', abb_feat_and_resp=listings, columns=app.config["INDEX_COLUMNS"],
+                               next_url=next_url)
     except:
         traceback.print_exc()
         logger.warning("Not able to display listings, error page returned")
+        if request.args.get("format") == "json":
+            return jsonify(error="listings not available"), 500
         return render_template('error.html')
 
 
@@ -54,125 +142,138 @@ def add_entry():
     :return: redirect to index page
     """
 
-    try: 
-        categorical_columns = ["host_response_time",
-                            "room_type",
-                            "property_type_cat",
-                          "neighbourhood_cleansed",
-                          "cancellation_policy"]
-
-        #save input
-        years_as_host = float(request.form['years_as_host'])
-        host_response_time = request.form['host_response_time']
-        host_response_rate = float(request.form['host_response_rate'])
-        host_is_superhost = int(request.form['host_is_superhost'])
-        host_has_profile_pic = int(request.form['host_has_profile_pic'])
-        host_identity_verified = int(request.form['host_identity_verified'])
-        host_listings_count = int(request.form['host_listings_count'])
-        room_type = request.form['room_type']
-        property_type_cat = request.form['property_type_cat']
-        accommodates_cat = int(request.form['accommodates_cat'])
-        bathrooms_cat = int(request.form['bathrooms_cat'])
-        bedrooms_cat = int(request.form['bedrooms_cat'])
-        beds_cat = int(request.form['beds_cat'])
-        guests_included_cat = int(request.form['guests_included_cat'])
-        extra_people_cat = int(request.form['extra_people_cat'])
-        price = float(request.form['price'])
-        security_deposit = float(request.form['security_deposit'])
-        cleaning_fee = float(request.form['cleaning_fee'])
-        amenities_count = int(request.form['amenities_count'])
-        neighbourhood_cleansed = request.form['neighbourhood_cleansed']
-        minimum_nights_cat = int(request.form['minimum_nights_cat'])
-        maximum_nights_cat = int(request.form['maximum_nights_cat'])
-        instant_bookable = int(request.form['instant_bookable'])
-        cancellation_policy = request.form['cancellation_policy']
-        require_guest_phone_verification = int(request.form['require_guest_phone_verification'])
-        require_guest_profile_picture = int(request.form['require_guest_profile_picture'])
-
-        #dataframe
-        df_entry = pd.DataFrame(
-            {
-               "years_as_host": years_as_host,
-                "host_response_time": host_response_time,
-                "host_response_rate": host_response_rate,
-                "host_is_superhost": host_is_superhost,
-                "host_has_profile_pic": host_has_profile_pic,
-                "host_identity_verified": host_identity_verified,
-                "host_listings_count": host_listings_count,
-                "room_type": room_type,
-                "property_type_cat": property_type_cat,
-                "accommodates_cat": accommodates_cat,
-                "bathrooms_cat": bathrooms_cat,
-                "bedrooms_cat": bedrooms_cat,
-                "beds_cat": beds_cat,
-                "guests_included_cat": guests_included_cat,
-                "extra_people_cat": extra_people_cat,
-                "price": price,
-                "security_deposit": security_deposit,
-                "cleaning_fee": cleaning_fee,
-                "amenities_count": amenities_count,
-                "neighbourhood_cleansed": neighbourhood_cleansed,
-                "minimum_nights_cat": minimum_nights_cat,
-                "maximum_nights_cat": maximum_nights_cat,
-                "instant_bookable": instant_bookable,
-                "cancellation_policy": cancellation_policy,
-                "require_guest_phone_verification": require_guest_phone_verification,
-                "require_guest_profile_picture": require_guest_profile_picture,
-                "reviews_per_month_bin": "very popular"
-            },
-            index=np.arange(0,1)
-        )
-
-        #load trained model & encoder
-        trained_model = pickle.load(open(config.SAVED_MODEL_LOCATION, 'rb'))
-        encoder = pickle.load(open(config.SAVED_ENCODER_LOCATION, 'rb'))
-
-        #predict on df_entry
-        df_predict = df_entry.loc[:, df_entry.columns != "reviews_per_month_bin"]
-        df_onehot_predict = pd.DataFrame(
-            encoder.transform(df_entry[categorical_columns]).toarray(),
-            columns = encoder.get_feature_names(categorical_columns)
-        )
-        df_predict = df_predict.join(df_onehot_predict).drop(columns=categorical_columns)
-
-        entry_prediction = trained_model.predict(df_predict)
+    try:
+        #get trained model & feature layout from the registry
+        trained_model = _get_model(1)
+        layout = registry.get("layout")
+
+        #save input, imputing missing host response and fee fields when an imputer is available
+        imputer = _get_imputer()
+        listing = cast_listing(request.form, layout, imputer["imputable"] if imputer else (), STRING_LENGTHS)
+        if imputer:
+            listing = impute_listings([listing], imputer)[0]
+
+        #predict on listing
+        entry_prediction, _ = score_listings(vectorize_listings([listing], layout), trained_model)
 
         reviews_per_month_bin = map_bin(int(entry_prediction[0]))
         logger.info("Prediction successful!")
 
-        listings1 = Airbnb(years_as_host = years_as_host, host_response_time = host_response_time,
-                            host_response_rate = host_response_rate, host_is_superhost = host_is_superhost,
-                            host_has_profile_pic = host_has_profile_pic, host_identity_verified = host_identity_verified,
-                            host_listings_count = host_listings_count, room_type = room_type, property_type_cat = property_type_cat,
-                            accommodates_cat = accommodates_cat, bathrooms_cat = bathrooms_cat, bedrooms_cat = bedrooms_cat,
-                            beds_cat = beds_cat, guests_included_cat = guests_included_cat, extra_people_cat = extra_people_cat,
-                            price = price, security_deposit = security_deposit, cleaning_fee = cleaning_fee,
-                            amenities_count = amenities_count, neighbourhood_cleansed = neighbourhood_cleansed,
-                            minimum_nights_cat = minimum_nights_cat, maximum_nights_cat = maximum_nights_cat,
-                            instant_bookable = instant_bookable, cancellation_policy = cancellation_policy,
-                            require_guest_phone_verification = require_guest_phone_verification,
-                            require_guest_profile_picture = require_guest_profile_picture, reviews_per_month_bin = reviews_per_month_bin
-                            )
-        db.session.add(listings1)
-        db.session.commit()
-        logger.info("New listing successfully added!")
+        if write_behind is not None:
+            write_behind.put(dict(listing, reviews_per_month_bin=reviews_per_month_bin))
+            logger.info("New listing queued to be added!")
+        else:
+            listings1 = Airbnb(reviews_per_month_bin = reviews_per_month_bin, **listing)
+            db.session.add(listings1)
+            db.session.commit()
+            logger.info("New listing successfully added!")
 
         return redirect(url_for('index'))
     except:
         logger.warning("Not able to display listings, error page returned")
         return render_template('error.html')
 
-def map_bin(x):
-    if x == 1:
-        return "very unpopular"
-    elif x == 2:
-        return "unpopular"
-    elif x == 3:
-        return "popular"
-    elif x == 4:
-        return "very popular"
+
+@app.route('/predict', methods=['POST'])
+def predict():
+    """Score a batch of listings sent as a JSON array or as NDJSON (one listing per line)
+
+    Pass ``?persist=true`` to also save the scored listings to the database with one bulk insert.
+
+    :return: JSON with the predicted bin and class probabilities for every listing
+    """
+
+    try:
+        layout = registry.get("layout")
+    except Exception as e:
+        logger.error("Feature layout not available: %s", e)
+        return jsonify(error="model not available"), 503
+
+    try:
+        imputer = _get_imputer()
+        imputable = imputer["imputable"] if imputer else ()
+        records = _read_listings(request)
+        listings = [cast_listing(record, layout, imputable, STRING_LENGTHS) for record in records]
+        if imputer:
+            listings = impute_listings(listings, imputer)
+        predictors = vectorize_listings(listings, layout)
+    except ValueError as e:
+        logger.warning("Invalid /predict payload: %s", e)
+        return jsonify(error=str(e)), 400
+
+    try:
+        trained_model = _get_model(len(listings))
+    except Exception as e:
+        logger.error("Trained model not available: %s", e)
+        return jsonify(error="model not available"), 503
+
+    try:
+        bins, probabilities = score_listings(predictors, trained_model)
+        labels = [map_bin(int(b)) for b in bins]
+        class_labels = [map_bin(int(c)) for c in trained_model.classes_]
+
+        persisted = 0
+        if request.args.get("persist", "false").lower() in ("1", "true", "yes"):
+            rows = [dict(listing, reviews_per_month_bin=label) for listing, label in zip(listings, labels)]
+            db.session.execute(Airbnb.__table__.insert(), rows)
+            db.session.commit()
+            persisted = len(rows)
+            logger.info("%d scored listings persisted", persisted)
+
+        predictions = [{"reviews_per_month_bin": label,
+                        "probabilities": dict(zip(class_labels, probs.tolist()))}
+                       for label, probs in zip(labels, probabilities)]
+        logger.info("Batch prediction successful for %d listings", len(predictions))
+        return jsonify(predictions=predictions, persisted=persisted)
+    except Exception:
+        traceback.print_exc()
+        db.session.rollback()
+        logger.warning("Batch prediction failed")
+        return jsonify(error="prediction failed"), 500
+
+
+def _get_model(n_rows):
+    """Model to score a batch with: the compiled model for small batches, the pickled model otherwise
+
+    :param n_rows: number of listings in the batch
+    :return: fitted classifier or compiled model, both with predict_proba and classes_
+    """
+    if app.config["USE_COMPILED_MODEL"] and n_rows <= app.config["COMPILED_MODEL_MAX_ROWS"]:
+        return registry.get("compiled_model")
+    return registry.get("model")
+
+
+def _get_imputer():
+    """Fitted imputer from the registry, or None if it has not been trained yet
+
+    :return: imputer (dict) or None, in which case every field is required
+    """
+    try:
+        return registry.get("imputer")
+    except Exception as e:
+        logger.debug("Imputer not available, missing fields will be rejected: %s", e)
+        return None
+
+
+def _read_listings(req):
+    """Parse the listings of a /predict request body
+
+    :param req: flask request with a JSON array or an NDJSON body
+    :return: list of listings (dicts)
+    """
+    if req.mimetype in ("application/x-ndjson", "application/jsonl"):
+        records = []
+        for line in req.stream:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
     else:
-        return "somethings wrong"
+        records = req.get_json(force=True, silent=True)
+
+    if not isinstance(records, list) or not records or not all(isinstance(r, dict) for r in records):
+        raise ValueError("Expected a non-empty JSON array (or NDJSON stream) of listings")
+    return records
+
 
 if __name__ == '__main__':
     app.run(debug=app.config["DEBUG"], port=app.config["PORT"], host=app.config["HOST"])
\ No newline at end of file
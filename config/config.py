@@ -18,10 +18,21 @@ SOURCE_DATA_URL = "http://data.insideairbnb.com/united-states/ca/san-francisco/2
 AIRBNB_RAW_LOCATION = path.join(PROJECT_HOME,'data/listings.csv')
 S3_BUCKET = "nw-tkj775-s3"
 S3_PATH_LOCATION = "data/listings.csv"
+INGESTION_MANIFEST = path.join(PROJECT_HOME,'config/ingestion_manifest.txt')  # one listings.csv.gz url per line
+INGESTION_LOCAL_DIR = path.join(PROJECT_HOME,'data/raw')
+INGESTION_S3_PREFIX = "data/raw"  # manifest snapshots are uploaded to <prefix>/<city>/<date>/listings.csv
+INGESTION_WORKERS = 4
+INGESTION_RETRIES = 3
+INGESTION_PART_SIZE = 8 * 1024 * 1024  # bytes per S3 multipart upload part when streaming (at least 5 MiB)
 #CREATE_RDS = False
 
+# file format of the clean, features and imputed datasets: "csv", "parquet" or "feather"
+# (a path passed on the command line picks its format from its own extension)
+ARTIFACT_FORMAT = "csv"
+
 # cleaning script configurations
-CLEAN_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/clean.csv')
+CLEAN_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/clean.' + ARTIFACT_FORMAT)
+CLEAN_CHUNKSIZE = None  # rows per chunk when cleaning large raw files; None reads the whole file at once
 LISTINGS_DATATYPES = {
     "zipcode": "str",
     "price": "str",
@@ -114,8 +125,31 @@ VALID_ZIP = {
 
 #featurize configurations
 DATA_SCRAPE_DATE = datetime.datetime(2020, 1, 4)
-FEATURE_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/features.csv')
+FEATURE_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/features.' + ARTIFACT_FORMAT)
+FEATURE_STATE_LOCATION = path.join(PROJECT_HOME,'data/feature_state.sav')  # features by listing id and row hash, for --incremental
+FEATURE_N_JOBS = 1  # processes the featurize stage splits the listings across
+FEATURE_PARTITION_BY = None  # column to partition the listings by, e.g. "neighbourhood_cleansed" or "city"; None for row ranges
 RESPONSE_VARIABLE = ["reviews_per_month_bin"]
+#declarative bins applied by src.create_features.apply_bin_spec
+#  column: source column; edges + labels: np.digitize cut points and the label of each bucket
+#  right: buckets include their right edge (a < x <= b) instead of their left edge (a <= x < b)
+#  clip: [lower, upper] bounds instead of edges (None for no bound)
+#  missing: source values other than NaN that are treated as missing
+#  fill: value for missing rows, or fill_from: column whose value (clipped to fill_clip, default clip) is used
+#missing rows without fill or fill_from stay NaN
+BIN_SPECS = {
+    "reviews_per_month_bin": {"column": "reviews_per_month", "edges": [0, 0.35, 1.1, 2.9],
+                              "labels": [0, 1, 2, 3, 4], "right": True},
+    "accommodates_cat": {"column": "accommodates", "edges": [2, 4, 6], "labels": [1, 2, 3, 4], "right": True},
+    "bathrooms_cat": {"column": "bathrooms", "edges": [2, 3], "labels": [1, 2, 3], "right": False, "fill": 1},
+    "bedrooms_cat": {"column": "bedrooms", "clip": [None, 3], "fill_from": "beds"},
+    "beds_cat": {"column": "beds", "clip": [None, 5], "missing": [0], "fill_from": "bedrooms",
+                 "fill_clip": [1, None]},
+    "guests_included_cat": {"column": "guests_included", "clip": [None, 3]},
+    "extra_people_cat": {"column": "extra_people", "edges": [0], "labels": [0, 1], "right": True},
+    "minimum_nights_cat": {"column": "minimum_nights", "edges": [7, 30], "labels": [1, 2, 3], "right": True},
+    "maximum_nights_cat": {"column": "maximum_nights", "edges": [30, 365], "labels": [1, 2, 3], "right": True},
+}
 HOST_FEATURES = [
     "years_as_host",
     "host_response_time",
@@ -148,17 +182,41 @@ BOOKING_FEATURES = [
     "require_guest_phone_verification",
     "require_guest_profile_picture"
 ]
+CATEGORICAL_FEATURES = [
+    "host_response_time",
+    "room_type",
+    "property_type_cat",
+    "neighbourhood_cleansed",
+    "cancellation_policy"
+]
+FLOAT_FEATURES = [
+    "years_as_host",
+    "host_response_rate",
+    "price",
+    "security_deposit",
+    "cleaning_fee"
+]
 
 #Training Full Model
-IMPUTED_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/imputed.csv')
+IMPUTED_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/imputed.' + ARTIFACT_FORMAT)
 SCORES_OUTPUT_LOCATION = path.join(PROJECT_HOME,'data/params_and_scores.txt')
+CV_RESULTS_LOCATION = path.join(PROJECT_HOME,'data/cv_results.parquet')
+OOF_PREDICTIONS_LOCATION = path.join(PROJECT_HOME,'data/oof_predictions.parquet')
 SAVED_MODEL_LOCATION = path.join(PROJECT_HOME,'data/trained_model.sav')
+COMPILED_MODEL_LOCATION = path.join(PROJECT_HOME,'data/trained_model.npz')
 SAVED_ENCODER_LOCATION = path.join(PROJECT_HOME,'data/encoder.sav')
+FEATURE_LAYOUT_LOCATION = path.join(PROJECT_HOME,'data/feature_layout.sav')
+IMPUTER_LOCATION = path.join(PROJECT_HOME,'data/imputer.sav')
+VOCAB_LOCATION = path.join(PROJECT_HOME,'data/vocabulary.sav')  # categories of the string features, built by --featurize
+IMPUTER_MAX_ITER = 12
+DB_LOAD_BATCH_SIZE = 5000  # rows per executemany batch for run_database.py --load
 RANDOM_STATE = 1414
+MODEL_ENGINE = "gbt"  # "gbt" (exact-split GradientBoostingClassifier) or "hist" (HistGradientBoostingClassifier)
+SPARSE_DESIGN = False  # train the gbt engine on a sparse CSR design matrix instead of a dense dataframe
 BEST_LR = 0.06144119459702984
 BEST_NUM_EST = 525
 BEST_MAX_DEPTH = 5
-BEST_SUBSAMPLE = 0.5
+BEST_SUBSAMPLE = 0.5  # not used by the hist engine, where BEST_NUM_EST is the number of boosting iterations
 
 #Tuning Hyperparameters
 TUNING_GRID = {
@@ -167,7 +225,15 @@ TUNING_GRID = {
     "max_depth": [3, 5, 8, 10, 15, 20],
     "subsample": [0.2, 0.3, 0.5, 0.7, 0.9]
 }
+HIST_TUNING_GRID = {
+    "learning_rate": stats.uniform(loc=0, scale=0.2),
+    "max_iter": np.arange(25, 750, 25),
+    "max_depth": [3, 5, 8, 10, 15, 20]
+}
 TEST_SIZE = 0.1
+SEARCH_MODE = "random"  # "random" (RandomizedSearchCV) or "halving" (successive halving, HalvingRandomSearchCV)
+HALVING_RESOURCE = "n_samples"  # resource given to the surviving candidates: "n_samples" or "n_estimators"
+HALVING_FACTOR = 3  # keep the best 1/HALVING_FACTOR candidates per round, with HALVING_FACTOR times the resource
 NUM_ITERS = 25 
 N_JOBS = -2
 PARAM_SCORING = ["roc_auc_ovo","accuracy"]
@@ -4,10 +4,22 @@ DEBUG = True
 LOGGING_CONFIG = "config/logging/local.conf"
 PORT = 5000
 APP_NAME = "airbnb_db"
-SQLALCHEMY_TRACK_MODIFICATIONS = True
+SQLALCHEMY_TRACK_MODIFICATIONS = False  # The app does not use the modification-tracking events
 HOST = "0.0.0.0"
 SQLALCHEMY_ECHO = False  # If true, SQL for queries made will be printed
-MAX_ROWS_SHOW = 100
+MAX_ROWS_SHOW = 100  # Listings per page on the index page
+# Columns shown on the index page (column -> header); only these are queried
+INDEX_COLUMNS = {
+    "neighbourhood_cleansed": "Neighbourhood",
+    "room_type": "Room Type",
+    "property_type_cat": "Property Type",
+    "reviews_per_month_bin": "Listing Popularity Score",
+}
+# Columns the index page can be filtered on, e.g. /?room_type=Private%20room
+INDEX_FILTERS = ["neighbourhood_cleansed", "room_type", "property_type_cat", "reviews_per_month_bin"]
+MODEL_HOT_RELOAD = True  # If true, reload model/feature layout when the files on disk change
+USE_COMPILED_MODEL = True  # If true, score small batches with the flattened .npz model instead of the pickled model
+COMPILED_MODEL_MAX_ROWS = 20  # Larger batches are scored with the pickled model, which is faster for them
 
 # Connection string
 DB_HOST = os.environ.get('MYSQL_HOST')
@@ -24,4 +36,19 @@ elif DB_HOST is None:
 else:
     SQLALCHEMY_DATABASE_URI = '{dialect}://{user}:{pw}@{host}:{port}/{db}'.format(dialect=DB_DIALECT, user=DB_USER,
                                                                                   pw=DB_PW, host=DB_HOST, port=DB_PORT,
-                                                                                  db=DATABASE)
\ No newline at end of file
+                                                                                  db=DATABASE)
+
+# Connection pool for MySQL (not applied to SQLite), overridable from the environment
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))  # Connections kept open
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))  # Extra connections under load, closed when returned
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600))  # Seconds before a connection is replaced
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'  # Test connections on checkout
+LOG_DB_TIMING = True  # If true, log the number of queries and time spent in the database for every request
+# Write-behind: /add returns without waiting for the insert, a background thread writes the listings in batches
+WRITE_BEHIND = False
+WRITE_BEHIND_BATCH_SIZE = 100  # Listings per insert
+WRITE_BEHIND_INTERVAL = 0.5  # Seconds a listing waits for its batch to fill
+WRITE_BEHIND_MAX_PENDING = 1000  # Queued listings above which /add writes synchronously again
+WRITE_BEHIND_MAX_RETRY_INTERVAL = 30.0  # Longest wait between retries of a batch while the database is unreachable
+# Listings that cannot be inserted (or are still pending when the app exits) are appended here as JSON lines
+WRITE_BEHIND_DEAD_LETTER_PATH = "data/write_behind_dead_letters.jsonl"
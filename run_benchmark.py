@@ -0,0 +1,750 @@
+import os
+from config import config
+import logging
+import argparse
+import pickle
+import tempfile
+import time
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sql
+from sklearn.datasets import make_classification
+
+from src.compiled_model import export_compiled_model, load_compiled_model
+from src.artifacts import read_table, write_table
+from src.clean import clean_frame, clean_pricing, clean_zips, PRICE_COLUMNS
+from src.create_features import create_features, create_features_incremental, apply_bin_spec
+from src.create_features import create_response_variable, featurize_partitions
+from src.impute import fit_imputer, apply_imputer, HOST_RESPONSE_TIME_MAP
+from src.train import CATEGORICAL_COLUMNS, one_hot_encode, encode_features, make_search, make_estimator
+from src.train import model_inputs, matrix_nbytes, ID_COLUMN
+from src.db_load import bulk_load
+from src.predict import map_bin
+from run_database import Airbnb
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.metrics import roc_auc_score
+from sklearn.model_selection import train_test_split
+
+# set up logging config
+logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+logger = logging.getLogger(__file__)
+
+
+def time_call(func, *args, min_seconds=0.5):
+    '''Average wall-clock seconds of func(*args), repeating until min_seconds have passed
+
+    Args:
+        func (function): function to time
+        min_seconds (float): minimum total time to spend repeating the call
+
+    Returns:
+        seconds (float): average seconds per call
+    '''
+    repeats = 0
+    start = time.perf_counter()
+    while True:
+        func(*args)
+        repeats += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / repeats
+
+def synthetic_listings(n_rows, seed, cities=("san-francisco",)):
+    '''Generate raw InsideAirbnb-like listings for benchmarks
+
+    Args:
+        n_rows (int): number of listings
+        seed (int): a seed to set for random_state to preserve reproducibility
+        cities (tuple): city names assigned round-robin to the listings
+
+    Returns:
+        df (dataframe object): raw listings with the columns the pipeline reads, reviews_per_month
+            depending on a few of the listing features
+    '''
+    rng = np.random.RandomState(seed)
+
+    def money(values):
+        return pd.Series(values).map(lambda v: "${:,.2f}".format(v) if v == v else np.nan)
+
+    def maybe_missing(values, rate):
+        return np.where(rng.rand(n_rows) < rate, np.nan, values)
+
+    df = pd.DataFrame({
+        "id": np.arange(1, n_rows + 1),
+        "city": np.resize(np.asarray(cities), n_rows),
+        "description": ["A lovely place to stay close to everything. " * 10] * n_rows,
+        "host_since": (pd.Timestamp("2008-08-01")
+                       + pd.to_timedelta(rng.randint(0, 4000, n_rows), unit="D")).strftime("%Y-%m-%d"),
+        "host_response_time": rng.choice(["within an hour", "within a few hours", "within a day",
+                                          "a few days or more", None], n_rows),
+        "host_response_rate": pd.Series(maybe_missing(rng.randint(0, 101, n_rows), 0.15)).map(
+            lambda v: "{:.0f}%".format(v) if v == v else np.nan),
+        "host_is_superhost": rng.choice(["t", "f"], n_rows),
+        "host_has_profile_pic": rng.choice(["t", "f"], n_rows, p=[0.95, 0.05]),
+        "host_identity_verified": rng.choice(["t", "f"], n_rows),
+        "host_listings_count": rng.randint(1, 30, n_rows),
+        "room_type": rng.choice(["Entire home/apt", "Private room", "Shared room", "Hotel room"], n_rows),
+        "property_type": rng.choice(["Apartment", "House", "Condominium", "Guest suite", "Loft", "Boat"], n_rows),
+        "accommodates": rng.randint(1, 12, n_rows),
+        "bathrooms": maybe_missing(rng.randint(0, 8, n_rows) / 2, 0.02),
+        "bedrooms": maybe_missing(rng.randint(0, 6, n_rows), 0.02),
+        "beds": rng.randint(1, 8, n_rows),
+        "guests_included": rng.randint(0, 6, n_rows),
+        "extra_people": money(rng.choice([0, 10, 25, 50], n_rows).astype(float)),
+        "price": money(rng.uniform(40, 2500, n_rows).round(0)),
+        "weekly_price": money(maybe_missing(rng.uniform(200, 9000, n_rows).round(0), 0.8)),
+        "monthly_price": money(maybe_missing(rng.uniform(800, 30000, n_rows).round(0), 0.8)),
+        "security_deposit": money(maybe_missing(rng.uniform(0, 2000, n_rows).round(0), 0.3)),
+        "cleaning_fee": money(maybe_missing(rng.uniform(0, 300, n_rows).round(0), 0.2)),
+        "amenities": pd.Series(rng.randint(1, 60, n_rows)).map(lambda k: "{" + ",".join(["Wifi"] * k) + "}"),
+        "neighbourhood_cleansed": rng.choice(["Mission", "Marina", "Bayview", "Nob Hill", "South of Market",
+                                              "Outer Sunset", "Noe Valley", "Western Addition"], n_rows),
+        "minimum_nights": rng.choice([1, 2, 3, 7, 14, 30, 60], n_rows),
+        "maximum_nights": rng.choice([7, 30, 90, 365, 1125], n_rows),
+        "instant_bookable": rng.choice(["t", "f"], n_rows),
+        "cancellation_policy": rng.choice(["flexible", "moderate", "strict_14_with_grace_period",
+                                           "super_strict_30"], n_rows),
+        "require_guest_phone_verification": rng.choice(["t", "f"], n_rows),
+        "require_guest_profile_picture": rng.choice(["t", "f"], n_rows),
+        "reviews_per_month": maybe_missing(rng.exponential(1.5, n_rows).round(2) + 0.01, 0.15),
+        "availability_30": rng.randint(0, 31, n_rows),
+        "availability_365": rng.randint(0, 366, n_rows),
+        "calendar_updated": rng.choice(["today", "2 weeks ago", "3 months ago", "never"], n_rows),
+        "number_of_reviews": rng.randint(0, 400, n_rows),
+        "last_review": (pd.Timestamp("2019-01-01")
+                        + pd.to_timedelta(rng.randint(0, 400, n_rows), unit="D")).strftime("%Y-%m-%d"),
+        "review_scores_rating": maybe_missing(rng.randint(60, 101, n_rows), 0.15),
+        "zipcode": rng.choice(["94110", "CA 94110", "CA", "94103", "94117", "99999", None], n_rows),
+    })
+    for col in config.LISTINGS_DROP_COLS:
+        df[col] = "https://example.com/" + col
+
+    #reviews_per_month depends on the listing, so models trained on synthetic listings have a signal to learn
+    popularity = np.exp(1.2 * (df["host_is_superhost"] == "t") + 0.8 * (df["instant_bookable"] == "t")
+                        + 0.8 * (df["room_type"] == "Private room") - 0.4 * np.log(df["minimum_nights"])
+                        - 0.15 * df["accommodates"] + 0.02 * df["amenities"].str.count(","))
+    df["reviews_per_month"] = (df["reviews_per_month"] * popularity / popularity.mean()).round(2) + 0.01
+
+    return df
+
+def benchmark_compiled_model(model_path, batch_sizes, seed):
+    '''Compare sklearn predict_proba with the compiled .npz evaluator at several batch sizes
+
+    Args:
+        model_path (str): pickled GradientBoostingClassifier; a model with the BEST_* config
+            hyperparameters is trained on synthetic data if the file does not exist
+        batch_sizes (list): number of rows scored per call
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    rng = np.random.RandomState(seed)
+    if os.path.exists(model_path):
+        trained_model = pickle.load(open(model_path, "rb"))
+        n_features = getattr(trained_model, "n_features_in_", None) or trained_model.n_features_
+        X = rng.normal(size=(max(batch_sizes), n_features))
+        logger.info("Benchmarking model from %s", model_path)
+    else:
+        X, y = make_classification(5000, 39, n_informative=15, n_classes=4, random_state=seed)
+        trained_model = GradientBoostingClassifier(learning_rate=config.BEST_LR, n_estimators=config.BEST_NUM_EST,
+                                                   max_depth=config.BEST_MAX_DEPTH,
+                                                   subsample=config.BEST_SUBSAMPLE, random_state=seed)
+        trained_model.fit(X, y)
+        X = X[rng.randint(0, len(X), max(batch_sizes))]
+        logger.info("No model at %s, benchmarking a synthetic model with the BEST_* hyperparameters", model_path)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compiled_path = os.path.join(tmp_dir, "model.npz")
+        export_compiled_model(trained_model, compiled_path)
+        logger.info("Compiled model size: %.1f KB (pickle: %.1f KB)", os.path.getsize(compiled_path) / 1024,
+                    len(pickle.dumps(trained_model)) / 1024)
+        compiled = load_compiled_model(compiled_path)
+
+    max_diff = np.abs(compiled.predict_proba(X[:10000]) - trained_model.predict_proba(X[:10000])).max()
+    logger.info("Max |predict_proba difference|: %.3g", max_diff)
+
+    for batch_size in batch_sizes:
+        batch = X[:batch_size]
+        sklearn_seconds = time_call(trained_model.predict_proba, batch)
+        compiled_seconds = time_call(compiled.predict_proba, batch)
+        logger.info("batch %7d | sklearn %10.0f rows/s (%.2f ms/call) | compiled %10.0f rows/s (%.2f ms/call)",
+                    batch_size, batch_size / sklearn_seconds, sklearn_seconds * 1000,
+                    batch_size / compiled_seconds, compiled_seconds * 1000)
+
+def benchmark_formats(n_rows, output_dir, seed):
+    '''Time writing and reading the clean, features and imputed datasets as csv, Parquet and Feather
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        output_dir (str): directory for the benchmark files
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    raw = synthetic_listings(n_rows, seed).drop(columns=list(config.LISTINGS_DROP_COLS))
+    clean_df = clean_frame(raw, config.VALID_ZIP)
+    clean_path = os.path.join(output_dir, "clean.csv")
+    write_table(clean_df, clean_path)
+    features_df = create_features(clean_path, config.DATA_SCRAPE_DATE, config.HOST_FEATURES,
+                                  config.PROPERTY_FEATURES, config.BOOKING_FEATURES, config.RESPONSE_VARIABLE,
+                                  config.BIN_SPECS)
+    imputed_df = features_df.fillna(features_df.median(numeric_only=True)).fillna("within an hour")
+
+    for stage, df in (("clean", clean_df), ("features", features_df), ("imputed", imputed_df)):
+        for fmt in ("csv", "parquet", "feather"):
+            filepath = os.path.join(output_dir, "{}.{}".format(stage, fmt))
+            write_seconds = time_call(write_table, df, filepath)
+            read_seconds = time_call(read_table, filepath)
+            logger.info("%-8s | %-7s | write %8.1f ms | read %8.1f ms | %8.1f KB", stage, fmt,
+                        write_seconds * 1000, read_seconds * 1000, os.path.getsize(filepath) / 1024)
+
+def benchmark_incremental(n_rows, changed_fractions, output_dir, seed):
+    '''Time featurizing a month-later snapshot in full and incrementally, for several shares of changed listings
+
+    In every next snapshot the columns that move monthly (availability, calendar_updated, review
+    counts, dates and scores, reviews_per_month) change for all listings, the price changes for
+    the given share of listings and the scrape date is a month later.
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        changed_fractions (list): shares of listings changed in the next snapshot
+        output_dir (str): directory for the benchmark files
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    feature_args = (config.HOST_FEATURES, config.PROPERTY_FEATURES, config.BOOKING_FEATURES,
+                    config.RESPONSE_VARIABLE, config.BIN_SPECS)
+    raw = synthetic_listings(n_rows, seed).drop(columns=list(config.LISTINGS_DROP_COLS))
+    clean_df = clean_frame(raw, config.VALID_ZIP)
+    clean_path = os.path.join(output_dir, "clean.parquet")
+    write_table(clean_df, clean_path)
+    state = create_features_incremental(clean_path, None, "benchmark", config.DATA_SCRAPE_DATE, *feature_args)[1]
+
+    rng = np.random.RandomState(seed)
+    next_scrape_date = config.DATA_SCRAPE_DATE + timedelta(days=30)
+    for fraction in changed_fractions:
+        changed = rng.rand(len(clean_df)) < fraction
+        next_path = os.path.join(output_dir, "next_clean.parquet")
+        new_reviews = rng.poisson(2, len(clean_df))
+        write_table(clean_df.assign(price=np.where(changed, clean_df["price"] + 1, clean_df["price"]),
+                                    availability_30=rng.randint(0, 31, len(clean_df)),
+                                    availability_365=rng.randint(0, 366, len(clean_df)),
+                                    calendar_updated="today",
+                                    number_of_reviews=clean_df["number_of_reviews"] + new_reviews,
+                                    last_review=np.where(new_reviews > 0, "2020-05-01", clean_df["last_review"]),
+                                    review_scores_rating=clean_df["review_scores_rating"] - (new_reviews > 2),
+                                    reviews_per_month=clean_df["reviews_per_month"] * 1.05), next_path)
+
+        start = time.perf_counter()
+        full = create_features(next_path, next_scrape_date, *feature_args)
+        full_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        incremental = create_features_incremental(next_path, state, "benchmark", next_scrape_date, *feature_args)[0]
+        incremental_seconds = time.perf_counter() - start
+
+        pd.testing.assert_frame_equal(full, incremental)
+        logger.info("%5.1f%% changed | full %6.2f s | incremental %6.2f s | %5.1fx", 100 * changed.mean(),
+                    full_seconds, incremental_seconds, full_seconds / incremental_seconds)
+
+def benchmark_featurize_scaling(n_rows, jobs, seed):
+    '''Time the host, property and booking features of multi-city synthetic listings on 1 to N processes
+
+    Listings are split by row ranges and by city; every run is checked against the single-process features.
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        jobs (list): numbers of processes to benchmark
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    cities = ("san-francisco", "oakland", "los-angeles", "new-york", "seattle", "boston", "austin", "chicago")
+    raw = synthetic_listings(n_rows, seed, cities).drop(columns=list(config.LISTINGS_DROP_COLS))
+    clean_df = create_response_variable(clean_frame(raw, config.VALID_ZIP), config.BIN_SPECS)
+    logger.info("%d listings in %d cities, %d CPUs available", len(clean_df), len(cities), os.cpu_count())
+
+    reference, base_seconds = None, None
+    for partition_by in (None, "city"):
+        for n_jobs in jobs:
+            start = time.perf_counter()
+            featured = featurize_partitions(clean_df.copy(), config.DATA_SCRAPE_DATE, config.BIN_SPECS,
+                                            n_jobs, partition_by)
+            seconds = time.perf_counter() - start
+            if reference is None:
+                reference, base_seconds = featured, seconds
+            pd.testing.assert_frame_equal(featured, reference)
+            logger.info("%-10s | %2d processes | %6.2f s | %5.2fx", partition_by or "row ranges", n_jobs,
+                        seconds, base_seconds / seconds)
+
+def object_clean_columns(df, zipcodes):
+    '''Reference for benchmark_parsing: string methods on object columns, one pass per operation
+    (the approach replaced by parse_currency and parse_zipcodes)'''
+    df = df.copy()
+    df.zipcode = df.zipcode.str.replace("CA ", "")
+    df.zipcode = df.zipcode.replace("CA", np.nan)
+    df.loc[~df.zipcode.isin(zipcodes), "zipcode"] = np.nan
+    for col in PRICE_COLUMNS:
+        df[col] = df[col].str.replace(",", "").str[1:].astype(float)
+    return df
+
+def benchmark_parsing(n_rows, output_dir, seed):
+    '''Time reading and parsing the price and zipcode columns of a synthetic listings csv
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        output_dir (str): directory for the benchmark file
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    columns = PRICE_COLUMNS + ["zipcode"]
+    filepath = os.path.join(output_dir, "listings.csv")
+    synthetic_listings(n_rows, seed)[columns].to_csv(filepath, index=False)
+
+    start = time.perf_counter()
+    raw = pd.read_csv(filepath, dtype={col: "str" for col in columns})
+    logger.info("read %d rows: %.2f s", n_rows, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    reference = object_clean_columns(raw, config.VALID_ZIP)
+    logger.info("object string methods:  %.2f s", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    parsed = clean_zips(raw.copy(), config.VALID_ZIP)
+    for col in PRICE_COLUMNS:
+        parsed = clean_pricing(parsed, col)
+    logger.info("Arrow compute kernels:  %.2f s", time.perf_counter() - start)
+
+    assert parsed[PRICE_COLUMNS].equals(reference[PRICE_COLUMNS])
+    assert parsed["zipcode"].astype(float).equals(reference["zipcode"].astype(float))
+
+def benchmark_binning(n_rows, replicate, seed):
+    '''Time the BIN_SPECS binning engine on synthetic listings replicated several times, against pd.cut
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        replicate (int): number of times the cleaned listings are stacked
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    raw = synthetic_listings(n_rows, seed).drop(columns=list(config.LISTINGS_DROP_COLS))
+    df = pd.concat([clean_frame(raw, config.VALID_ZIP)] * replicate, ignore_index=True)
+    logger.info("Binning %d rows", len(df))
+
+    total = 0
+    for col_name, spec in config.BIN_SPECS.items():
+        seconds = time_call(apply_bin_spec, df.copy(), col_name, spec)
+        total += seconds
+        if "edges" in spec:
+            bins = [-np.inf] + list(spec["edges"]) + [np.inf]
+            cut_seconds = time_call(pd.cut, df[spec["column"]], bins, spec.get("right", False), spec["labels"])
+            logger.info("%-22s | bin spec %7.1f ms | pd.cut %7.1f ms", col_name, seconds * 1000, cut_seconds * 1000)
+        else:
+            logger.info("%-22s | bin spec %7.1f ms", col_name, seconds * 1000)
+    logger.info("All bins: %.1f ms (%.0f rows/s)", total * 1000, len(df) / total)
+
+def impute_all_columns(df, seed, max_iter):
+    '''Reference for benchmark_imputation: one-hot encode every categorical level and fit an
+    IterativeImputer over all columns on each run (the approach replaced by fit_imputer)'''
+    from sklearn.experimental import enable_iterative_imputer
+    from sklearn.impute import IterativeImputer
+
+    df = df.fillna({"security_deposit": df["security_deposit"].median(), "cleaning_fee": df["cleaning_fee"].median()})
+    df = pd.get_dummies(df, columns=[c for c in CATEGORICAL_COLUMNS if c != "host_response_time"], drop_first=True)
+    df["host_response_time"] = df["host_response_time"].map(HOST_RESPONSE_TIME_MAP)
+    imputer = IterativeImputer(max_iter=max_iter, random_state=seed, initial_strategy="most_frequent")
+    return imputer.fit_transform(df.drop(columns=["reviews_per_month_bin", ID_COLUMN], errors="ignore"))
+
+def benchmark_imputation(n_rows, seed):
+    '''Time fitting and applying the saved imputer against refitting an imputer over every column
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    raw = synthetic_listings(n_rows, seed).drop(columns=list(config.LISTINGS_DROP_COLS))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clean_path = os.path.join(tmp_dir, "clean.csv")
+        write_table(clean_frame(raw, config.VALID_ZIP), clean_path)
+        df = create_features(clean_path, config.DATA_SCRAPE_DATE, config.HOST_FEATURES, config.PROPERTY_FEATURES,
+                             config.BOOKING_FEATURES, config.RESPONSE_VARIABLE, config.BIN_SPECS)
+    df = df.reset_index(drop=True)
+    logger.info("Imputing %d rows (%d with a missing host_response_rate)", len(df),
+                df["host_response_rate"].isna().sum())
+
+    start = time.perf_counter()
+    impute_all_columns(df, seed, config.IMPUTER_MAX_ITER)
+    logger.info("Refit on every column (one-hot encoded):  %8.2f s", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    imputer = fit_imputer(df, seed, CATEGORICAL_COLUMNS, max_iter=config.IMPUTER_MAX_ITER)
+    logger.info("fit_imputer (fitted once):               %8.2f s", time.perf_counter() - start)
+
+    apply_seconds = time_call(apply_imputer, df, imputer)
+    logger.info("apply_imputer on the same rows:           %8.2f s", apply_seconds)
+    one_row = df[df["host_response_rate"].isna()].head(1)
+    logger.info("apply_imputer on one listing:             %8.2f ms", time_call(apply_imputer, one_row, imputer) * 1000)
+
+def synthetic_imputed_listings(n_rows, seed):
+    '''Synthetic listings run through cleaning, featurizing and imputation
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        df (dataframe object): imputed model data, as written by run_model.py --impute
+    '''
+    raw = synthetic_listings(n_rows, seed).drop(columns=list(config.LISTINGS_DROP_COLS))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        clean_path = os.path.join(tmp_dir, "clean.csv")
+        write_table(clean_frame(raw, config.VALID_ZIP), clean_path)
+        df = create_features(clean_path, config.DATA_SCRAPE_DATE, config.HOST_FEATURES, config.PROPERTY_FEATURES,
+                             config.BOOKING_FEATURES, config.RESPONSE_VARIABLE, config.BIN_SPECS)
+    df = df.reset_index(drop=True)
+    return apply_imputer(df, fit_imputer(df, seed, CATEGORICAL_COLUMNS, max_iter=config.IMPUTER_MAX_ITER))
+
+def synthetic_model_data(n_rows, seed):
+    '''Synthetic imputed listings, one-hot encoded
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        predictors (dataframe object): one-hot encoded model inputs
+        response (series): reviews_per_month_bin
+    '''
+    df = one_hot_encode(synthetic_imputed_listings(n_rows, seed).drop(columns=[ID_COLUMN]))[0]
+
+    return df.loc[:, df.columns != "reviews_per_month_bin"], df["reviews_per_month_bin"]
+
+def benchmark_search(n_rows, num_iters, seed):
+    '''Compare wall-clock time and scores of random search and successive halving on the same split
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        num_iters (int): number of random search candidates
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    predictors, response = synthetic_model_data(n_rows, seed)
+    X_train, X_test, y_train, y_test = train_test_split(predictors, response, test_size=config.TEST_SIZE,
+                                                        random_state=seed)
+    logger.info("Tuning on %d rows, %d held out", len(X_train), len(X_test))
+
+    for search_mode, resource in (("random", None), ("halving", "n_samples"), ("halving", "n_estimators")):
+        search = make_search(GradientBoostingClassifier(n_iter_no_change=3, random_state=seed), config.TUNING_GRID,
+                             search_mode, num_iters, seed, config.N_JOBS, config.PARAM_SCORING, config.GRID_REFIT,
+                             resource, config.HALVING_FACTOR)
+        start = time.perf_counter()
+        search.fit(X_train, y_train)
+        seconds = time.perf_counter() - start
+        n_candidates = len(search.cv_results_["params"])
+        test_auc = roc_auc_score(y_test, search.predict_proba(X_test), multi_class="ovo", average="macro")
+        logger.info("%-8s %-12s | %7.1f s | %3d candidate fits | CV AUC %.4f | held-out AUC %.4f | %s",
+                    search_mode, resource or "", seconds, n_candidates, search.best_score_, test_auc,
+                    search.best_params_)
+
+def benchmark_engines(imputed_path, n_rows, batch_sizes, seed):
+    '''Compare fit time, predict latency (sklearn and compiled) and held-out AUC of the gbt and hist engines
+
+    Both engines are trained with the BEST_* hyperparameters on the same training rows, without
+    early stopping so that each fits all BEST_NUM_EST boosting stages.
+
+    Args:
+        imputed_path (str): imputed model data; synthetic listings are used if it does not exist
+        n_rows (int): number of synthetic raw listings
+        batch_sizes (list): numbers of listings scored per predict_proba call
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    if os.path.exists(imputed_path):
+        df = read_table(imputed_path)
+    else:
+        logger.info("%s not found, benchmarking on %d synthetic listings", imputed_path, n_rows)
+        df = synthetic_imputed_listings(n_rows, seed)
+
+    engine_params = {
+        "gbt": {"learning_rate": config.BEST_LR, "n_estimators": config.BEST_NUM_EST,
+                "max_depth": config.BEST_MAX_DEPTH, "subsample": config.BEST_SUBSAMPLE, "n_iter_no_change": None},
+        "hist": {"learning_rate": config.BEST_LR, "max_iter": config.BEST_NUM_EST, "max_depth": config.BEST_MAX_DEPTH,
+                 "early_stopping": False},
+    }
+    for engine, params in engine_params.items():
+        encoded = encode_features(df.drop(columns=[ID_COLUMN], errors="ignore"), engine)[0]
+        predictors = encoded.loc[:, encoded.columns != "reviews_per_month_bin"]
+        X_train, X_test, y_train, y_test = train_test_split(predictors, encoded["reviews_per_month_bin"],
+                                                            test_size=config.TEST_SIZE, random_state=seed)
+        model = make_estimator(engine, seed, predictors.columns, **params)
+
+        start = time.perf_counter()
+        model.fit(X_train, y_train)
+        fit_seconds = time.perf_counter() - start
+        test_auc = roc_auc_score(y_test, model.predict_proba(X_test), multi_class="ovo", average="macro")
+        logger.info("%-4s | %d columns | fit %7.2f s on %d rows | held-out AUC %.4f", engine, predictors.shape[1],
+                    fit_seconds, len(X_train), test_auc)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_compiled_model(model, os.path.join(tmp_dir, "model.npz"))
+            compiled = load_compiled_model(os.path.join(tmp_dir, "model.npz"))
+
+        X_test = X_test.to_numpy(dtype=np.float64)
+        for batch_size in batch_sizes:
+            batch = X_test[np.arange(batch_size) % len(X_test)]
+            for name, scorer in (("sklearn", model), ("compiled", compiled)):
+                seconds = time_call(scorer.predict_proba, batch)
+                logger.info("%-4s | %-8s | batch %7d | %10.3f ms per call | %12.0f rows/s", engine, name,
+                            batch_size, seconds * 1000, batch_size / seconds)
+
+def benchmark_design_matrix(n_rows, neighbourhoods, n_estimators, seed):
+    '''Compare memory, build time and gbt fit time of the dense and sparse one-hot design matrices
+
+    neighbourhood_cleansed of the synthetic listings is relabelled with each number of
+    neighbourhoods, to see how both layouts grow as categories are added.
+
+    Args:
+        n_rows (int): number of synthetic raw listings
+        neighbourhoods (list): numbers of distinct neighbourhoods to benchmark
+        n_estimators (int): boosting stages fitted per model
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    df = synthetic_imputed_listings(n_rows, seed)
+    rng = np.random.RandomState(seed)
+    params = {"learning_rate": config.BEST_LR, "n_estimators": n_estimators, "max_depth": config.BEST_MAX_DEPTH,
+              "subsample": config.BEST_SUBSAMPLE, "n_iter_no_change": None}
+
+    for n_neighbourhoods in neighbourhoods:
+        df["neighbourhood_cleansed"] = np.char.add("Neighbourhood ", rng.randint(0, n_neighbourhoods, len(df)).astype(str))
+        predictions = {}
+        for layout, sparse_design in (("dense", False), ("sparse", True)):
+            start = time.perf_counter()
+            predictors, response, columns, _ = model_inputs(df, "gbt", sparse_design=sparse_design)
+            build_seconds = time.perf_counter() - start
+            X_train, X_test, y_train, y_test = train_test_split(predictors, response, test_size=config.TEST_SIZE,
+                                                                random_state=seed)
+            model = make_estimator("gbt", seed, columns, **params)
+
+            start = time.perf_counter()
+            model.fit(X_train, y_train)
+            fit_seconds = time.perf_counter() - start
+            proba = model.predict_proba(X_test)
+            predictions[layout] = np.argmax(proba, axis=1)
+            logger.info("%4d neighbourhoods | %-6s | %d x %d | %8.1f MB | build %6.2f s | fit %7.2f s | "
+                        "held-out AUC %.4f", n_neighbourhoods, layout, predictors.shape[0], predictors.shape[1],
+                        matrix_nbytes(predictors) / 1e6, build_seconds, fit_seconds,
+                        roc_auc_score(y_test, proba, multi_class="ovo", average="macro"))
+        logger.info("%4d neighbourhoods | same held-out prediction for %.2f%% of listings", n_neighbourhoods,
+                    100 * np.mean(predictions["dense"] == predictions["sparse"]))
+
+DB_QUERIES = {
+    "room type x popularity in a neighbourhood":
+        "SELECT room_type, reviews_per_month_bin, COUNT(*) FROM abb_feat_and_resp "
+        "WHERE neighbourhood_cleansed = :neighbourhood GROUP BY room_type, reviews_per_month_bin",
+    "average price by property type x popularity":
+        "SELECT property_type_cat, reviews_per_month_bin, AVG(price) FROM abb_feat_and_resp "
+        "GROUP BY property_type_cat, reviews_per_month_bin",
+    "neighbourhoods for a popularity bin":
+        "SELECT neighbourhood_cleansed, COUNT(*) FROM abb_feat_and_resp "
+        "WHERE reviews_per_month_bin = :popularity GROUP BY neighbourhood_cleansed",
+    "popularity by room type":
+        "SELECT room_type, reviews_per_month_bin, COUNT(*) FROM abb_feat_and_resp "
+        "GROUP BY room_type, reviews_per_month_bin",
+    "100 listings for a neighbourhood and room type":
+        "SELECT * FROM abb_feat_and_resp "
+        "WHERE neighbourhood_cleansed = :neighbourhood AND room_type = :room_type LIMIT 100",
+    "index page of a room type, halfway down":
+        "SELECT id, neighbourhood_cleansed, room_type, price FROM abb_feat_and_resp "
+        "WHERE room_type = :room_type AND id < :cursor ORDER BY id DESC LIMIT 101",
+    "index page of a 0.1% neighbourhood, halfway down":
+        "SELECT id, neighbourhood_cleansed, room_type, price FROM abb_feat_and_resp "
+        "WHERE neighbourhood_cleansed = :sparse_neighbourhood AND id < :cursor ORDER BY id DESC LIMIT 101",
+}
+
+def legacy_table(table):
+    '''Copy of a model table with the original schema: String(100) and Integer columns and no indexes'''
+    columns = []
+    for col in table.columns:
+        if isinstance(col.type, sql.String):
+            col_type = sql.String(100)
+        elif isinstance(col.type, sql.Integer):
+            col_type = sql.Integer()
+        else:
+            col_type = col.type
+        columns.append(sql.Column(col.name, col_type, primary_key=col.primary_key))
+    return sql.Table(table.name, sql.MetaData(), *columns)
+
+def benchmark_db_queries(imputed_path, n_rows, output_dir, seed):
+    '''Compare dashboard query latency on the original and the indexed, compact abb_feat_and_resp schema
+
+    The imputed listings are resampled to n_rows, bulk loaded into a SQLite database per schema
+    and every query in DB_QUERIES is timed on both.
+
+    Args:
+        imputed_path (str): imputed model data; synthetic listings are used if it does not exist
+        n_rows (int): number of rows to load
+        output_dir (str): directory for the benchmark databases
+        seed (int): a seed to set for random_state to preserve reproducibility
+
+    Returns:
+        None
+    '''
+    if os.path.exists(imputed_path):
+        df = read_table(imputed_path)
+    else:
+        logger.info("%s not found, benchmarking on synthetic listings", imputed_path)
+        df = synthetic_imputed_listings(min(n_rows, 10000), seed)
+    df = df.sample(n_rows, replace=True, random_state=seed).reset_index(drop=True)
+    df["id"] = np.arange(1, n_rows + 1)
+    #a neighbourhood with 0.1% of the listings, like the smallest San Francisco ones: without a
+    #(neighbourhood, id) index an index page filtered on it scans about 1000 rows per listing shown
+    sparse = np.random.RandomState(seed).rand(n_rows) < 0.001
+    df.loc[sparse, "neighbourhood_cleansed"] = "Presidio"
+    listings_path = os.path.join(output_dir, "listings.parquet")
+    write_table(df, listings_path)
+
+    row = df.iloc[0]
+    params = {"neighbourhood": row["neighbourhood_cleansed"], "room_type": row["room_type"],
+              "popularity": map_bin(row["reviews_per_month_bin"]), "cursor": n_rows // 2,
+              "sparse_neighbourhood": "Presidio"}
+    for name, table in (("original", legacy_table(Airbnb.__table__)), ("indexed", Airbnb.__table__)):
+        db_path = os.path.join(output_dir, name + ".db")
+        engine = sql.create_engine("sqlite:///" + db_path)
+        table.create(engine)
+        bulk_load(engine, table, listings_path, config.DB_LOAD_BATCH_SIZE)
+        engine.execute("ANALYZE")
+        logger.info("%-8s | %d rows | %.1f MB", name, n_rows, os.path.getsize(db_path) / 1e6)
+
+        with engine.connect() as connection:
+            for query_name, query in DB_QUERIES.items():
+                statement = sql.text(query)
+                seconds = time_call(lambda: connection.execute(statement, params).fetchall())
+                logger.info("%-8s | %-50s | %9.2f ms", name, query_name, seconds * 1000)
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pipeline and serving performance.")
+
+    #Benchmark the compiled model evaluator against sklearn
+    parser.add_argument('--compiled_model', '-cm', default=False, action='store_true',
+                            help = "If given, compare sklearn and compiled model throughput")
+    #Benchmark the pipeline dataset formats
+    parser.add_argument('--formats', '-fo', default=False, action='store_true',
+                            help = "If given, compare csv, Parquet and Feather read/write times")
+    #number of synthetic rows
+    parser.add_argument('--rows', '-r', default=100000, type=int,
+                            help = "If given, change the number of synthetic listings to benchmark on")
+    #Benchmark currency and zipcode parsing
+    parser.add_argument('--parsing', '-pa', default=False, action='store_true',
+                            help = "If given, time parsing the price and zipcode columns of the synthetic listings")
+    #Benchmark incremental featurization
+    parser.add_argument('--incremental', '-in', default=False, action='store_true',
+                            help = "If given, compare full and incremental featurization of a month-later snapshot")
+    #shares of changed listings
+    parser.add_argument('--changed', '-ch', default=[0.01, 0.05, 0.2, 1.0], type=float, nargs='+',
+                            help = "If given, change the shares of listings changed in the next snapshot for --incremental")
+    #Benchmark parallel featurization
+    parser.add_argument('--featurize_scaling', '-fs', default=False, action='store_true',
+                            help = "If given, time featurizing multi-city synthetic listings on 1 to N processes")
+    #numbers of processes
+    parser.add_argument('--jobs', '-j', default=[1, 2, 4, 8], type=int, nargs='+',
+                            help = "If given, change the numbers of processes --featurize_scaling runs on")
+    #Benchmark the feature binning engine
+    parser.add_argument('--binning', '-bi', default=False, action='store_true',
+                            help = "If given, time the BIN_SPECS binning engine")
+    #number of times the synthetic listings are replicated
+    parser.add_argument('--replicate', '-re', default=10, type=int,
+                            help = "If given, change how many times the synthetic listings are stacked for --binning")
+    #Benchmark imputation
+    parser.add_argument('--imputation', '-im', default=False, action='store_true',
+                            help = "If given, time the saved imputer against refitting an imputer over every column")
+    #Benchmark hyperparameter search modes
+    parser.add_argument('--search', '-se', default=False, action='store_true',
+                            help = "If given, compare random search and successive halving")
+    #random search candidates
+    parser.add_argument('--num_iters', '-ni', default=config.NUM_ITERS, type=int,
+                            help = "If given, change the number of random search candidates for --search")
+    #Benchmark the model engines
+    parser.add_argument('--engines', '-en', default=False, action='store_true',
+                            help = "If given, compare fit time, predict latency and AUC of the gbt and hist engines")
+    #Benchmark the dense and sparse design matrices
+    parser.add_argument('--design_matrix', '-dm', default=False, action='store_true',
+                            help = "If given, compare memory and fit time of the dense and sparse one-hot design matrices")
+    #numbers of neighbourhoods
+    parser.add_argument('--neighbourhoods', '-nb', default=[37, 150, 600], type=int, nargs='+',
+                            help = "If given, change the numbers of neighbourhoods --design_matrix relabels the listings with")
+    #boosting stages
+    parser.add_argument('--stages', '-st', default=50, type=int,
+                            help = "If given, change the number of boosting stages --design_matrix fits")
+    #imputed data filepath
+    parser.add_argument('--imputed_path', '-ip', default=config.IMPUTED_OUTPUT_LOCATION,
+                            help = "If given, change the imputed data --engines trains on")
+    #Benchmark the database schema
+    parser.add_argument('--db_queries', '-dq', default=False, action='store_true',
+                            help = "If given, compare dashboard query latency on the original and indexed table schema")
+    #trained model filepath
+    parser.add_argument('--model_path', '-mp', default=config.SAVED_MODEL_LOCATION,
+                            help = "If given, change filepath of the trained model to benchmark")
+    #batch sizes
+    parser.add_argument('--batch_sizes', '-bs', default=[1, 100, 100000], type=int, nargs='+',
+                            help = "If given, change the batch sizes to benchmark")
+
+    args = parser.parse_args()
+
+    if args.compiled_model:
+        benchmark_compiled_model(args.model_path, args.batch_sizes, config.RANDOM_STATE)
+
+    if args.formats:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_formats(args.rows, tmp_dir, config.RANDOM_STATE)
+
+    if args.parsing:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_parsing(args.rows, tmp_dir, config.RANDOM_STATE)
+
+    if args.incremental:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_incremental(args.rows, args.changed, tmp_dir, config.RANDOM_STATE)
+
+    if args.featurize_scaling:
+        benchmark_featurize_scaling(args.rows, args.jobs, config.RANDOM_STATE)
+
+    if args.binning:
+        benchmark_binning(args.rows, args.replicate, config.RANDOM_STATE)
+
+    if args.imputation:
+        benchmark_imputation(args.rows, config.RANDOM_STATE)
+
+    if args.search:
+        benchmark_search(args.rows, args.num_iters, config.RANDOM_STATE)
+
+    if args.engines:
+        benchmark_engines(args.imputed_path, args.rows, args.batch_sizes, config.RANDOM_STATE)
+
+    if args.design_matrix:
+        benchmark_design_matrix(args.rows, args.neighbourhoods, args.stages, config.RANDOM_STATE)
+
+    if args.db_queries:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            benchmark_db_queries(args.imputed_path, args.rows, tmp_dir, config.RANDOM_STATE)
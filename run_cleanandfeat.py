@@ -2,10 +2,15 @@ import os
 from config import config
 import logging
 import argparse
+import pickle
 
 from src.downloads3 import downloads3
-from src.clean import clean_data
-from src.create_features import create_features
+from src.clean import clean_data, clean_data_chunked
+from src.create_features import create_features, create_features_incremental
+from src.artifacts import artifact_format, read_table, write_table
+from src.train import CATEGORICAL_COLUMNS
+from src.vocabulary import build_vocabulary, load_vocabulary, apply_vocabulary
+from src.stage_cache import stage_fingerprint, source_files, is_up_to_date, record_fingerprint
 
 # set up logging config
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
@@ -31,9 +36,35 @@ if __name__ == '__main__':
     #clean output filepath
     parser.add_argument('--clean_path', '-cp', default=config.CLEAN_OUTPUT_LOCATION,
                             help = "If given, create filepath for clean data")
+    #chunked cleaning
+    parser.add_argument('--chunksize', '-cs', default=config.CLEAN_CHUNKSIZE, type=int,
+                            help = "If given, clean the raw data in chunks of this many rows")
     #feature output filepath
     parser.add_argument('--feature_path', '-fp', default=config.FEATURE_OUTPUT_LOCATION,
                             help = "If given, create filepath for feature data")
+    #featurize only new and changed listings
+    parser.add_argument('--incremental', '-in', default=False, action='store_true',
+                            help = "If given, recompute features only for listings new or changed since the previous snapshot")
+    #feature state filepath
+    parser.add_argument('--state_path', '-sp', default=config.FEATURE_STATE_LOCATION,
+                            help = "If given, change filepath for the feature state --incremental reads and updates")
+    #featurize in parallel processes
+    parser.add_argument('--n_jobs', '-nj', default=config.FEATURE_N_JOBS, type=int,
+                            help = "If given, featurize the listings in this many processes")
+    #partition column for parallel featurization
+    parser.add_argument('--partition_by', '-pb', default=config.FEATURE_PARTITION_BY,
+                            help = "If given, split the listings across processes by this column instead of by row ranges")
+
+    #vocabulary filepath
+    parser.add_argument('--vocab_path', '-vp', default=config.VOCAB_LOCATION,
+                            help = "If given, change filepath for the vocabulary of the categorical features")
+    #featurize with the saved vocabulary instead of rebuilding it
+    parser.add_argument('--reuse_vocab', '-rv', default=False, action='store_true',
+                            help = "If given, cast new features to the saved vocabulary instead of building a new one")
+
+    #rerun stages even if their inputs, config and code are unchanged
+    parser.add_argument('--force', '-F', default=False, action='store_true',
+                            help = "If given, rerun the clean and featurize stages even if their outputs are up to date")
 
     args = parser.parse_args()
 
@@ -42,6 +73,29 @@ if __name__ == '__main__':
                                      config.S3_BUCKET, config.S3_PATH_LOCATION, args.raw_path)
 
     if args.clean:
+        clean_fingerprint = stage_fingerprint("clean", [args.raw_path],
+                    {"LISTINGS_DATATYPES": config.LISTINGS_DATATYPES,
+                     "LISTINGS_DROP_COLS": config.LISTINGS_DROP_COLS,
+                     "VALID_ZIP": config.VALID_ZIP},
+                    source_files(clean_data, clean_data_chunked, write_table))
+
+    if args.clean and is_up_to_date(clean_fingerprint, [args.clean_path], args.force):
+        pass
+    elif args.clean and args.chunksize and artifact_format(args.clean_path) != "csv":
+        logger.error("Chunked cleaning streams to csv, please give a .csv --clean_path")
+    elif args.clean and args.chunksize:
+        try:
+            rows = clean_data_chunked(args.raw_path,
+                    args.clean_path,
+                    config.LISTINGS_DATATYPES,
+                    config.LISTINGS_DROP_COLS,
+                    config.VALID_ZIP,
+                    args.chunksize)
+            record_fingerprint(clean_fingerprint, [args.clean_path])
+            logger.info("File: {} created -- {} rows of raw data successfully cleaned".format(args.clean_path, rows))
+        except Exception:
+            logger.error("Something went wrong with clean_data_chunked function. Please check raw data and/or configs")
+    elif args.clean:
         try:
             clean_df = clean_data(args.raw_path, 
                     config.LISTINGS_DATATYPES, 
@@ -50,24 +104,66 @@ if __name__ == '__main__':
         except Exception:
             logger.error("Something went wrong with clean_data function. Please check raw data and/or configs")
         try:
-            clean_df.to_csv(args.clean_path, index=False)
+            write_table(clean_df, args.clean_path)
+            record_fingerprint(clean_fingerprint, [args.clean_path])
             logger.info("File: {} created -- raw data successfully cleaned".format(args.clean_path))
         except Exception:
-            logger.error("Failed to create clean.csv")
+            logger.error("Failed to create {}".format(args.clean_path))
             
     if args.featurize:
+        feature_config = {"HOST_FEATURES": config.HOST_FEATURES,
+                          "PROPERTY_FEATURES": config.PROPERTY_FEATURES,
+                          "BOOKING_FEATURES": config.BOOKING_FEATURES,
+                          "RESPONSE_VARIABLE": config.RESPONSE_VARIABLE,
+                          "BIN_SPECS": config.BIN_SPECS}
+        feature_inputs = [args.clean_path] + ([args.vocab_path] if args.reuse_vocab else [])
+        feature_outputs = [args.feature_path] + ([] if args.reuse_vocab else [args.vocab_path])
+        feature_outputs += [args.state_path] if args.incremental else []
+        feature_fingerprint = stage_fingerprint("featurize", feature_inputs,
+                    dict(feature_config, DATA_SCRAPE_DATE=config.DATA_SCRAPE_DATE),
+                    source_files(create_features, build_vocabulary, read_table, write_table))
+        #stored features are only reused with the same featurization config and code
+        state_version = stage_fingerprint("featurize_state", [], feature_config,
+                                          source_files(create_features))["fingerprint"]
+
+    if args.featurize and not is_up_to_date(feature_fingerprint, feature_outputs, args.force):
         try:
-            feature_df = create_features(args.clean_path,
-                        config.DATA_SCRAPE_DATE,
-                        config.HOST_FEATURES,
-                        config.PROPERTY_FEATURES,
-                        config.BOOKING_FEATURES,
-                        config.RESPONSE_VARIABLE)
+            if args.incremental:
+                state = pickle.load(open(args.state_path, "rb")) if os.path.exists(args.state_path) else None
+                feature_df, state = create_features_incremental(args.clean_path,
+                            state,
+                            state_version,
+                            config.DATA_SCRAPE_DATE,
+                            config.HOST_FEATURES,
+                            config.PROPERTY_FEATURES,
+                            config.BOOKING_FEATURES,
+                            config.RESPONSE_VARIABLE,
+                            config.BIN_SPECS,
+                            n_jobs=args.n_jobs,
+                            partition_by=args.partition_by)
+                pickle.dump(state, open(args.state_path, "wb"))
+            else:
+                feature_df = create_features(args.clean_path,
+                            config.DATA_SCRAPE_DATE,
+                            config.HOST_FEATURES,
+                            config.PROPERTY_FEATURES,
+                            config.BOOKING_FEATURES,
+                            config.RESPONSE_VARIABLE,
+                            config.BIN_SPECS,
+                            args.n_jobs,
+                            args.partition_by)
+            if args.reuse_vocab:
+                vocabulary = load_vocabulary(args.vocab_path)
+            else:
+                vocabulary = build_vocabulary(feature_df, CATEGORICAL_COLUMNS)
+                pickle.dump(vocabulary, open(args.vocab_path, "wb"))
+            feature_df = apply_vocabulary(feature_df, vocabulary)
         except Exception:
             logger.error("Something went wrong with create_features function. Please check cleaned data and/or configs")
 
         try:
-            feature_df.to_csv(args.feature_path, index=False)
+            write_table(feature_df, args.feature_path)
+            record_fingerprint(feature_fingerprint, feature_outputs)
             logger.info("File: {} created -- features successfully generated".format(args.feature_path))
         except Exception:
-            logger.error("Failed to create feature.csv")
+            logger.error("Failed to create {}".format(args.feature_path))
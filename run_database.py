@@ -1,70 +1,128 @@
 import os
 import sys
 from config.flaskconfig import SQLALCHEMY_DATABASE_URI
+from config import config
 import logging
 
 import sqlalchemy as sql
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base 
-from sqlalchemy import Column, Integer, String, MetaData, Float, Text
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, Enum, Index, MetaData, Float, Text
 
 import argparse
 
-# set up logging config
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
-logger = logging.getLogger(__file__)
-
-#argparse
-parser = argparse.ArgumentParser(description="Create defined tables in database, and select local or AWS database push")
-parser.add_argument("--truncate", "-t", default=False, action="store_true",
-                        help="If given, delete current records from abb_feat_and_resp table before create_all "
-                            "so that table can be recreated without unique id issues ")
+from src.db_load import bulk_load, truncate_table, rebuild_table
+from src.predict import map_bin
 
-args = parser.parse_args()
+logger = logging.getLogger(__file__)
 
 Base = declarative_base()  
 
+POPULARITY_LABELS = [map_bin(reviews_per_month_bin) for reviews_per_month_bin in range(5)]
+
 class Airbnb(Base):
     """Create a data model for the database to be set up for capturing features related to Airbnb listings in San Francisco """
     __tablename__ = 'abb_feat_and_resp'
+    # composite indexes for the dashboard filters and aggregates (by neighbourhood, room type,
+    # property type and popularity); the property type index also covers AVG(price). The (column, id)
+    # indexes serve the index page filters, which are keyset-paginated newest first on id
+    __table_args__ = (
+        Index("ix_abb_neighbourhood_room_bin", "neighbourhood_cleansed", "room_type", "reviews_per_month_bin"),
+        Index("ix_abb_room_bin", "room_type", "reviews_per_month_bin"),
+        Index("ix_abb_property_bin_price", "property_type_cat", "reviews_per_month_bin", "price"),
+        Index("ix_abb_bin_neighbourhood", "reviews_per_month_bin", "neighbourhood_cleansed"),
+        Index("ix_abb_neighbourhood_id", "neighbourhood_cleansed", "id"),
+        Index("ix_abb_room_id", "room_type", "id"),
+        Index("ix_abb_property_id", "property_type_cat", "id"),
+        Index("ix_abb_bin_id", "reviews_per_month_bin", "id"),
+    )
     id = Column(Integer, primary_key=True)
+    listing_id = Column(BigInteger, unique=True, nullable=True)
     years_as_host = Column(Float, unique=False, nullable=True)
-    host_response_time = Column(String(100), unique=False, nullable=True)
+    host_response_time = Column(String(32), unique=False, nullable=True)
     host_response_rate = Column(Float, unique=False, nullable=True)
-    host_is_superhost = Column(Integer, unique=False, nullable=True)
-    host_has_profile_pic = Column(Integer, unique=False, nullable=True)
-    host_identity_verified = Column(Integer, unique=False, nullable=True)
-    host_listings_count = Column(Integer, unique=False, nullable=True)
-    room_type = Column(String(100), unique=False, nullable=True)
-    property_type_cat = Column(String(100), unique=False, nullable=True)
-    accommodates_cat = Column(Integer, unique=False, nullable=True)
-    bathrooms_cat = Column(Integer, unique=False, nullable=True)
-    bedrooms_cat = Column(Integer, unique=False, nullable=True)
-    beds_cat = Column(Integer, unique=False, nullable=True)
-    guests_included_cat = Column(Integer, unique=False, nullable=True)
-    extra_people_cat = Column(Integer, unique=False, nullable=True)
+    host_is_superhost = Column(SmallInteger, unique=False, nullable=True)
+    host_has_profile_pic = Column(SmallInteger, unique=False, nullable=True)
+    host_identity_verified = Column(SmallInteger, unique=False, nullable=True)
+    host_listings_count = Column(SmallInteger, unique=False, nullable=True)
+    room_type = Column(String(32), unique=False, nullable=True)
+    property_type_cat = Column(String(32), unique=False, nullable=True)
+    accommodates_cat = Column(SmallInteger, unique=False, nullable=True)
+    bathrooms_cat = Column(SmallInteger, unique=False, nullable=True)
+    bedrooms_cat = Column(SmallInteger, unique=False, nullable=True)
+    beds_cat = Column(SmallInteger, unique=False, nullable=True)
+    guests_included_cat = Column(SmallInteger, unique=False, nullable=True)
+    extra_people_cat = Column(SmallInteger, unique=False, nullable=True)
     price = Column(Float, unique=False, nullable=True)
     security_deposit = Column(Float, unique=False, nullable=True)
     cleaning_fee = Column(Float, unique=False, nullable=True)
-    amenities_count = Column(Integer, unique=False, nullable=True)
-    neighbourhood_cleansed = Column(String(100), unique=False, nullable=True)
-    minimum_nights_cat = Column(Integer, unique=False, nullable=True)
-    maximum_nights_cat = Column(Integer, unique=False, nullable=True)
-    instant_bookable = Column(Integer, unique=False, nullable=True)
-    cancellation_policy = Column(String(100), unique=False, nullable=True)
-    require_guest_phone_verification = Column(Integer, unique=False, nullable=True)
-    require_guest_profile_picture = Column(Integer, unique=False, nullable=True)
-    reviews_per_month_bin = Column(String(100), unique=False, nullable=True)
+    amenities_count = Column(SmallInteger, unique=False, nullable=True)
+    neighbourhood_cleansed = Column(String(64), unique=False, nullable=True)
+    minimum_nights_cat = Column(SmallInteger, unique=False, nullable=True)
+    maximum_nights_cat = Column(SmallInteger, unique=False, nullable=True)
+    instant_bookable = Column(SmallInteger, unique=False, nullable=True)
+    cancellation_policy = Column(String(40), unique=False, nullable=True)
+    require_guest_phone_verification = Column(SmallInteger, unique=False, nullable=True)
+    require_guest_profile_picture = Column(SmallInteger, unique=False, nullable=True)
+    reviews_per_month_bin = Column(Enum(*POPULARITY_LABELS, name="reviews_per_month_bin_enum"), unique=False, nullable=True)
       
     def __repr__(self):
         return '<Airbnb %r>' % self.id
 
-def _truncate_abb(session):
-    """Deletes abb_feat_and_resp table if rerunning and run into unique key error."""
+# Longest value each sized string column accepts, checked before listings are scored and inserted
+STRING_LENGTHS = {col.name: col.type.length for col in Airbnb.__table__.columns
+                  if isinstance(col.type, String) and not isinstance(col.type, Enum)}
+
+def _truncate_abb(engine):
+    """Empties abb_feat_and_resp table if rerunning and run into unique key error."""
+
+    with engine.begin() as connection:
+        truncate_table(connection, Airbnb.__table__)
 
-    session.execute('''DELETE FROM abb_feat_and_resp''')
+def _migrate_abb(engine):
+    """Rebuilds an abb_feat_and_resp table created with an older schema (no listing_id or indexes, an INTEGER
+    listing_id, or other string column sizes, e.g. room_type and host_response_time as enums)."""
+
+    inspector = sql.inspect(engine)
+    if Airbnb.__tablename__ not in inspector.get_table_names():
+        return
+    existing = {index["name"] for index in inspector.get_indexes(Airbnb.__tablename__)}
+    types = {col["name"]: col["type"] for col in inspector.get_columns(Airbnb.__tablename__)}
+    resized = [col.name for col in Airbnb.__table__.columns if isinstance(col.type, String) and col.name in types
+               and getattr(types[col.name], "length", None) != col.type.length]
+    #InsideAirbnb listing ids no longer fit in 32 bits
+    widened = [col.name for col in Airbnb.__table__.columns if isinstance(col.type, BigInteger) and col.name in types
+               and not isinstance(types[col.name], BigInteger)]
+    if all(index.name in existing for index in Airbnb.__table__.indexes) and not resized and not widened:
+        return
+    logger.info("Migrating abb_feat_and_resp to the current schema")
+    rebuild_table(engine, Airbnb.__table__)
 
 if __name__ == '__main__':
+    # set up logging config
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+
+    #argparse
+    parser = argparse.ArgumentParser(description="Create defined tables in database, and select local or AWS database push")
+    parser.add_argument("--truncate", "-t", default=False, action="store_true",
+                            help="If given, delete current records from abb_feat_and_resp table before create_all "
+                                "so that table can be recreated without unique id issues ")
+    #bulk load listings
+    parser.add_argument("--load", "-l", nargs="?", const=config.IMPUTED_OUTPUT_LOCATION, default=None,
+                            help="If given, bulk load imputed or scored listings into abb_feat_and_resp "
+                                "(default file: imputed data)")
+    #rows per executemany batch
+    parser.add_argument("--batch_size", "-bs", default=config.DB_LOAD_BATCH_SIZE, type=int,
+                            help="If given, change the number of rows inserted per batch by --load")
+    #update rows that are already loaded
+    parser.add_argument("--upsert", "-u", default=False, action="store_true",
+                            help="If given, --load updates listings whose id is already in the table")
+    #replace the table contents
+    parser.add_argument("--replace", "-r", default=False, action="store_true",
+                            help="If given, --load replaces the contents of abb_feat_and_resp in one swap")
+
+    args = parser.parse_args()
+
     if os.environ.get('MYSQL_HOST') is None:
         logger.info("Airbnb Database location: Local")
     else:
@@ -73,21 +131,24 @@ if __name__ == '__main__':
     engine = sql.create_engine(SQLALCHEMY_DATABASE_URI)
 
     if args.truncate:
-        Session = sessionmaker(bind=engine)
-        session = Session()
         try:
             logger.info("Attempting to truncate abb_feat_and_resp table.")
-            _truncate_abb(session)
-            session.commit()
+            _truncate_abb(engine)
             logger.info("abb_feat_and_resp truncated.")
         except Exception as e:
             logger.error("Error occurred while attempting to truncate abb_feat_and_resp table.")
             logger.error(e)
-        finally:
-            session.close()
 
     # create the airbnb table
+    _migrate_abb(engine)
     Base.metadata.create_all(engine)
 
     logger.info("Airbnb Database created successfully!")
 
+    if args.load:
+        try:
+            bulk_load(engine, Airbnb.__table__, args.load, args.batch_size, args.upsert, args.replace)
+        except Exception:
+            logger.error("Failed to load {} into abb_feat_and_resp".format(args.load))
+            raise
+
@@ -5,8 +5,14 @@ import argparse
 import pickle
 
 from src.train import get_model_data
+from src.impute import fit_imputer
 from src.train import tune_and_score
+from src.train import write_scores
 from src.train import train_model
+from src.compiled_model import export_compiled_model
+from src.artifacts import read_table, write_table
+from src.predict import compile_feature_layout
+from src.stage_cache import stage_fingerprint, source_files, is_up_to_date, record_fingerprint
 
 # set up logging config
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
@@ -36,58 +42,128 @@ if __name__ == '__main__':
     #scoring metrics output filepath
     parser.add_argument('--scores_path', '-sp', default=config.SCORES_OUTPUT_LOCATION,
                             help = "If given, change filepath for scoring metrics")
+    #search results output filepath
+    parser.add_argument('--cv_results_path', '-crp', default=config.CV_RESULTS_LOCATION,
+                            help = "If given, change filepath for the cv_results_ of every search candidate")
+    #out-of-fold predictions output filepath
+    parser.add_argument('--oof_path', '-op', default=config.OOF_PREDICTIONS_LOCATION,
+                            help = "If given, change filepath for the best candidate's out-of-fold predictions, '' to skip them")
     #trained model output filepath
     parser.add_argument('--model_path', '-mp', default=config.SAVED_MODEL_LOCATION,
                             help = "If given, change filepath for scoring metrics")
+    #compiled model output filepath
+    parser.add_argument('--compiled_path', '-cp', default=config.COMPILED_MODEL_LOCATION,
+                            help = "If given, change filepath for the compiled (.npz) model")
     #encoder output filepath
     parser.add_argument('--encoder_path', '-ep', default=config.SAVED_ENCODER_LOCATION,
                             help = "If given, change filepath for scoring metrics")
+    #feature layout output filepath
+    parser.add_argument('--layout_path', '-lp', default=config.FEATURE_LAYOUT_LOCATION,
+                            help = "If given, change filepath for compiled feature layout")
+
+    #fitted imputer filepath
+    parser.add_argument('--imputer_path', '-imp', default=config.IMPUTER_LOCATION,
+                            help = "If given, change filepath for the fitted imputer")
+    #impute with the saved imputer instead of refitting
+    parser.add_argument('--reuse_imputer', '-ri', default=False, action='store_true',
+                            help = "If given, impute new features with the saved imputer instead of fitting a new one")
+    #vocabulary filepath
+    parser.add_argument('--vocab_path', '-vp', default=config.VOCAB_LOCATION,
+                            help = "If given, change filepath for the vocabulary of the categorical features")
+    #rerun stages even if their inputs, config and code are unchanged
+    parser.add_argument('--force', '-F', default=False, action='store_true',
+                            help = "If given, rerun the impute, tune and train stages even if their outputs are up to date")
 
     args = parser.parse_args()
 
+    #features built before the vocabulary existed are encoded by fitted encoders instead
+    vocab_path = args.vocab_path if os.path.exists(args.vocab_path) else None
+    if vocab_path is None:
+        logger.warning("Vocabulary %s not found, categorical features are encoded from the data", args.vocab_path)
+    vocab_inputs = [vocab_path] if vocab_path else []
+
     if args.impute:
+        impute_inputs = [args.feature_path] + ([args.imputer_path] if args.reuse_imputer else []) + vocab_inputs
+        impute_outputs = [args.imputed_path] + ([] if args.reuse_imputer else [args.imputer_path])
+        impute_fingerprint = stage_fingerprint("impute", impute_inputs,
+                    {"RANDOM_STATE": config.RANDOM_STATE,
+                     "IMPUTER_MAX_ITER": config.IMPUTER_MAX_ITER},
+                    source_files(get_model_data, fit_imputer, read_table, write_table))
+
+    if args.impute and not is_up_to_date(impute_fingerprint, impute_outputs, args.force):
         try:
-            imputed_df = get_model_data(args.feature_path, config.RANDOM_STATE)
+            imputed_df = get_model_data(args.feature_path, config.RANDOM_STATE, args.imputer_path,
+                                        not args.reuse_imputer, config.IMPUTER_MAX_ITER, vocab_path)
         except Exception:
             logger.error("Something went wrong imputing missing values.")
             raise
         try:
-            imputed_df.to_csv(args.imputed_path, index=False)
+            write_table(imputed_df, args.imputed_path)
+            record_fingerprint(impute_fingerprint, impute_outputs)
             logger.info("File: {} created -- imputed values successfully generated".format(args.imputed_path))
         except Exception:
-            logger.error("Failed to create imputed.csv")
+            logger.error("Failed to create {}".format(args.imputed_path))
             raise
 
     if args.tune_and_score:
+        tuning_grid = config.HIST_TUNING_GRID if config.MODEL_ENGINE == "hist" else config.TUNING_GRID
+        tune_fingerprint = stage_fingerprint("tune_and_score", [args.imputed_path] + vocab_inputs,
+                    {"RANDOM_STATE": config.RANDOM_STATE,
+                     "MODEL_ENGINE": config.MODEL_ENGINE,
+                     "SPARSE_DESIGN": config.SPARSE_DESIGN,
+                     "TUNING_GRID": tuning_grid,
+                     "NUM_ITERS": config.NUM_ITERS,
+                     "PARAM_SCORING": config.PARAM_SCORING,
+                     "GRID_REFIT": config.GRID_REFIT,
+                     "TEST_SIZE": config.TEST_SIZE,
+                     "SEARCH_MODE": config.SEARCH_MODE,
+                     "HALVING_RESOURCE": config.HALVING_RESOURCE,
+                     "HALVING_FACTOR": config.HALVING_FACTOR},
+                    source_files(tune_and_score, read_table, write_table))
+        #an empty --oof_path skips the out-of-fold predictions
+        oof_path = args.oof_path or None
+        tune_outputs = [args.scores_path, args.cv_results_path] + ([oof_path] if oof_path else [])
+
+    if args.tune_and_score and not is_up_to_date(tune_fingerprint, tune_outputs, args.force):
         #extract best hyperparameters and scores from test set
         try:
-            classifier, cv_auc, cv_acc, test_auc, test_acc = tune_and_score(args.imputed_path, config.RANDOM_STATE, config.TUNING_GRID,
-                            config.NUM_ITERS, config.N_JOBS, config.PARAM_SCORING, config.GRID_REFIT, config.TEST_SIZE)
+            classifier, cv_auc, cv_acc, test_auc, test_acc, timings = tune_and_score(args.imputed_path, config.RANDOM_STATE, tuning_grid,
+                            config.NUM_ITERS, config.N_JOBS, config.PARAM_SCORING, config.GRID_REFIT, config.TEST_SIZE,
+                            config.SEARCH_MODE, config.HALVING_RESOURCE, config.HALVING_FACTOR, config.MODEL_ENGINE,
+                            args.cv_results_path, oof_path, vocab_path, config.SPARSE_DESIGN)
         except Exception:
             logger.error("Something went wrong while tuning and scoring")
             raise
 
         try:
-            with open(args.scores_path, 'w') as f:
-                f.write("Best learning_rate: " + str(classifier.best_params_["learning_rate"]) + '\n')
-                f.write("Best n_estimators: " + str(classifier.best_params_["n_estimators"]) + '\n')
-                f.write("Best max_depth: " + str(classifier.best_params_["max_depth"]) + '\n')
-                f.write("Best subsample: " + str(classifier.best_params_["subsample"]) + '\n')
-                f.write("CV AUC: " + str(cv_auc) + "\n")
-                f.write("CV Accuracy: " + str(cv_acc) + "\n")
-                f.write("Test AUC: " + str(test_auc) + "\n")
-                f.write("Test Accuracy: " + str(test_acc) + "\n")
-                f.close()
+            write_scores(args.scores_path, classifier, tuning_grid, config.MODEL_ENGINE, config.SEARCH_MODE,
+                         cv_auc, cv_acc, test_auc, test_acc, timings)
+            record_fingerprint(tune_fingerprint, tune_outputs)
             logger.info("File: {} created -- hyperparameters and scoring metrics saved".format(args.scores_path))
         except Exception:
             logger.error("Failed to save hyperparameters and scoring metrics")
             raise
 
     if args.full_model:
+        model_outputs = [args.model_path, args.encoder_path, args.layout_path, args.compiled_path]
+        model_fingerprint = stage_fingerprint("full_model", [args.imputed_path] + vocab_inputs,
+                    {"RANDOM_STATE": config.RANDOM_STATE,
+                     "MODEL_ENGINE": config.MODEL_ENGINE,
+                     "SPARSE_DESIGN": config.SPARSE_DESIGN,
+                     "BEST_LR": config.BEST_LR,
+                     "BEST_NUM_EST": config.BEST_NUM_EST,
+                     "BEST_MAX_DEPTH": config.BEST_MAX_DEPTH,
+                     "BEST_SUBSAMPLE": config.BEST_SUBSAMPLE},
+                    source_files(train_model, read_table, compile_feature_layout, export_compiled_model))
+
+    if args.full_model and not is_up_to_date(model_fingerprint, model_outputs, args.force):
         try:
             trained_model = train_model(args.imputed_path, config.RANDOM_STATE, config.BEST_LR, config.BEST_NUM_EST,
-                                config.BEST_MAX_DEPTH, config.BEST_SUBSAMPLE, args.encoder_path)
+                                config.BEST_MAX_DEPTH, config.BEST_SUBSAMPLE, args.encoder_path,
+                                args.layout_path, config.MODEL_ENGINE, vocab_path, config.SPARSE_DESIGN)
             pickle.dump(trained_model, open(args.model_path, "wb"))
+            export_compiled_model(trained_model, args.compiled_path)
+            record_fingerprint(model_fingerprint, model_outputs)
             logger.info("Trained model successfully created")
         except Exception:
             logger.error("Trained model was not fit successfully")
@@ -1,5 +1,7 @@
 import os
-from src.ingestion import fetch_zipfile, gunzip, upload_file_s3
+import argparse
+import boto3
+from src.ingestion import fetch_zipfile, gunzip, upload_file_s3, read_manifest, ingest_manifest, stream_to_s3
 from config import config
 import logging
 
@@ -8,17 +10,62 @@ logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 logger = logging.getLogger(__file__)
 
 if __name__ == '__main__':
-    #download gzipped data from InsideAirbnb website
-    fetch_zipfile(config.SOURCE_DATA_URL)
+    parser = argparse.ArgumentParser(description="Ingest InsideAirbnb data into S3.")
 
-    #unzip gzipped file
-    gunzip(config.SOURCE_DATA_URL.split("/")[-1],config.AIRBNB_RAW_LOCATION)
+    #ingest every snapshot in a manifest instead of SOURCE_DATA_URL
+    parser.add_argument('--manifest', '-m', nargs='?', const=config.INGESTION_MANIFEST, default=None,
+                            help = "If given, ingest every url in the manifest (default: INGESTION_MANIFEST in config)")
+    #number of snapshots processed at once
+    parser.add_argument('--workers', '-w', default=config.INGESTION_WORKERS, type=int,
+                            help = "If given, change the number of snapshots ingested concurrently")
+    #attempts for each download and upload
+    parser.add_argument('--retries', '-r', default=config.INGESTION_RETRIES, type=int,
+                            help = "If given, change the number of attempts for each download and upload")
+    #local directory for manifest snapshots
+    parser.add_argument('--local_dir', '-ld', default=config.INGESTION_LOCAL_DIR,
+                            help = "If given, change the directory for downloaded manifest snapshots")
 
-    #upload file to S3
-    uploaded = upload_file_s3(config.AIRBNB_RAW_LOCATION, config.S3_BUCKET, os.environ.get('AWS_ACCESS_KEY_ID'),
-                                 os.environ.get('AWS_SECRET_ACCESS_KEY'), config.S3_PATH_LOCATION)
+    #keep an unzipped local copy of streamed manifest snapshots
+    parser.add_argument('--keep_local', '-k', default=False, action='store_true',
+                            help = "If given, also write each streamed manifest snapshot to --local_dir")
+    #download, unzip and upload through local files instead of streaming
+    parser.add_argument('--via_disk', '-vd', default=False, action='store_true',
+                            help = "If given, download, unzip and upload through local files instead of streaming")
 
-    if uploaded:
-        logger.info("File uploaded to S3 successfully.")
+    args = parser.parse_args()
+
+    session = boto3.Session(aws_access_key_id = os.environ.get('AWS_ACCESS_KEY_ID'),
+                            aws_secret_access_key = os.environ.get('AWS_SECRET_ACCESS_KEY'))
+
+    if args.manifest:
+        results = ingest_manifest(read_manifest(args.manifest), args.local_dir, config.S3_BUCKET,
+                                  config.INGESTION_S3_PREFIX, session.client('s3'), args.workers, args.retries,
+                                  stream=not args.via_disk, keep_local=args.keep_local,
+                                  part_size=config.INGESTION_PART_SIZE)
+        for result in results:
+            if not result["ok"]:
+                logger.error("Not ingested: {} ({})".format(result["url"], result["error"]))
+    elif not args.via_disk:
+        #stream the gzipped data into S3, keeping the unzipped copy locally
+        try:
+            stats = stream_to_s3(config.SOURCE_DATA_URL, config.S3_BUCKET, config.S3_PATH_LOCATION,
+                                 session.client('s3'), config.INGESTION_PART_SIZE,
+                                 config.AIRBNB_RAW_LOCATION, args.retries)
+            logger.info("File uploaded to S3 successfully in {} parts.".format(stats["parts"]))
+        except Exception as e:
+            logger.error("File upload to S3 was unsuccessful: {}".format(e))
     else:
-        logger.error("File upload to S3 was unsuccessful.")
+        #download gzipped data from InsideAirbnb website
+        fetch_zipfile(config.SOURCE_DATA_URL)
+
+        #unzip gzipped file
+        gunzip(config.SOURCE_DATA_URL.split("/")[-1],config.AIRBNB_RAW_LOCATION)
+
+        #upload file to S3
+        uploaded = upload_file_s3(config.AIRBNB_RAW_LOCATION, config.S3_BUCKET, os.environ.get('AWS_ACCESS_KEY_ID'),
+                                     os.environ.get('AWS_SECRET_ACCESS_KEY'), config.S3_PATH_LOCATION)
+
+        if uploaded:
+            logger.info("File uploaded to S3 successfully.")
+        else:
+            logger.error("File upload to S3 was unsuccessful.")
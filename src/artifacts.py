@@ -0,0 +1,90 @@
+import os
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FORMAT_EXTENSIONS = {
+    ".csv": "csv",
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "feather",
+}
+
+def artifact_format(filepath):
+    '''Infer the storage format of a pipeline dataset from its file extension
+
+    Args:
+        filepath (str): file path of the dataset
+
+    Returns:
+        fmt (str): one of "csv", "parquet" or "feather"
+    '''
+    ext = os.path.splitext(filepath)[1].lower()
+    try:
+        return FORMAT_EXTENSIONS[ext]
+    except KeyError:
+        raise ValueError("Unsupported artifact extension '{}' for {}, use one of {}".format(
+            ext, filepath, sorted(FORMAT_EXTENSIONS)))
+
+def read_table(filepath, **csv_kwargs):
+    '''Read a pipeline dataset (csv, Parquet or Feather/Arrow IPC)
+
+    Parquet and Feather files keep their dtypes and are memory-mapped rather than parsed.
+
+    Args:
+        filepath (str): file path of the dataset
+        csv_kwargs: extra keyword arguments for pd.read_csv
+
+    Returns:
+        df (dataframe object): the dataset
+    '''
+    fmt = artifact_format(filepath)
+    if fmt == "csv":
+        return pd.read_csv(filepath, **csv_kwargs)
+    if fmt == "parquet":
+        return pd.read_parquet(filepath, engine="pyarrow", memory_map=True)
+
+    from pyarrow import feather
+    return feather.read_table(filepath, memory_map=True).to_pandas()
+
+def write_table(df, filepath):
+    '''Write a pipeline dataset, choosing csv, Parquet or Feather/Arrow IPC from the file extension
+
+    Args:
+        df (dataframe object): the dataset
+        filepath (str): file path to write to
+
+    Returns:
+        None
+    '''
+    fmt = artifact_format(filepath)
+    if fmt == "csv":
+        df.to_csv(filepath, index=False)
+    elif fmt == "parquet":
+        df.to_parquet(filepath, engine="pyarrow", index=False)
+    else:
+        df.reset_index(drop=True).to_feather(filepath)
+
+def iter_table(filepath, chunksize):
+    '''Iterate over a pipeline dataset in chunks of rows
+
+    csv files are parsed chunk by chunk; Parquet and Feather files are memory-mapped and sliced.
+
+    Args:
+        filepath (str): file path of the dataset
+        chunksize (int): number of rows per chunk
+
+    Yields:
+        chunk (dataframe object): up to chunksize rows of the dataset
+    '''
+    if artifact_format(filepath) == "csv":
+        for chunk in pd.read_csv(filepath, chunksize=chunksize):
+            yield chunk
+        return
+
+    df = read_table(filepath)
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
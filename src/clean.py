@@ -3,9 +3,15 @@ import logging
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 logger = logging.getLogger(__name__)
 
+PRICE_COLUMNS = ["price", "weekly_price", "monthly_price", "security_deposit", "cleaning_fee", "extra_people"]
+CURRENCY_PATTERN = r"^\$?-?[0-9][0-9,]*(\.[0-9]*)?$"
+ZIPCODE_PATTERN = r"^[0-9]{5}$"
+
 def clean_data(raw_input_path, listing_types, dropped_cols, zipcodes):
     '''Clean raw data and return a dataframe of cleaned data
     
@@ -21,12 +27,50 @@ def clean_data(raw_input_path, listing_types, dropped_cols, zipcodes):
 
     df = pd.read_csv(raw_input_path, dtype=listing_types)
 
-    price_columns = ["price","weekly_price","monthly_price","security_deposit",
-                    "cleaning_fee","extra_people"]
-    
     #drop unused columns
     df = df.drop(columns=dropped_cols, axis=1)
-    
+
+    return clean_frame(df, zipcodes)
+
+def clean_data_chunked(raw_input_path, output_path, listing_types, dropped_cols, zipcodes, chunksize):
+    '''Clean raw data in fixed-size chunks and stream the result to a csv
+
+    Only the columns that are not dropped are read, so peak memory is bounded by
+    the chunk size rather than the size of the raw file.
+
+    Args:
+        raw_input_path (str): file path for raw input data downloaded from S3
+        output_path (str): file path for the cleaned output
+        listing_types (dict): a dictionary of listing types that need to be cast
+        dropped_cols (dict): a list of the columns that aren't needed
+        zipcodes (dict): a list of valid San Francisco zipcodes
+        chunksize (int): number of raw rows to read and clean at a time
+
+    Returns:
+        rows (int): number of cleaned rows written
+    '''
+    reader = pd.read_csv(raw_input_path, dtype=listing_types, chunksize=chunksize,
+                         usecols=lambda col: col not in dropped_cols)
+
+    rows = 0
+    for i, chunk in enumerate(reader):
+        chunk = clean_frame(chunk, zipcodes)
+        chunk.to_csv(output_path, mode="w" if i == 0 else "a", header=(i == 0), index=False)
+        rows += len(chunk)
+        logger.debug("Chunk %d cleaned, %d rows written so far", i, rows)
+
+    return rows
+
+def clean_frame(df, zipcodes):
+    '''Apply the row filters and column cleaning to raw listings
+
+    Args:
+        df (dataframe object): raw listings without the unused columns
+        zipcodes (dict): a list of valid San Francisco zipcodes
+
+    Returns:
+        df (dataframe object): cleaned dataframe
+    '''
     #drop observations that have no relevant host info
     df = df.dropna(subset=["host_since",
                           "host_response_rate",
@@ -35,17 +79,11 @@ def clean_data(raw_input_path, listing_types, dropped_cols, zipcodes):
                     how="all")
     
     #extract zipcode and set invalid zipcodes as NaN
-    try:
-        df = clean_zips(df, zipcodes)
-    except Exception as e:
-        logger.error(e)
+    df = clean_zips(df, zipcodes)
 
     #clean columns related to pricing metrics
-    for col in price_columns:
-        try:
-            df = clean_pricing(df, col)
-        except Exception as e:
-            logger.error(e)
+    for col in PRICE_COLUMNS:
+        df = clean_pricing(df, col)
 
     #drop reviews_per_month that are na
     df = df.dropna(subset=["reviews_per_month"])
@@ -53,18 +91,16 @@ def clean_data(raw_input_path, listing_types, dropped_cols, zipcodes):
     return df
 
 def clean_zips(df, zipcodes):
-    '''Clean zipcodes in rawdata
+    '''Clean zipcodes in rawdata into integer zipcodes, <NA> if missing, not in zipcodes or malformed
     
     Args:
         df (dataframe object)): dataframe to be cleaned
         zipcodes (dict): a list of valid San Francisco zipcodes
 
     Returns:
-        df (dataframe object): cleaned dataframe
+        df (dataframe object): cleaned dataframe, zipcode as a nullable Int64 column
     '''
-    df.zipcode = df.zipcode.str.replace("CA ","")
-    df.zipcode = df.zipcode.replace("CA", np.nan)
-    df.loc[~df.zipcode.isin(zipcodes), "zipcode"] = np.nan
+    df["zipcode"] = parse_zipcodes(df["zipcode"], zipcodes)
 
     return df
 
@@ -78,6 +114,65 @@ def clean_pricing(df,col_name):
     Returns:
         df (dataframe object): cleaned dataframe
     '''
-    df[col_name] = df[col_name].str.replace(",","").str[1:].astype(float)
+    df[col_name] = parse_currency(df[col_name], col_name)
 
     return df
+
+def parse_currency(values, name="values"):
+    '''Parse currency strings ("$1,200.00") into floats in one pass of Arrow compute kernels
+
+    Values that are already numeric are returned as floats. Malformed strings become NaN and are
+    counted in a warning instead of failing the whole column.
+
+    Args:
+        values (Series): currency strings, missing values as NaN/None
+        name (str): column name used in the warning
+
+    Returns:
+        parsed (Series): float64 values with the index of values
+    '''
+    if values.dtype.kind in "iuf":
+        return values.astype(np.float64)
+
+    strings = pa.array(values, type=pa.string(), from_pandas=True)
+    digits = pc.ascii_ltrim(pc.replace_substring(strings, ",", ""), "$")
+    try:
+        parsed = pc.cast(digits, pa.float64())
+    except pa.ArrowInvalid:
+        valid = pc.match_substring_regex(strings, CURRENCY_PATTERN)
+        _log_malformed(strings, valid, name)
+        parsed = pc.cast(pc.if_else(valid, digits, None), pa.float64())
+
+    return pd.Series(parsed.to_numpy(zero_copy_only=False), index=values.index, name=values.name)
+
+def parse_zipcodes(values, zipcodes, name="zipcode"):
+    '''Parse zipcode strings ("94110" or "CA 94110") into integer zipcodes in one pass of Arrow compute kernels
+
+    Zipcodes that are not in zipcodes (including a bare "CA") become <NA>. Strings that are not a
+    5-digit zipcode at all are also counted in a warning.
+
+    Args:
+        values (Series): zipcode strings, missing values as NaN/None
+        zipcodes (dict): a list of valid zipcodes, as strings
+        name (str): column name used in the warning
+
+    Returns:
+        parsed (Series): nullable Int64 zipcodes with the index of values
+    '''
+    strings = pa.array(values.astype(object), type=pa.string(), from_pandas=True)
+    stripped = pc.replace_substring_regex(strings, "^CA ", "", max_replacements=1)
+    _log_malformed(strings, pc.or_(pc.match_substring_regex(stripped, ZIPCODE_PATTERN), pc.equal(strings, "CA")), name)
+
+    known = pc.is_in(stripped, value_set=pa.array(sorted(zipcodes), type=pa.string()))
+    parsed = pc.cast(pc.if_else(known, stripped, None), pa.int64())
+    mask = pc.is_null(parsed).to_numpy(zero_copy_only=False)
+    data = pc.fill_null(parsed, 0).to_numpy(zero_copy_only=False)
+
+    return pd.Series(pd.arrays.IntegerArray(data, mask), index=values.index, name=values.name)
+
+def _log_malformed(strings, valid, name):
+    '''Warn about the non-missing strings that failed validation, with a few examples'''
+    malformed = pc.filter(strings, pc.invert(pc.fill_null(valid, True)))
+    if len(malformed):
+        logger.warning("%d malformed %s values set to NaN, e.g. %s", len(malformed), name,
+                       malformed.slice(0, 3).to_pylist())
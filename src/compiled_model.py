@@ -0,0 +1,298 @@
+import logging
+
+import numpy as np
+from scipy.special import expit, softmax
+
+logger = logging.getLogger(__name__)
+
+#HistGradientBoostingClassifier supports at most 255 categories (plus missing) per feature
+_N_CATEGORIES = 256
+
+def export_compiled_model(trained_model, filepath):
+    '''Flatten every tree of a fitted gradient boosting model into contiguous arrays saved as .npz
+
+    Node arrays of all trees are concatenated (stage-major, then class) and child pointers are
+    global indices. Leaves point to themselves so that a fixed number of steps can be taken for
+    every tree. Leaf values are pre-multiplied by the learning rate.
+
+    Both GradientBoostingClassifier and HistGradientBoostingClassifier are supported. For the
+    latter, native categorical splits are kept as a category -> go-left table (cat_left) indexed
+    per split node (cat_row, -1 for numeric splits), and inputs are compared in float64. Missing
+    (NaN) inputs follow each split's missing_go_to_left, as in sklearn.
+
+    Args:
+        trained_model (GradientBoostingClassifier or HistGradientBoostingClassifier): fitted model from train_model
+        filepath (str): file path to save the compiled model (.npz)
+
+    Returns:
+        None
+    '''
+    n_features = getattr(trained_model, "n_features_in_", None) or trained_model.n_features_
+    if hasattr(trained_model, "_predictors"):
+        trees, init_raw = _hist_trees(trained_model)
+        n_stages = len(trained_model._predictors)
+        float64_inputs = True
+    else:
+        trees, init_raw = _gbt_trees(trained_model, n_features)
+        n_stages = trained_model.estimators_.shape[0]
+        float64_inputs = False
+
+    features, thresholds, lefts, rights, values, cat_rows, cat_lefts, roots = [], [], [], [], [], [], [], []
+    missing_lefts = []
+    max_depth = 0
+    offset = 0
+    n_cat_rows = 0
+    for tree in trees:
+        node_ids = np.arange(len(tree["feature"]))
+        is_leaf = tree["is_leaf"]
+
+        features.append(np.where(is_leaf, 0, tree["feature"]))
+        thresholds.append(np.where(is_leaf, np.inf, tree["threshold"]))
+        lefts.append(np.where(is_leaf, node_ids, tree["left"]) + offset)
+        rights.append(np.where(is_leaf, node_ids, tree["right"]) + offset)
+        values.append(tree["value"])
+        cat_rows.append(np.where(tree["cat_row"] >= 0, tree["cat_row"] + n_cat_rows, -1))
+        cat_lefts.append(tree["cat_left"])
+        missing_lefts.append(tree["missing_left"] & ~is_leaf)
+        roots.append(offset)
+
+        max_depth = max(max_depth, tree["max_depth"])
+        offset += len(node_ids)
+        n_cat_rows += len(tree["cat_left"])
+
+    np.savez_compressed(
+        filepath,
+        feature=np.concatenate(features).astype(np.int32),
+        threshold=np.concatenate(thresholds).astype(np.float64),
+        left=np.concatenate(lefts).astype(np.int32),
+        right=np.concatenate(rights).astype(np.int32),
+        value=np.concatenate(values).astype(np.float64),
+        cat_row=np.concatenate(cat_rows).astype(np.int32),
+        cat_left=np.concatenate(cat_lefts).astype(bool),
+        missing_left=np.concatenate(missing_lefts).astype(bool),
+        root=np.asarray(roots, dtype=np.int32),
+        init_raw=init_raw.astype(np.float64),
+        classes=trained_model.classes_,
+        n_stages=n_stages,
+        n_features=n_features,
+        max_depth=max_depth,
+        float64_inputs=float64_inputs,
+    )
+    logger.info("Compiled %d trees (%d nodes) into %s", len(roots), offset, filepath)
+
+def _gbt_trees(trained_model, n_features):
+    '''Node arrays of every tree of a GradientBoostingClassifier and its class priors'''
+    trees = []
+    for stage in trained_model.estimators_:
+        for estimator in stage:
+            tree = estimator.tree_
+            trees.append({
+                "feature": tree.feature,
+                "threshold": tree.threshold,
+                "left": tree.children_left,
+                "right": tree.children_right,
+                "is_leaf": tree.children_left == -1,
+                "value": tree.value[:, 0, 0] * trained_model.learning_rate,
+                "cat_row": np.full(tree.node_count, -1),
+                "cat_left": np.zeros((0, _N_CATEGORIES), dtype=bool),
+                #trees without missing value support (sklearn < 1.3) send NaN right
+                "missing_left": getattr(tree, "missing_go_to_left", np.zeros(tree.node_count)).astype(bool),
+                "max_depth": tree.max_depth,
+            })
+
+    #raw prediction of the init estimator (class priors), identical for every row
+    init_raw = trained_model._raw_predict_init(np.zeros((1, n_features), dtype=np.float32))[0]
+    return trees, init_raw
+
+def _hist_trees(trained_model):
+    '''Node arrays of every tree of a HistGradientBoostingClassifier and its baseline prediction'''
+    trees = []
+    for stage in trained_model._predictors:
+        for predictor in stage:
+            nodes = predictor.nodes
+            is_categorical = nodes["is_categorical"].astype(bool) & ~nodes["is_leaf"].astype(bool)
+            #category c goes left when bit c of the split's bitset is set
+            bitsets = predictor.raw_left_cat_bitsets.astype(np.uint32)
+            cat_left = ((bitsets[:, :, None] >> np.arange(32, dtype=np.uint32)) & 1).reshape(len(bitsets), _N_CATEGORIES)
+            trees.append({
+                "feature": nodes["feature_idx"],
+                "threshold": nodes["num_threshold"],
+                "left": nodes["left"],
+                "right": nodes["right"],
+                "is_leaf": nodes["is_leaf"].astype(bool),
+                #leaf values already include the learning rate
+                "value": nodes["value"],
+                "cat_row": np.where(is_categorical, nodes["bitset_idx"].astype(np.int64), -1),
+                "cat_left": cat_left.astype(bool),
+                "missing_left": nodes["missing_go_to_left"].astype(bool),
+                "max_depth": int(nodes["depth"].max()),
+            })
+
+    return trees, np.asarray(trained_model._baseline_prediction).ravel()
+
+def load_compiled_model(filepath):
+    '''Load a compiled model saved by export_compiled_model
+
+    Args:
+        filepath (str): file path of the compiled model (.npz)
+
+    Returns:
+        model (CompiledGradientBoosting): model with predict_proba and predict
+    '''
+    with np.load(filepath, allow_pickle=False) as arrays:
+        return CompiledGradientBoosting({name: arrays[name] for name in arrays.files})
+
+class CompiledGradientBoosting:
+    '''Vectorized evaluator for a flattened GradientBoostingClassifier or HistGradientBoostingClassifier
+
+    Walks every tree for a block of rows at once, one tree level per step, and mirrors the
+    sklearn interface used for scoring (classes_, predict_proba, predict). Shallow models are
+    re-laid out as perfect binary trees on load so that children are found arithmetically.
+    '''
+
+    def __init__(self, arrays, block_size=32, max_perfect_depth=12):
+        self.classes_ = arrays["classes"]
+        self.init_raw = arrays["init_raw"]
+        self.n_stages = int(arrays["n_stages"])
+        self.n_features = int(arrays["n_features"])
+        self.max_depth = int(arrays["max_depth"])
+        self.block_size = block_size
+
+        #GradientBoostingClassifier trees are fit on float32 inputs, HistGradientBoostingClassifier on float64
+        self.dtype = np.float64 if bool(arrays.get("float64_inputs", False)) else np.float32
+
+        self.feature = arrays["feature"]
+        self.threshold = arrays["threshold"] if self.dtype == np.float64 else _float32_floor(arrays["threshold"])
+        self.left = arrays["left"]
+        self.right = arrays["right"]
+        self.value = arrays["value"]
+        self.root = arrays["root"]
+        #native categorical splits (hist engine): cat_left[cat_row[node], category] is True to go left
+        self.cat_row = arrays.get("cat_row", np.full(len(self.feature), -1, dtype=np.int32))
+        self.cat_left = arrays.get("cat_left", np.zeros((0, _N_CATEGORIES), dtype=bool))
+        self.categorical = len(self.cat_left) > 0
+        #missing (NaN) inputs go left where missing_left is set and right otherwise
+        self.missing_left = arrays.get("missing_left", np.zeros(len(self.feature), dtype=bool))
+
+        self.perfect = self.max_depth <= max_perfect_depth
+        if self.perfect:
+            self._build_perfect_layout()
+
+    def _build_perfect_layout(self):
+        '''Pad every tree to a perfect tree of depth max_depth (node i has children 2i+1, 2i+2)'''
+        n_trees = len(self.root)
+        n_internal = 2 ** self.max_depth - 1
+
+        feature = np.empty((n_trees, n_internal), dtype=np.int32)
+        threshold = np.empty((n_trees, n_internal), dtype=self.dtype)
+        cat_row = np.empty((n_trees, n_internal), dtype=np.int32)
+        missing_left = np.empty((n_trees, n_internal), dtype=bool)
+        nodes = self.root[:, None]
+        for depth in range(self.max_depth):
+            level = slice(2 ** depth - 1, 2 ** (depth + 1) - 1)
+            feature[:, level] = self.feature[nodes]
+            threshold[:, level] = self.threshold[nodes]
+            cat_row[:, level] = self.cat_row[nodes]
+            missing_left[:, level] = self.missing_left[nodes]
+            #leaves point to themselves, so they are copied down both branches
+            nodes = np.stack([self.left[nodes], self.right[nodes]], axis=2).reshape(n_trees, -1)
+
+        tree_start = np.arange(n_trees, dtype=np.int32) * n_internal
+        self.p_feature = feature.ravel()
+        self.p_threshold = threshold.ravel()
+        self.p_cat_row = cat_row.ravel()
+        self.p_missing_left = missing_left.ravel()
+        self.p_value = self.value[nodes].ravel()
+        self.p_root = tree_start
+        #global child index = 2 * node + 1 - tree_start (+1 when going right)
+        self.p_child_offset = (2 - tree_start).astype(np.int32)
+        self.p_leaf_offset = (np.arange(n_trees, dtype=np.int64) * (n_internal + 1)
+                              - tree_start - n_internal)
+
+    def raw_predict(self, X):
+        '''Sum of the tree outputs (and class priors) for each row
+
+        Args:
+            X (array): predictors of shape (n_rows, n_features)
+
+        Returns:
+            raw (array): raw scores of shape (n_rows, n_trees_per_stage)
+        '''
+        #compare with the same precision sklearn does
+        X = np.ascontiguousarray(X, dtype=self.dtype)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError("Expected {} features, got array of shape {}".format(self.n_features, X.shape))
+
+        n_rows = X.shape[0]
+        n_trees_per_stage = len(self.init_raw)
+        raw = np.empty((n_rows, n_trees_per_stage), dtype=np.float64)
+        walk = self._walk_perfect if self.perfect else self._walk
+
+        for start in range(0, n_rows, self.block_size):
+            block = X[start:start + self.block_size]
+            n_block = block.shape[0]
+            row_offsets = (np.arange(n_block, dtype=np.int32) * self.n_features)[:, None]
+
+            leaf_values = walk(block.ravel(), row_offsets).reshape(n_block, self.n_stages, n_trees_per_stage)
+            raw[start:start + n_block] = self.init_raw + leaf_values.sum(axis=1)
+
+        return raw
+
+    def _walk_perfect(self, flat_block, row_offsets):
+        '''Leaf value of every tree for a block of rows, using the perfect tree layout'''
+        nodes = np.broadcast_to(self.p_root, (row_offsets.shape[0], len(self.p_root)))
+        for _ in range(self.max_depth):
+            feature = np.take(self.p_feature, nodes)
+            feature += row_offsets
+            x = np.take(flat_block, feature)
+            go_left = x <= np.take(self.p_threshold, nodes)
+            if self.categorical:
+                self._categorical_splits(go_left, x, np.take(self.p_cat_row, nodes))
+            self._missing_splits(go_left, x, self.p_missing_left, nodes)
+            nodes = 2 * nodes + self.p_child_offset
+            nodes -= go_left
+        return np.take(self.p_value, nodes + self.p_leaf_offset)
+
+    def _walk(self, flat_block, row_offsets):
+        '''Leaf value of every tree for a block of rows, following child pointers'''
+        nodes = np.broadcast_to(self.root, (row_offsets.shape[0], len(self.root)))
+        for _ in range(self.max_depth):
+            x = flat_block[row_offsets + self.feature[nodes]]
+            go_left = x <= self.threshold[nodes]
+            if self.categorical:
+                self._categorical_splits(go_left, x, self.cat_row[nodes])
+            self._missing_splits(go_left, x, self.missing_left, nodes)
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.value[nodes]
+
+    def _categorical_splits(self, go_left, x, cat_row):
+        '''Overwrite go_left in place for the nodes that split on a category (cat_row >= 0)'''
+        is_categorical = cat_row >= 0
+        if is_categorical.any():
+            categories = np.clip(np.nan_to_num(x[is_categorical]), 0, _N_CATEGORIES - 1).astype(np.intp)
+            go_left[is_categorical] = self.cat_left[cat_row[is_categorical], categories]
+
+    def _missing_splits(self, go_left, x, missing_left, nodes):
+        '''Overwrite go_left in place for missing (NaN) inputs with the nodes' missing_go_to_left'''
+        missing = np.isnan(x)
+        if missing.any():
+            go_left[missing] = np.take(missing_left, nodes[missing])
+
+    def predict_proba(self, X):
+        '''Class probabilities, columns ordered as classes_'''
+        raw = self.raw_predict(X)
+        if raw.shape[1] == 1:
+            proba = expit(raw[:, 0])
+            return np.column_stack([1 - proba, proba])
+        return softmax(raw, axis=1)
+
+    def predict(self, X):
+        '''Most likely class of each row'''
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+def _float32_floor(threshold):
+    '''Largest float32 <= each threshold, so float32 x <= t gives the same answer in float32'''
+    threshold32 = threshold.astype(np.float32)
+    too_big = threshold32.astype(np.float64) > threshold
+    threshold32[too_big] = np.nextafter(threshold32[too_big], np.float32(-np.inf))
+    return threshold32
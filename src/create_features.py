@@ -1,20 +1,32 @@
 import os
 import logging
+import functools
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 import datetime
 from datetime import date, timedelta
 
+from src.artifacts import read_table
+
 pd.options.mode.chained_assignment = None
 logger = logging.getLogger(__name__)
 
+#clean columns that derived features are built from; binned features read their BIN_SPECS columns
+DERIVED_FEATURE_SOURCES = {
+    "years_as_host": ["host_since"],
+    "property_type_cat": ["property_type"],
+    "amenities_count": ["amenities"],
+}
+
 #Function to create response variable
-def create_response_variable(df):
+def create_response_variable(df, bin_specs):
     """A function to create the response variable, a bin of reviews per month
     
     Args:
         df (dataframe object)): dataframe
+        bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
 
     Returns:
         df (dataframe object): dataframe with response variable 'reviews_per_month_bin'
@@ -27,18 +39,10 @@ def create_response_variable(df):
         logger.error(e)
 
     try:
-        #bin 0
-        df.loc[:,"reviews_per_month_bin"] = 0
-        #bin 1
-        df.loc[(df.reviews_per_month > 0) & (df.reviews_per_month <= 0.35), "reviews_per_month_bin"] = 1
-        #bin 2
-        df.loc[(df.reviews_per_month > 0.35) & (df.reviews_per_month <= 1.1), "reviews_per_month_bin"] = 2
-        #bin 3
-        df.loc[(df.reviews_per_month > 1.1) & (df.reviews_per_month <= 2.9), "reviews_per_month_bin"] = 3
-        #bin 4
-        df.loc[(df.reviews_per_month > 2.9), "reviews_per_month_bin"] = 4
+        df = apply_bin_spec(df, "reviews_per_month_bin", bin_specs["reviews_per_month_bin"])
     except Exception as e:
         logger.error(e)
+        df.loc[:,"reviews_per_month_bin"] = 0
     
     return df
 
@@ -75,10 +79,11 @@ def create_host_features(df, scrape_date):
     return df
 
 #Function to create features related to the property
-def create_property_features(df):
+def create_property_features(df, bin_specs):
     '''A function to create features related to the airbnb property listing
     Args:
         df (dataframe object)
+        bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
     Returns:
         dataframe with response variables related to the host
     '''
@@ -91,54 +96,13 @@ def create_property_features(df):
     except Exception as e:
         logger.error(e)
     
-    #create bins for accomodates column
-    try:
-        df.loc[:,"accommodates_cat"] = df["accommodates"]
-        df.loc[df["accommodates"] <= 2, "accommodates_cat"] = 1
-        df.loc[(df["accommodates"] > 2) & (df["accommodates"] <= 4), "accommodates_cat"] = 2
-        df.loc[(df["accommodates"] > 4) & (df["accommodates"] <= 6), "accommodates_cat"] = 3
-        df.loc[(df["accommodates"] > 6), "accommodates_cat"] = 4
-    except Exception as e:
-        logger.error(e)
-    
-    #create bins for the # of bathrooms
-    try:
-        df.loc[:,"bathrooms_cat"] = df["bathrooms"]
-        df.loc[(df["bathrooms"] < 2) | (df["bathrooms"].isna()), "bathrooms_cat"] = 1 #if less than 2 or isna
-        df.loc[(df["bathrooms"] >= 2) & (df["bathrooms"] < 3), "bathrooms_cat"] = 2
-        df.loc[df["bathrooms"] >= 3, "bathrooms_cat"] = 3
-    except Exception as e:
-        logger.error(e)
-    
-    #create bins for # of bedrooms
-    try:
-        df.loc[:,"bedrooms_cat"] = df["bedrooms"]
-        df.loc[df["bedrooms"].isna(),"bedrooms_cat"] = np.minimum(df["beds"],3) #impute bedrooms based on # of beds
-        df.loc[df["bedrooms"] >= 3, "bedrooms_cat"] = 3
-    except Exception as e:
-        logger.error(e)
-    
-    #create bins for # of beds--the number of beds is at a minimum, the number of bedrooms
-    try:
-        df.loc[:,"beds_cat"] = df["beds"]
-        df.loc[(df["beds"].isna()) | (df["beds"] == 0), "beds_cat"] = np.maximum(df["bedrooms"], 1)
-        df.loc[df["beds"] >= 5, "beds_cat"] = 5
-    except Exception as e:
-        logger.error(e)
-    
-    #create bins for guests included, those >3 are lumped together
-    try:
-        df.loc[:,"guests_included_cat"] = df["guests_included"]
-        df.loc[df["guests_included"] >= 3, "guests_included_cat"] = 3
-    except Exception as e:
-        logger.error(e)
-    
-    #turn extra_people into a binary variable. If price >0, then 1
-    try:
-        df.loc[:,"extra_people_cat"] = df["extra_people"]
-        df.loc[df["extra_people"] > 0, "extra_people_cat"] = 1
-    except Exception as e:
-        logger.error(e)
+    #create bins for accommodates, bathrooms, bedrooms, beds, guests included and extra_people
+    for col in ["accommodates_cat", "bathrooms_cat", "bedrooms_cat", "beds_cat",
+                "guests_included_cat", "extra_people_cat"]:
+        try:
+            df = apply_bin_spec(df, col, bin_specs[col])
+        except Exception as e:
+            logger.error(e)
     
     #count the number of amenities, instead of having as text
     try:
@@ -148,11 +112,12 @@ def create_property_features(df):
     
     return df
 
-def create_booking_features(df):
+def create_booking_features(df, bin_specs):
     """A function to create features related to booking
     
     Args:
         df (dataframe object)): dataframe
+        bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
 
     Returns:
         df (dataframe object): dataframe with response variables related to the booking properties
@@ -160,22 +125,16 @@ def create_booking_features(df):
 
     bool_cols = ["instant_bookable","require_guest_phone_verification","require_guest_profile_picture"]
 
-    #create bins for minimum nights
+    #create bins for minimum nights: a week or less, btw. week & month, greater than a month
     try:
-        df.loc[:,"minimum_nights_cat"] = df["minimum_nights"]
-        df.loc[df["minimum_nights"] <= 7, "minimum_nights_cat"] = 1 #if a week or less, group 1
-        df.loc[(df["minimum_nights"] > 7) & (df["minimum_nights"] <= 30), "minimum_nights_cat"] = 2 #if btw. week & month
-        df.loc[df["minimum_nights"] > 30, "minimum_nights_cat"] = 3 #greater than a month, 
+        df = apply_bin_spec(df, "minimum_nights_cat", bin_specs["minimum_nights_cat"])
     except Exception as e:
         logger.error(e)
     
-    #create bins for maximum nights
+    #create bins for maximum nights: a month or less, btw. month & year, greater than a year
     try:
         df["maximum_nights"] = df["maximum_nights"].astype(int)
-        df.loc[:,"maximum_nights_cat"] = df["maximum_nights"]
-        df.loc[df["maximum_nights"] <= 30, "maximum_nights_cat"] = 1 #if max is a month or less
-        df.loc[(df["maximum_nights"] > 30) & (df["maximum_nights"] <= 365), "maximum_nights_cat"] = 2 #btw. month & year
-        df.loc[df["maximum_nights"] > 365, "maximum_nights_cat"] = 3
+        df = apply_bin_spec(df, "maximum_nights_cat", bin_specs["maximum_nights_cat"])
     except Exception as e:
         logger.error(e)
     
@@ -195,10 +154,12 @@ def create_booking_features(df):
     
     return df
 
-def clean_data_types(df):
-    """Clean up datatypes of final dataset
+def clean_data_types(df, categorical_columns=("host_response_time", "room_type", "property_type_cat",
+                                                 "neighbourhood_cleansed", "cancellation_policy")):
+    """Clean up datatypes of final dataset, string features become categoricals
     Args:
         df (dataframe object)): dataframe
+        categorical_columns (list): string features
     Returns: 
         df (dataframe object): final dataframe with clean types
     """
@@ -206,19 +167,98 @@ def clean_data_types(df):
     df["host_has_profile_pic"] = df["host_has_profile_pic"].astype(int)
     df["host_identity_verified"] = df["host_identity_verified"].astype(int)
     df["host_listings_count"] = df["host_listings_count"].astype(int)
-    df["room_type"] = df["room_type"].astype(str)
-    df["property_type_cat"] = df["property_type_cat"].astype(str)
     df["bathrooms_cat"] = df["bathrooms_cat"].astype(int)
     df["bedrooms_cat"] = df["bedrooms_cat"].astype(int)
     df["beds_cat"] = df["beds_cat"].astype(int)
     df["extra_people_cat"] = df["extra_people_cat"].astype(int)
     df["instant_bookable"] = df["instant_bookable"].astype(int)
-    df["cancellation_policy"] = df["cancellation_policy"].astype(str)
     df["require_guest_phone_verification"] = df["require_guest_phone_verification"].astype(int)
     df["require_guest_profile_picture"] = df["require_guest_profile_picture"].astype(int)
+    for col in categorical_columns:
+        df[col] = df[col].astype("category")
+    
+    return df
+
+def bin_values(values, spec, fill_values=None):
+    """Bucket a numeric array in one pass with a bin specification (see BIN_SPECS in config)
     
+    Args:
+        values (array-like): numeric values of spec["column"]
+        spec (dict): edges/labels/right or clip, plus optional missing, fill, fill_from and fill_clip
+        fill_values (array-like): values of spec["fill_from"], required when the spec has fill_from
+
+    Returns:
+        binned (array): int64 when the labels (or clipped values) and fills are whole numbers, otherwise
+            float64 with NaN for missing rows that have no fill
+    """
+    x = np.asarray(values)
+    if x.dtype.kind not in "biuf":
+        raise TypeError("Cannot bin non-numeric values of {} (dtype {})".format(spec["column"], x.dtype))
+
+    if "edges" in spec:
+        labels = np.asarray(spec["labels"])
+        if len(labels) != len(spec["edges"]) + 1:
+            raise ValueError("{} needs {} labels for {} edges".format(spec["column"], len(spec["edges"]) + 1,
+                                                                     len(spec["edges"])))
+        index = _bucket_index(x, spec["edges"], spec.get("right", False))
+        if np.array_equal(labels, labels[0] + np.arange(len(labels))):
+            binned = index.astype(labels.dtype) + labels[0]
+        else:
+            binned = labels.take(index)
+    else:
+        binned = _clip(x, spec.get("clip"))
+
+    missing = np.isnan(x) if x.dtype.kind == "f" else np.zeros(len(x), dtype=bool)
+    for value in spec.get("missing", []):
+        missing |= x == value
+
+    if missing.any():
+        if "fill" in spec:
+            fill = np.float64(spec["fill"])
+        elif "fill_from" in spec:
+            fill = _clip(np.asarray(fill_values, dtype=np.float64)[missing], spec.get("fill_clip", spec.get("clip")))
+        else:
+            fill = np.float64(np.nan)
+        if binned.dtype.kind == "f" or not np.array_equal(fill, np.floor(fill)):
+            binned = binned.astype(np.float64)
+        binned[missing] = fill
+
+    return binned.astype(np.int64, copy=False) if binned.dtype.kind in "biu" else binned
+
+def apply_bin_spec(df, col_name, spec):
+    """Add a binned column to a dataframe using a bin specification
+    
+    Args:
+        df (dataframe object)): dataframe
+        col_name (string): name of the new binned column
+        spec (dict): bin specification, see BIN_SPECS in config
+
+    Returns:
+        df (dataframe object): dataframe with the new column
+    """
+    fill_values = df[spec["fill_from"]].to_numpy(dtype=np.float64) if "fill_from" in spec else None
+    df.loc[:,col_name] = bin_values(df[spec["column"]].to_numpy(), spec, fill_values)
+
     return df
 
+def _bucket_index(x, edges, right):
+    """Bucket of each value, as np.digitize(x, edges, right) but one comparison pass per edge"""
+    if len(edges) > 16:
+        return np.searchsorted(edges, x, side="left" if right else "right")
+    index = np.zeros(len(x), dtype=np.int8)
+    for edge in edges:
+        index += (x > edge) if right else (x >= edge)
+    return index
+
+def _clip(x, bounds):
+    """Clip to [lower, upper], either of which may be None"""
+    lower, upper = bounds if bounds else (None, None)
+    if lower is not None:
+        x = np.maximum(x, lower)
+    if upper is not None:
+        x = np.minimum(x, upper)
+    return x
+
 def bool_to_int(df, col_name):
     """A function to turn ts and fs into 1s and 0s
     
@@ -279,29 +319,34 @@ def extract_str_count(df, col_name):
     return df
 
 def create_features(clean_datapath, scrape_date, host_features,
-					property_features, booking_features, response_variable):
+					property_features, booking_features, response_variable, bin_specs, n_jobs=1, partition_by=None,
+					key="id"):
     '''Create features related to host, property, booking, and response
     
     Args:
-        clean_datapath (str): file path for cleaned data
+        clean_datapath (str): file path for cleaned data (csv, parquet or feather)
         scrape_date (datetime): the date when inside_airbnb scraped data
     	host_features (list): a list of the columns to keep for host features
     	property_features (list): a list of of the columns to keep for property features
     	booking_features (list): a list of of the columns to keep for booking features
     	response_variable (list): a list of length 1 of the response variable
+    	bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
+    	n_jobs (int): number of processes the listings are featurized in, see featurize_partitions
+    	partition_by (str): column to partition the listings by (e.g. neighbourhood_cleansed or city),
+    	    None for n_jobs ranges of rows
+    	key (str): listing id column, kept as the first column (not a feature) if the clean data has it
 
     Returns:
         df (dataframe object): cleaned dataframe
     '''
 
-    df = pd.read_csv(clean_datapath)
-    df = create_response_variable(df)
-    df = create_host_features(df, scrape_date)
-    df = create_property_features(df)
-    df = create_booking_features(df)
+    df = read_table(clean_datapath)
+    df = create_response_variable(df, bin_specs)
+    df = featurize_partitions(df, scrape_date, bin_specs, n_jobs, partition_by)
     
     #select final variables
-    df = df[host_features+
+    df = df[([key] if key in df.columns else [])+
+            host_features+
             property_features+
             booking_features+
             response_variable]
@@ -309,3 +354,140 @@ def create_features(clean_datapath, scrape_date, host_features,
     df = clean_data_types(df)
     
     return df
+
+def create_features_incremental(clean_datapath, state, version, scrape_date, host_features,
+                                property_features, booking_features, response_variable, bin_specs, key="id",
+                                n_jobs=1, partition_by=None):
+    '''Create features for a new clean snapshot, recomputing only new and changed listings
+
+    Listings are matched to the previous snapshot's state by id and a hash of the clean columns
+    the host, property and booking features are built from, so columns that move every month
+    (availability, review counts and scores, reviews_per_month) do not mark a listing as
+    changed. Host, property and booking features are computed for new and
+    changed listings only; unchanged listings reuse their stored features, with years_as_host
+    recomputed from host_since if the scrape date moved. The response is binned for every
+    listing, since reviews_per_month changes every month. The features equal those of
+    create_features on the same snapshot.
+
+    Args:
+        clean_datapath (str): file path for cleaned data (csv, parquet or feather), with a unique key column
+        state (dict): state returned for the previous snapshot, None to featurize every listing
+        version (str): digest of the featurization config and code; a state with another
+            version is discarded
+        scrape_date (datetime): the date when inside_airbnb scraped data
+        host_features (list): a list of the columns to keep for host features
+        property_features (list): a list of of the columns to keep for property features
+        booking_features (list): a list of of the columns to keep for booking features
+        response_variable (list): a list of length 1 of the response variable
+        bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
+        key (str): listing id column of the clean data
+        n_jobs (int): number of processes the changed listings are featurized in, see featurize_partitions
+        partition_by (str): column to partition the changed listings by, None for ranges of rows
+
+    Returns:
+        df (dataframe object): cleaned dataframe with the key column first, as from create_features
+        state (dict): version, scrape_date and the features keyed by listing id and row hash, for the next snapshot
+    '''
+    feature_columns = host_features + property_features + booking_features
+    df = read_table(clean_datapath)
+    if df[key].duplicated().any():
+        raise ValueError("Incremental features need unique listing ids, {} has duplicate {} values".format(
+            clean_datapath, key))
+    row_hash = pd.util.hash_pandas_object(df[feature_sources(feature_columns, bin_specs)], index=False)
+    response = create_response_variable(df[[key, "reviews_per_month"]], bin_specs)
+
+    if state is not None and state["version"] != version:
+        logger.info("Featurization config or code changed, recomputing every listing")
+        state = None
+    stored = state["features"].set_index(key) if state is not None else pd.DataFrame(columns=["row_hash"])
+
+    #listings with a response whose clean row is unchanged since the previous snapshot
+    ids = df.loc[response.index, key]
+    reuse = ids.isin(stored.index).to_numpy()
+    reuse[reuse] = stored["row_hash"].reindex(ids[reuse]).to_numpy() == row_hash[response.index[reuse]].to_numpy()
+
+    reused = None
+    if reuse.any():
+        reused = stored.loc[ids[reuse], ["host_since"] + feature_columns].set_axis(response.index[reuse])
+        if state["scrape_date"] != scrape_date:
+            reused["years_as_host"] = round((scrape_date - reused["host_since"]) / np.timedelta64(1,"Y"), 2)
+
+    changed = featurize_partitions(df.loc[response.index[~reuse]], scrape_date, bin_specs, n_jobs, partition_by)
+    logger.info("%d listings recomputed, %d reused from the previous snapshot", len(changed), reuse.sum())
+
+    merged = pd.concat([reused, changed[["host_since"] + feature_columns]]).sort_index()
+    merged[response_variable] = response[response_variable]
+    merged[key] = df.loc[merged.index, key]
+    merged = clean_data_types(merged)
+
+    state = {"version": version, "scrape_date": scrape_date,
+             "features": merged.assign(row_hash=row_hash[merged.index])}
+    return merged[[key] + feature_columns + response_variable], state
+
+def feature_sources(feature_columns, bin_specs):
+    '''Clean columns that a list of host, property and booking features is built from
+
+    Args:
+        feature_columns (list): feature columns, as in HOST_FEATURES, PROPERTY_FEATURES and BOOKING_FEATURES
+        bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
+
+    Returns:
+        columns (list): clean columns, each once, in the order of the features
+    '''
+    columns = []
+    for feature in feature_columns:
+        if feature in bin_specs:
+            sources = [bin_specs[feature]["column"]] + ([bin_specs[feature]["fill_from"]]
+                                                        if "fill_from" in bin_specs[feature] else [])
+        else:
+            sources = DERIVED_FEATURE_SOURCES.get(feature, [feature])
+        columns += [col for col in sources if col not in columns]
+
+    return columns
+
+def featurize_partitions(df, scrape_date, bin_specs, n_jobs=1, partition_by=None):
+    '''Host, property and booking features of clean listings, computed per partition in a process pool
+
+    The feature builders work row by row, so each partition is featurized on its own and the
+    partitions are concatenated back in the original row order. The result is the same for any
+    n_jobs and partitioning.
+
+    Args:
+        df (dataframe object): clean listings with a unique index
+        scrape_date (datetime): the date when inside_airbnb scraped data
+        bin_specs (dict): bin specifications keyed by output column, see BIN_SPECS in config
+        n_jobs (int): number of processes, 1 to featurize in this process
+        partition_by (str): column whose values define the partitions (missing values form one
+            partition), None for n_jobs ranges of rows
+
+    Returns:
+        df (dataframe object): listings with the host, property and booking features
+    '''
+    if n_jobs < 1:
+        raise ValueError("n_jobs must be at least 1, got {}".format(n_jobs))
+    if partition_by is not None and partition_by not in df.columns:
+        raise ValueError("Cannot partition the listings by {}, it is not a column".format(partition_by))
+    if n_jobs == 1 or len(df) == 0:
+        return _create_listing_features(df, scrape_date, bin_specs)
+
+    if partition_by is None:
+        partitions = [df.iloc[rows] for rows in np.array_split(np.arange(len(df)), n_jobs) if len(rows)]
+    else:
+        #factorize codes missing values as -1, so they form a partition (groupby's dropna needs pandas >= 1.1)
+        keys = pd.factorize(df[partition_by], sort=True)[0]
+        partitions = [partition for _, partition in df.groupby(keys, sort=True)]
+
+    featurize = functools.partial(_create_listing_features, scrape_date=scrape_date, bin_specs=bin_specs)
+    with ProcessPoolExecutor(max_workers=min(n_jobs, len(partitions))) as executor:
+        featured = list(executor.map(featurize, partitions))
+    logger.debug("Featurized %d listings in %d partitions on %d processes", len(df), len(partitions), n_jobs)
+
+    return pd.concat(featured).loc[df.index]
+
+def _create_listing_features(df, scrape_date, bin_specs):
+    '''Host, property and booking features of clean listings'''
+    df = create_host_features(df, scrape_date)
+    df = create_property_features(df, bin_specs)
+    df = create_booking_features(df, bin_specs)
+
+    return df
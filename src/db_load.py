@@ -0,0 +1,176 @@
+import time
+import logging
+
+import sqlalchemy as sql
+from sqlalchemy.dialects import mysql, postgresql
+
+from src.artifacts import iter_table
+from src.predict import map_bin
+
+logger = logging.getLogger(__name__)
+
+LISTING_KEY = "listing_id"
+
+def truncate_table(connection, table):
+    '''Remove every row of a table with the fastest statement the database supports
+
+    MySQL and PostgreSQL use TRUNCATE TABLE (on MySQL it commits immediately and cannot be rolled
+    back). SQLite has no TRUNCATE; an unqualified DELETE uses its truncate optimization instead.
+
+    Args:
+        connection (Connection or Engine): database connection
+        table (Table): table to empty
+
+    Returns:
+        None
+    '''
+    if connection.dialect.name == "sqlite":
+        connection.execute(table.delete())
+    else:
+        connection.execute(sql.text("TRUNCATE TABLE {}".format(table.name)))
+
+def rebuild_table(engine, table):
+    '''Migrate an existing table to the schema of its model, keeping the rows
+
+    The rows of the columns both schemas share are copied into a new table (column types are
+    converted on insert), the old table is dropped, the new one renamed into its place and the
+    model's indexes created. SQLite and PostgreSQL run the migration in one transaction; MySQL
+    commits each DDL statement.
+
+    Args:
+        engine (Engine): database engine
+        table (Table): model table (e.g. the Airbnb model's __table__), which must already exist
+
+    Returns:
+        rows (int): number of rows copied
+    '''
+    existing = {col["name"] for col in sql.inspect(engine).get_columns(table.name)}
+    columns = ", ".join(col.name for col in table.columns if col.name in existing)
+    staging = sql.Table(table.name + "_migrate", sql.MetaData(), *[col.copy() for col in table.columns])
+
+    with engine.begin() as connection:
+        staging.drop(connection, checkfirst=True)
+        staging.create(connection)
+        connection.execute(sql.text("INSERT INTO {new} ({cols}) SELECT {cols} FROM {old}".format(
+            new=staging.name, old=table.name, cols=columns)))
+        rows = connection.execute(sql.select([sql.func.count()]).select_from(staging)).scalar()
+        connection.execute(sql.text("DROP TABLE {}".format(table.name)))
+        connection.execute(sql.text("ALTER TABLE {} RENAME TO {}".format(staging.name, table.name)))
+        for index in table.indexes:
+            index.create(connection)
+
+    logger.info("Migrated %d rows of %s", rows, table.name)
+    return rows
+
+def listing_records(df, columns):
+    '''Convert a chunk of imputed or scored listings into insert parameters for the table
+
+    The source listing id (id) is loaded as listing_id, numeric reviews_per_month_bin values are
+    mapped to the labels the webapp stores, and missing values become NULL.
+
+    Args:
+        df (dataframe object): listings, extra columns are ignored
+        columns (list): table columns to fill
+
+    Returns:
+        records (list): one dict per listing, keyed by the table columns present in df
+    '''
+    df = df.rename(columns={"id": LISTING_KEY})
+    df = df[[col for col in columns if col in df.columns]]
+    if "reviews_per_month_bin" in df and df["reviews_per_month_bin"].dtype.kind in "iuf":
+        labels = {value: map_bin(value) for value in df["reviews_per_month_bin"].dropna().unique()}
+        df = df.assign(reviews_per_month_bin=df["reviews_per_month_bin"].map(labels))
+
+    #tolist() gives Python scalars, much faster than converting the frame to object dtype
+    values = []
+    for col in df.columns:
+        items = df[col].tolist()
+        missing = df[col].isna()
+        if missing.any():
+            items = [None if is_missing else item for item, is_missing in zip(items, missing)]
+        values.append(items)
+
+    return [dict(zip(df.columns, row)) for row in zip(*values)]
+
+def upsert_statement(table, dialect_name, update_columns):
+    '''INSERT statement that updates the existing row when its listing_id is already loaded
+
+    Args:
+        table (Table): table to load, with a unique listing_id column
+        dialect_name (str): "sqlite", "mysql" or "postgresql"
+        update_columns (list): columns overwritten on a conflict
+
+    Returns:
+        statement: statement for executemany with one parameter dict per row
+    '''
+    if dialect_name == "mysql":
+        statement = mysql.insert(table)
+        return statement.on_duplicate_key_update({col: statement.inserted[col] for col in update_columns})
+    if dialect_name == "postgresql":
+        statement = postgresql.insert(table)
+        return statement.on_conflict_do_update(index_elements=[LISTING_KEY],
+                                               set_={col: statement.excluded[col] for col in update_columns})
+    if dialect_name == "sqlite":
+        #SQLAlchemy 1.3 has no SQLite upsert construct, SQLite >= 3.24 supports the syntax
+        columns = [LISTING_KEY] + update_columns
+        return sql.text("INSERT INTO {table} ({cols}) VALUES ({params}) ON CONFLICT({key}) DO UPDATE SET {sets}".format(
+            table=table.name, cols=", ".join(columns), params=", ".join(":" + col for col in columns),
+            key=LISTING_KEY, sets=", ".join("{0} = excluded.{0}".format(col) for col in update_columns)))
+    raise ValueError("Upsert is not supported for the {} dialect".format(dialect_name))
+
+def bulk_load(engine, table, filepath, batch_size=5000, upsert=False, replace=False):
+    '''Stream a dataset of listings into a table with batched executemany inserts in one transaction
+
+    Args:
+        engine (Engine): database engine
+        table (Table): table to load (the Airbnb model's __table__)
+        filepath (str): imputed or scored listings (csv, parquet or feather)
+        batch_size (int): rows read and inserted per executemany call
+        upsert (bool): if True, update rows whose listing_id is already in the table instead of
+            inserting duplicates (the input needs an id or listing_id column)
+        replace (bool): if True, replace the contents of the table. On MySQL the rows are loaded
+            into a copy of the table that is then swapped in with RENAME TABLE; elsewhere the table
+            is emptied in the same transaction as the load. Readers never see an empty table.
+
+    Returns:
+        rows (int): number of rows loaded
+    '''
+    columns = [col.name for col in table.columns if col.name != "id"]
+    dialect_name = engine.dialect.name
+    target = table
+    swap = replace and dialect_name == "mysql"
+    if swap:
+        target = sql.Table(table.name + "_load", sql.MetaData(), *[col.copy() for col in table.columns])
+        with engine.connect() as connection:
+            connection.execute(sql.text("DROP TABLE IF EXISTS {}".format(target.name)))
+            connection.execute(sql.text("CREATE TABLE {} LIKE {}".format(target.name, table.name)))
+
+    rows = 0
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        if replace and not swap:
+            truncate_table(connection, table)
+        for chunk in iter_table(filepath, batch_size):
+            records = listing_records(chunk, columns)
+            if not records:
+                continue
+            if upsert:
+                if LISTING_KEY not in records[0]:
+                    raise ValueError("Upsert needs an id or {} column in {}".format(LISTING_KEY, filepath))
+                update_columns = [col for col in records[0] if col != LISTING_KEY]
+                statement = upsert_statement(target, dialect_name, update_columns)
+            else:
+                statement = target.insert()
+            connection.execute(statement, records)
+            rows += len(records)
+            logger.debug("Loaded %d rows", rows)
+
+    if swap:
+        with engine.connect() as connection:
+            connection.execute(sql.text("RENAME TABLE {0} TO {0}_old, {1} TO {0}".format(table.name, target.name)))
+            connection.execute(sql.text("DROP TABLE {}_old".format(table.name)))
+
+    seconds = time.perf_counter() - start
+    logger.info("Loaded %d rows into %s in %.2fs (%.0f rows/s)", rows, table.name, seconds,
+                rows / seconds if seconds else float("inf"))
+    return rows
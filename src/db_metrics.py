@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+import sqlalchemy as sql
+
+logger = logging.getLogger(__name__)
+
+def engine_options(database_uri, pool_size=5, max_overflow=10, pool_recycle=3600, pool_pre_ping=True):
+    '''create_engine keyword arguments for a pooled database connection
+
+    SQLite gets no pool settings: SQLAlchemy opens a connection per checkout for a database file
+    (NullPool) and keeps one per thread for :memory:, neither takes a size or overflow, and SQLite
+    connections never go stale.
+
+    Args:
+        database_uri (str): SQLAlchemy database URI
+        pool_size (int): connections kept open in the pool
+        max_overflow (int): extra connections opened when the pool is exhausted, closed when returned
+        pool_recycle (int): seconds after which a connection is replaced, keep below MySQL's wait_timeout
+        pool_pre_ping (bool): if True, test connections on checkout and replace dropped ones
+
+    Returns:
+        options (dict): keyword arguments for create_engine (SQLALCHEMY_ENGINE_OPTIONS in Flask-SQLAlchemy)
+    '''
+    if sql.engine.url.make_url(database_uri).get_backend_name() == "sqlite":
+        return {}
+    return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_recycle": pool_recycle,
+            "pool_pre_ping": pool_pre_ping}
+
+class QueryTimer:
+    '''Time the queries of an engine per request (per thread) and in total
+
+    start() begins a request on the current thread, every query the thread runs until stop() is
+    counted towards that request. Queries outside a request (startup, background threads) are
+    not counted.
+    '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._totals = {"requests": 0, "queries": 0, "db_seconds": 0.0, "request_seconds": 0.0}
+        self._engines = []
+
+    def listen(self, engine):
+        '''Time every query run by an engine
+
+        Args:
+            engine (Engine): database engine
+        '''
+        sql.event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+        sql.event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+        self._engines.append(engine)
+
+    def start(self):
+        '''Begin timing a request on the current thread'''
+        self._local.request = {"start": time.perf_counter(), "queries": 0, "db_seconds": 0.0}
+
+    def stop(self):
+        '''Finish the request of the current thread and add it to the totals
+
+        Returns:
+            timing (dict): queries, db_seconds and request_seconds of the request, None outside a request
+        '''
+        request = getattr(self._local, "request", None)
+        if request is None:
+            return None
+        self._local.request = None
+        timing = {"queries": request["queries"], "db_seconds": request["db_seconds"],
+                  "request_seconds": time.perf_counter() - request["start"]}
+        with self._lock:
+            self._totals["requests"] += 1
+            for key, value in timing.items():
+                self._totals[key] += value
+        return timing
+
+    def summary(self):
+        '''Cumulative timing and the status of every engine's connection pool
+
+        Returns:
+            summary (dict): totals, mean per-request times in ms and the pool status of each engine
+        '''
+        with self._lock:
+            summary = dict(self._totals)
+        requests = summary["requests"] or 1
+        summary["mean_db_ms"] = summary["db_seconds"] * 1000 / requests
+        summary["mean_request_ms"] = summary["request_seconds"] * 1000 / requests
+        summary["pools"] = [engine.pool.status() for engine in self._engines]
+        return summary
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        context._query_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        request = getattr(self._local, "request", None)
+        if request is not None:
+            request["queries"] += 1
+            request["db_seconds"] += time.perf_counter() - context._query_start
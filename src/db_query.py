@@ -0,0 +1,40 @@
+import logging
+
+import sqlalchemy as sql
+
+logger = logging.getLogger(__name__)
+
+def listing_page(connection, table, columns, filters=None, cursor=None, page_size=100):
+    '''One page of a table, newest rows first, with keyset pagination on the primary key
+
+    Only the given columns are selected. Rather than an OFFSET, a page starts after the last id of
+    the previous page (WHERE id < cursor), so every page costs the same as the first one.
+
+    Args:
+        connection (Connection, Engine or Session): database connection
+        table (Table): table to page through, with an integer id primary key
+        columns (list): columns to return, id is always included
+        filters (dict): column -> value, rows must match all of them
+        cursor (int): next_cursor of the previous page, None for the first page
+        page_size (int): maximum number of rows per page
+
+    Returns:
+        rows (list): one dict per row, keyed by id and the requested columns
+        next_cursor (int): cursor of the next page, None on the last page
+    '''
+    filters = filters or {}
+    unknown = [col for col in list(columns) + list(filters) if col not in table.c]
+    if unknown:
+        raise ValueError("Unknown columns for {}: {}".format(table.name, ", ".join(unknown)))
+
+    query = sql.select([table.c.id] + [table.c[col] for col in columns if col != "id"])
+    for col, value in filters.items():
+        query = query.where(table.c[col] == value)
+    if cursor is not None:
+        query = query.where(table.c.id < cursor)
+    #one extra row tells whether there is a next page
+    query = query.order_by(table.c.id.desc()).limit(page_size + 1)
+
+    rows = [dict(row) for row in connection.execute(query).fetchall()]
+    next_cursor = rows[page_size - 1]["id"] if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
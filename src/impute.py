@@ -0,0 +1,132 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+#Imputer
+from sklearn.experimental import enable_iterative_imputer
+from sklearn.impute import IterativeImputer
+
+logger = logging.getLogger(__name__)
+
+HOST_RESPONSE_TIME_MAP = {
+    "within an hour": 0,
+    "within a few hours": 1,
+    "within a day": 2,
+    "a few days or more": 3,
+}
+MEDIAN_IMPUTED_COLUMNS = ["security_deposit", "cleaning_fee"]
+
+def fit_imputer(df, seed, categorical_columns, response="reviews_per_month_bin", max_iter=12, key="id"):
+    '''Fit the imputation of missing feature input once, so it can be reused for new batches and at serving time
+
+    security_deposit and cleaning_fee are filled with their medians. host_response_rate and
+    host_response_time are imputed by an IterativeImputer fitted on the numeric features and the
+    other categorical features one-hot encoded (first category dropped), as the original
+    imputation did; columns with no missing values are used as predictors but not modelled
+    themselves. The one-hot categories are fixed at fit time, so batches and single listings are
+    encoded the same way (unknown categories as all zeros).
+
+    Args:
+        df (dataframe object): features dataset
+        seed (int): a seed to set for random_state to preserve reproducibility
+        categorical_columns (list): string features, one-hot encoded for the IterativeImputer (host_response_time
+            is imputed as its mapped category instead)
+        response (str): response column, left out of the IterativeImputer
+        max_iter (int): number of imputation rounds
+        key (str): listing id column, left out of the IterativeImputer if present
+
+    Returns:
+        imputer (dict): the medians, the one-hot categories, the fitted IterativeImputer, its column order and
+            the imputable columns
+    '''
+    medians = {col: float(df[col].median()) for col in MEDIAN_IMPUTED_COLUMNS}
+    onehot = {col: _categories(df[col])[1:] for col in categorical_columns if col != "host_response_time"}
+    columns = ([c for c in df.columns if c not in categorical_columns and c not in (response, key)]
+               + ["{}_{}".format(col, category) for col, categories in onehot.items() for category in categories]
+               + ["host_response_time_mapping"])
+
+    iterative = IterativeImputer(max_iter=max_iter,
+                                 random_state=seed,
+                                 verbose=0,
+                                 initial_strategy="most_frequent",
+                                 skip_complete=True)
+    iterative.fit(_imputer_matrix(df.fillna(medians), columns, onehot))
+
+    return {"medians": medians, "onehot": onehot, "columns": columns, "iterative": iterative,
+            "imputable": MEDIAN_IMPUTED_COLUMNS + ["host_response_rate", "host_response_time"]}
+
+def apply_imputer(df, imputer):
+    '''Fill missing feature input with a fitted imputer, only transforming rows that have missing values
+
+    Args:
+        df (dataframe object): features, with the columns the imputer was fitted on
+        imputer (dict): imputer from fit_imputer
+
+    Returns:
+        df (dataframe object): features with security_deposit, cleaning_fee, host_response_rate and
+            host_response_time filled in
+    '''
+    df = df.fillna(imputer["medians"])
+    X = _imputer_matrix(df, imputer["columns"], imputer.get("onehot", {}))
+    rows = np.isnan(X).any(axis=1)
+    if not rows.any():
+        return df
+
+    imputed = imputer["iterative"].transform(X[rows])
+    rate = imputed[:, imputer["columns"].index("host_response_rate")]
+    time_mapping = imputed[:, imputer["columns"].index("host_response_time_mapping")]
+
+    #round imputed host_response_rate to 2 decimal places, between 0 and 1
+    #round imputed host_response_time_mapping(categorical) to the nearest category, between 0 and 3
+    inv_host_resp_map = {v: k for k, v in HOST_RESPONSE_TIME_MAP.items()}
+    if isinstance(df["host_response_time"].dtype, pd.CategoricalDtype):
+        new_categories = [c for c in HOST_RESPONSE_TIME_MAP if c not in df["host_response_time"].cat.categories]
+        df["host_response_time"] = df["host_response_time"].cat.add_categories(new_categories)
+    row_index = df.index[rows]
+    df.loc[row_index, "host_response_rate"] = np.clip(np.round(rate, 2), 0, 1)
+    df.loc[row_index, "host_response_time"] = [inv_host_resp_map[int(v)] for v in np.clip(np.round(time_mapping), 0, 3)]
+    logger.debug("Imputed %d of %d rows", rows.sum(), len(df))
+
+    return df
+
+def impute_listings(listings, imputer):
+    '''Fill missing imputable fields of typed listings (from cast_listing) at serving time
+
+    Args:
+        listings (list): listings from cast_listing, missing fields set to None or NaN
+        imputer (dict): imputer from fit_imputer
+
+    Returns:
+        listings (list): the listings, with missing fields filled in
+    '''
+    missing = [i for i, listing in enumerate(listings)
+               if any(listing.get(col) is None or listing.get(col) != listing.get(col) for col in imputer["imputable"])]
+    if not missing:
+        return listings
+
+    filled = apply_imputer(pd.DataFrame([listings[i] for i in missing]), imputer)
+    listings = list(listings)
+    for i, (_, row) in zip(missing, filled.iterrows()):
+        listings[i] = dict(listings[i])
+        for col in imputer["imputable"]:
+            listings[i][col] = str(row[col]) if col == "host_response_time" else float(row[col])
+
+    return listings
+
+def _categories(values):
+    '''Categories of a column in pd.get_dummies order: the dtype's categories, or the sorted values'''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return list(values.cat.categories)
+    return sorted(values.dropna().unique())
+
+def _imputer_matrix(df, columns, onehot):
+    '''Float matrix of the imputer columns: the numeric features, the onehot indicators of their fitted
+    categories and host_response_time mapped to its numeric category, in that order'''
+    n_numeric = len(columns) - sum(len(categories) for categories in onehot.values()) - 1
+    blocks = [df[columns[:n_numeric]].to_numpy(dtype=np.float64)]
+    for col, categories in onehot.items():
+        values = df[col].to_numpy(dtype=object)[:, None]
+        blocks.append((values == np.asarray(categories, dtype=object)[None, :]).astype(np.float64))
+    blocks.append(df["host_response_time"].map(HOST_RESPONSE_TIME_MAP).to_numpy(dtype=np.float64)[:, None])
+    return np.hstack(blocks)
@@ -1,9 +1,16 @@
 import os
 import gzip
+import time
+import zlib
 import requests
 import logging
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+S3_MIN_PART_SIZE = 5 * 1024 * 1024  # every part of a multipart upload but the last must be at least 5 MiB
 
 def fetch_zipfile(url):
     '''Downloads a file and writes it to current directory
@@ -15,9 +22,55 @@ def fetch_zipfile(url):
     '''
     filename = url.split("/")[-1]
     
-    with open(filename, "wb") as f:
-        r = requests.get(url)
-        f.write(r.content)
+    download_file(url, filename)
+
+def download_file(url, dest_filepath, retries=3, backoff=1.0, chunk_size=1048576, timeout=60, session=None):
+    '''Streams a file to disk, resuming a partial download and retrying on failure
+
+    The file is written to dest_filepath + ".part" and renamed when complete. If a ".part" file
+    already exists, only the remaining bytes are requested with an HTTP Range header.
+
+    Args:
+        url (str): the url to the file to be downloaded
+        dest_filepath (str): the filepath to write the file to
+        retries (int): number of attempts before giving up
+        backoff (float): seconds to wait after the first failed attempt, doubled after each failure
+        chunk_size (int): bytes to write at a time
+        timeout (float): seconds to wait for the server to respond
+        session (requests.Session): session to reuse connections, a new one is used if None
+    Returns:
+        n_bytes (int): bytes received over the network (excluding bytes resumed from disk)
+    '''
+    session = session or requests.Session()
+    part_filepath = dest_filepath + ".part"
+    n_bytes = 0
+
+    for attempt in range(1, retries + 1):
+        offset = os.path.getsize(part_filepath) if os.path.exists(part_filepath) else 0
+        headers = {"Range": "bytes={}-".format(offset)} if offset else {}
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                if r.status_code == 416:
+                    #the partial file does not match the remote file, start over
+                    os.remove(part_filepath)
+                    raise requests.HTTPError("Range not satisfiable for {}".format(url), response=r)
+                r.raise_for_status()
+                #a 200 instead of a 206 means the server ignored the range, so rewrite the file
+                mode = "ab" if offset and r.status_code == 206 else "wb"
+                with open(part_filepath, mode) as f:
+                    for chunk in r.iter_content(chunk_size):
+                        f.write(chunk)
+                        n_bytes += len(chunk)
+            os.replace(part_filepath, dest_filepath)
+            return n_bytes
+        except (requests.RequestException, IOError) as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status is not None and 400 <= status < 500 and status not in (408, 416, 429):
+                raise
+            if attempt == retries:
+                raise
+            logger.warning("Download of %s failed (attempt %d of %d), retrying: %s", url, attempt, retries, e)
+            time.sleep(backoff * 2 ** (attempt - 1))
 
 def gunzip(source_filepath, dest_filepath, block_size=65536):
     '''Unzips a gzipped file
@@ -34,9 +87,7 @@ def gunzip(source_filepath, dest_filepath, block_size=65536):
             block = s_file.read(block_size)
             if not block:
                 break
-            else:
-                d_file.write(block)
-        d_file.write(block)
+            d_file.write(block)
 
 def upload_file_s3(file_name, bucket, aws_access_key, aws_secret_key, s3_object_name = None):
     '''Uploads a file to an S3 bucket
@@ -62,6 +113,236 @@ def upload_file_s3(file_name, bucket, aws_access_key, aws_secret_key, s3_object_
         return False
     return True
 
+def stream_to_s3(url, bucket, s3_key, s3_client, part_size=8388608, local_filepath=None, retries=3,
+                 backoff=1.0, chunk_size=1048576, timeout=60, session=None):
+    '''Streams a gzipped file from a url, unzips it on the fly and uploads it to S3 as a multipart upload
+
+    Nothing but the optional local copy touches the disk, and memory is bounded by part_size and
+    chunk_size rather than by the file size. If the connection drops, the download is resumed with
+    an HTTP Range request where it stopped, keeping the decompressor and the parts already uploaded.
+
+    Args:
+        url (str): the url to the gzipped file
+        bucket (str): the bucket name to upload into
+        s3_key (str): the S3 object name to upload into
+        s3_client: boto3 S3 client (or any object with the same multipart upload methods)
+        part_size (int): bytes of unzipped data per uploaded part, at least 5 MiB
+        local_filepath (str): if given, also write the unzipped file here
+        retries (int): attempts for each request
+        backoff (float): seconds to wait after the first failed attempt, doubled after each failure
+        chunk_size (int): bytes of the gzipped body read at a time
+        timeout (float): seconds to wait for the server to respond
+        session (requests.Session): session to reuse connections, a new one is used if None
+    Returns:
+        stats (dict): bytes downloaded (gzipped), csv_bytes unzipped and the number of parts
+    '''
+    if part_size < S3_MIN_PART_SIZE:
+        raise ValueError("part_size must be at least {} bytes, got {}".format(S3_MIN_PART_SIZE, part_size))
+    session = session or requests.Session()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    buffer = bytearray()
+    parts = []
+    n_bytes = 0
+    csv_bytes = 0
+
+    def upload_part(body):
+        for attempt in range(1, retries + 1):
+            try:
+                response = s3_client.upload_part(Bucket=bucket, Key=s3_key, UploadId=upload_id,
+                                                 PartNumber=len(parts) + 1, Body=bytes(body))
+                parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+                return
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                logger.warning("Upload of part %d of %s failed (attempt %d of %d), retrying: %s",
+                               len(parts) + 1, s3_key, attempt, retries, e)
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=s3_key)["UploadId"]
+    local_file = open(local_filepath, "wb") if local_filepath else None
+    try:
+        attempt = 1
+        while True:
+            headers = {"Range": "bytes={}-".format(n_bytes)} if n_bytes else {}
+            try:
+                with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+                    r.raise_for_status()
+                    if n_bytes and r.status_code != 206:
+                        raise IOError("{} does not support resuming at byte {}".format(url, n_bytes))
+                    expected = n_bytes + int(r.headers.get("Content-Length", -1))
+                    for chunk in r.iter_content(chunk_size):
+                        n_bytes += len(chunk)
+                        data = chunk
+                        while data:
+                            if decompressor.eof:
+                                #concatenated gzip members
+                                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                            #max_length bounds how much a highly compressed chunk expands at once
+                            out = decompressor.decompress(data, part_size)
+                            data = decompressor.unused_data if decompressor.eof else decompressor.unconsumed_tail
+                            csv_bytes += len(out)
+                            if local_file:
+                                local_file.write(out)
+                            buffer += out
+                            if len(buffer) >= part_size:
+                                upload_part(buffer[:part_size])
+                                del buffer[:part_size]
+                    if n_bytes < expected:
+                        raise IOError("Connection to {} closed after {} of {} bytes".format(url, n_bytes, expected))
+                break
+            except (requests.RequestException, IOError) as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if (status is not None and 400 <= status < 500 and status not in (408, 429)) or attempt == retries:
+                    raise
+                logger.warning("Download of %s failed at byte %d (attempt %d of %d), resuming: %s",
+                               url, n_bytes, attempt, retries, e)
+                time.sleep(backoff * 2 ** (attempt - 1))
+                attempt += 1
+
+        if not decompressor.eof:
+            raise IOError("{} ended before the end of the gzip stream".format(url))
+        if buffer or not parts:
+            upload_part(buffer)
+        s3_client.complete_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id,
+                                            MultipartUpload={"Parts": parts})
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=bucket, Key=s3_key, UploadId=upload_id)
+        raise
+    finally:
+        if local_file:
+            local_file.close()
+
+    return {"bytes": n_bytes, "csv_bytes": csv_bytes, "parts": len(parts)}
+
+def read_manifest(manifest_filepath):
+    '''Reads an ingestion manifest: one InsideAirbnb listings.csv.gz url per line, # for comments
+
+    Args:
+        manifest_filepath (str): the filepath of the manifest
+    Returns:
+        urls (list): the urls to ingest, duplicates removed
+    '''
+    urls = []
+    with open(manifest_filepath) as f:
+        for line in f:
+            url = line.split("#")[0].strip()
+            if url and url not in urls:
+                urls.append(url)
+    return urls
+
+def snapshot_paths(url, local_dir, s3_prefix):
+    '''Local and S3 locations of one snapshot, from an InsideAirbnb url
+    (.../<city>/<YYYY-MM-DD>/data/listings.csv.gz)
+
+    Args:
+        url (str): the url to the gzipped listings
+        local_dir (str): directory for downloaded and unzipped files
+        s3_prefix (str): S3 key prefix, the key is <s3_prefix>/<city>/<date>/listings.csv
+    Returns:
+        paths (dict): city, date, gz_filepath, csv_filepath and s3_key
+    '''
+    parts = url.rstrip("/").split("/")
+    if len(parts) < 5:
+        raise ValueError("Cannot find the city and date in {}".format(url))
+    city, date, filename = parts[-4], parts[-3], parts[-1]
+    stem = filename[:-3] if filename.endswith(".gz") else filename
+    name = "{}_{}_{}".format(city, date, stem)
+
+    return {"city": city, "date": date,
+            "gz_filepath": os.path.join(local_dir, name + ".gz"),
+            "csv_filepath": os.path.join(local_dir, name),
+            "s3_key": "/".join([s3_prefix.rstrip("/"), city, date, stem])}
+
+def ingest_snapshot(url, local_dir, bucket, s3_prefix, s3_client, retries=3, backoff=1.0, stream=True,
+                    keep_local=False, part_size=8388608):
+    '''Downloads, unzips and uploads one snapshot to S3
+
+    Args:
+        url (str): the url to the gzipped listings
+        local_dir (str): directory for downloaded and unzipped files
+        bucket (str): the bucket name to upload into
+        s3_prefix (str): S3 key prefix, see snapshot_paths
+        s3_client: boto3 S3 client (or any object with the same upload_file method)
+        retries (int): attempts for the download and for the upload
+        backoff (float): seconds to wait after the first failed attempt, doubled after each failure
+        stream (bool): stream straight to S3 (see stream_to_s3) instead of going through local files
+        keep_local (bool): when streaming, also write the unzipped file to local_dir
+        part_size (int): bytes per multipart upload part when streaming
+    Returns:
+        result (dict): url, s3_key, ok, bytes downloaded, csv bytes, seconds and error (if any)
+    '''
+    start = time.perf_counter()
+    result = {"url": url, "s3_key": None, "ok": False, "bytes": 0, "csv_bytes": 0, "seconds": 0.0, "error": None}
+    try:
+        paths = snapshot_paths(url, local_dir, s3_prefix)
+        result["s3_key"] = paths["s3_key"]
+        if stream:
+            stats = stream_to_s3(url, bucket, paths["s3_key"], s3_client, part_size,
+                                 paths["csv_filepath"] if keep_local else None, retries, backoff)
+            result["bytes"], result["csv_bytes"] = stats["bytes"], stats["csv_bytes"]
+        else:
+            result["bytes"] = download_file(url, paths["gz_filepath"], retries=retries, backoff=backoff)
+            gunzip(paths["gz_filepath"], paths["csv_filepath"])
+            result["csv_bytes"] = os.path.getsize(paths["csv_filepath"])
+
+            for attempt in range(1, retries + 1):
+                try:
+                    s3_client.upload_file(paths["csv_filepath"], bucket, paths["s3_key"])
+                    break
+                except Exception as e:
+                    if attempt == retries:
+                        raise
+                    logger.warning("Upload of %s failed (attempt %d of %d), retrying: %s",
+                                   paths["s3_key"], attempt, retries, e)
+                    time.sleep(backoff * 2 ** (attempt - 1))
+        result["ok"] = True
+    except Exception as e:
+        logger.error("Ingestion of %s failed: %s", url, e)
+        result["error"] = str(e)
+
+    result["seconds"] = time.perf_counter() - start
+    if result["ok"]:
+        logger.info("Ingested %s -> s3://%s/%s: %.1f MB in %.1fs (%.1f MB/s)", url, bucket, result["s3_key"],
+                    result["bytes"] / 1e6, result["seconds"], result["bytes"] / 1e6 / max(result["seconds"], 1e-9))
+    return result
+
+def ingest_manifest(urls, local_dir, bucket, s3_prefix, s3_client, max_workers=4, retries=3, backoff=1.0,
+                    stream=True, keep_local=False, part_size=8388608):
+    '''Ingests many snapshots concurrently with a bounded pool of worker threads
+
+    A failed snapshot is logged and reported in the results without stopping the others.
+
+    Args:
+        urls (list): the urls to the gzipped listings, see read_manifest
+        local_dir (str): directory for downloaded and unzipped files
+        bucket (str): the bucket name to upload into
+        s3_prefix (str): S3 key prefix, see snapshot_paths
+        s3_client: boto3 S3 client (thread-safe, shared by the workers)
+        max_workers (int): maximum number of snapshots processed at once
+        retries (int): attempts for each download and each upload
+        backoff (float): seconds to wait after the first failed attempt, doubled after each failure
+        stream (bool): stream each snapshot straight to S3 instead of going through local files
+        keep_local (bool): when streaming, also write the unzipped files to local_dir
+        part_size (int): bytes per multipart upload part when streaming
+    Returns:
+        results (list): one result dict per url (see ingest_snapshot), in manifest order
+    '''
+    os.makedirs(local_dir, exist_ok=True)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(
+            lambda url: ingest_snapshot(url, local_dir, bucket, s3_prefix, s3_client, retries, backoff,
+                                        stream, keep_local, part_size), urls))
+    seconds = time.perf_counter() - start
+
+    n_ok = sum(result["ok"] for result in results)
+    n_bytes = sum(result["bytes"] for result in results)
+    logger.info("Ingested %d of %d snapshots (%d failed): %.1f MB downloaded in %.1fs (%.1f MB/s) with %d workers",
+                n_ok, len(results), len(results) - n_ok, n_bytes / 1e6, seconds, n_bytes / 1e6 / max(seconds, 1e-9),
+                max_workers)
+    return results
+
 
 
 
@@ -0,0 +1,114 @@
+import os
+import hashlib
+import logging
+import pickle
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+def load_pickle(filepath):
+    '''Default artifact loader: unpickle a file
+
+    Args:
+        filepath (str): path to a pickled object
+
+    Returns:
+        obj: the unpickled object
+    '''
+    with open(filepath, "rb") as f:
+        return pickle.load(f)
+
+def file_digest(filepath, block_size=1048576):
+    '''Hash the contents of a file so that artifacts can be versioned
+
+    Args:
+        filepath (str): path to the file to hash
+        block_size (int): bytes to read at a time
+
+    Returns:
+        digest (str): first 12 hex characters of the sha256 of the file
+    '''
+    sha = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()[:12]
+
+class ArtifactRegistry:
+    '''Process-wide cache of trained artifacts (model, encoder, ...)
+
+    Each artifact is loaded once and shared by every request and thread. When hot_reload is
+    on, the file's mtime is checked on access and the artifact is reloaded only if its content
+    hash actually changed.
+    '''
+
+    def __init__(self, hot_reload=True):
+        self.hot_reload = hot_reload
+        self._artifacts = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, filepath, loader=load_pickle):
+        '''Register an artifact to be loaded lazily from filepath
+
+        Args:
+            name (str): name used to retrieve the artifact
+            filepath (str): location of the artifact on disk
+            loader (function): function taking a filepath and returning the artifact
+        '''
+        with self._lock:
+            self._artifacts[name] = {"filepath": filepath, "loader": loader, "obj": None,
+                                     "mtime": None, "version": None}
+
+    def preload(self):
+        '''Load every registered artifact, logging (not raising) when one is not available yet'''
+        for name in list(self._artifacts):
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning("Artifact %s not loaded at startup, will retry on first use: %s", name, e)
+
+    def get(self, name):
+        '''Return the loaded artifact, loading or reloading it from disk if needed
+
+        Args:
+            name (str): name the artifact was registered under
+
+        Returns:
+            obj: the loaded artifact
+        '''
+        entry = self._artifacts[name]
+        if entry["obj"] is not None and not self.hot_reload:
+            return entry["obj"]
+
+        mtime = os.stat(entry["filepath"]).st_mtime
+        if entry["obj"] is not None and mtime == entry["mtime"]:
+            return entry["obj"]
+
+        with self._lock:
+            #another thread may have reloaded while we waited for the lock
+            if entry["obj"] is not None and mtime == entry["mtime"]:
+                return entry["obj"]
+            version = file_digest(entry["filepath"])
+            if entry["obj"] is not None and version == entry["version"]:
+                entry["mtime"] = mtime
+                return entry["obj"]
+
+            start = time.perf_counter()
+            obj = entry["loader"](entry["filepath"])
+            elapsed = time.perf_counter() - start
+            logger.info("Loaded artifact %s from %s (version %s) in %.3fs",
+                        name, entry["filepath"], version, elapsed)
+            entry.update(obj=obj, mtime=mtime, version=version)
+            return obj
+
+    def versions(self):
+        '''Return the content version of every loaded artifact
+
+        Returns:
+            versions (dict): artifact name -> version (None if not loaded yet)
+        '''
+        return {name: entry["version"] for name, entry in self._artifacts.items()}
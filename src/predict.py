@@ -0,0 +1,209 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def listings_frame(records, feature_columns, categorical_columns, float_columns):
+    '''Build a typed dataframe of listings from raw input records (form or JSON)
+
+    Args:
+        records (list): a list of dict-like listings keyed by feature name
+        feature_columns (list): the ordered list of model input features
+        categorical_columns (list): features that are kept as strings
+        float_columns (list): features cast to float, all other features are cast to int
+
+    Returns:
+        df (dataframe object): one row per listing with the model input features
+    '''
+    df = pd.DataFrame.from_records(records, columns=feature_columns)
+
+    missing = df.columns[df.isna().any()].tolist()
+    if missing:
+        raise ValueError("Missing value(s) for: {}".format(", ".join(missing)))
+
+    types = {}
+    for col in feature_columns:
+        if col in categorical_columns:
+            types[col] = str
+        elif col in float_columns:
+            types[col] = float
+        else:
+            types[col] = int
+
+    return df.astype(types)
+
+def encode_listings(df, encoder, categorical_columns):
+    '''One-hot encode listings the same way the model was trained
+
+    Args:
+        df (dataframe object): listings from listings_frame
+        encoder (OneHotEncoder): fitted encoder saved by train_model
+        categorical_columns (list): features that are one-hot encoded
+
+    Returns:
+        df_predict (dataframe object): predictors ready for the trained model
+    '''
+    df = df.reset_index(drop=True)
+    df_onehot = pd.DataFrame(
+        encoder.transform(df[categorical_columns]).toarray(),
+        columns = encoder.get_feature_names(categorical_columns)
+    )
+    df_predict = df.join(df_onehot).drop(columns=categorical_columns)
+
+    return df_predict
+
+def compile_feature_layout(encoder, feature_columns, categorical_columns, float_columns, encoding="onehot",
+                           vocabulary=None):
+    '''Compile a fitted encoder into a layout mapping each raw input field to its model column(s)
+
+    Numeric fields keep their order at the front of the row, followed by the one-hot columns
+    in the encoder's order -- the same columns encode_listings produces. With ordinal encoding
+    (hist engine) each categorical field is one column holding its category code.
+
+    Args:
+        encoder (OneHotEncoder or OrdinalEncoder): fitted encoder from one_hot_encode or ordinal_encode
+        feature_columns (list): the ordered list of raw model input features
+        categorical_columns (list): features that are encoded, in encoder order
+        float_columns (list): numeric features cast to float, all other numeric features are cast to int
+        encoding (str): "onehot" or "ordinal"
+        vocabulary (dict): if given, the vocabulary the encoder was built from; unknown categories are
+            then encoded as the column's fallback instead of being rejected
+
+    Returns:
+        layout (dict): numeric field offsets, category -> offset (onehot) or category -> code (ordinal)
+            lookups, the fallback category of each field, the encoding and the output column names
+    '''
+    fallback = {col: vocabulary[col]["fallback"] for col in categorical_columns} if vocabulary else {}
+    numeric = []
+    for col in feature_columns:
+        if col not in categorical_columns:
+            numeric.append((col, len(numeric), "float" if col in float_columns else "int"))
+
+    if encoding == "ordinal":
+        categorical = [(col, {str(category): float(code) for code, category in enumerate(encoder.categories_[i])})
+                       for i, col in enumerate(categorical_columns)]
+        columns = [col for col, _, _ in numeric] + list(categorical_columns)
+        return {"numeric": numeric, "categorical": categorical, "n_columns": len(columns), "columns": columns,
+                "encoding": encoding, "fallback": fallback}
+
+    categorical = []
+    offset = len(numeric)
+    for i, col in enumerate(categorical_columns):
+        dropped = encoder.drop_idx_[i] if encoder.drop_idx_ is not None else None
+        lookup = {}
+        for j, category in enumerate(encoder.categories_[i]):
+            if dropped is not None and j == dropped:
+                lookup[str(category)] = None
+            else:
+                lookup[str(category)] = offset
+                offset += 1
+        categorical.append((col, lookup))
+
+    columns = [col for col, _, _ in numeric] + list(encoder.get_feature_names(categorical_columns))
+
+    return {"numeric": numeric, "categorical": categorical, "n_columns": offset, "columns": columns,
+            "encoding": encoding, "fallback": fallback}
+
+def cast_listing(record, layout, imputable=(), max_lengths=None):
+    '''Type the fields of one raw listing (form or JSON) using a feature layout
+
+    Args:
+        record (dict): a listing keyed by feature name
+        layout (dict): feature layout from compile_feature_layout
+        imputable (list): fields that may be missing (see impute_listings); they are set to NaN
+            (numeric) or None (categorical) instead of raising
+        max_lengths (dict): if given, longest accepted value of categorical fields (e.g. the sizes of
+            their database columns); longer values raise ValueError
+
+    Returns:
+        listing (dict): the listing with int, float and string values
+    '''
+    listing = {}
+    for col, _, kind in layout["numeric"]:
+        value = record.get(col)
+        if value is None or value == "":
+            if col not in imputable:
+                raise ValueError("Missing value for: {}".format(col))
+            listing[col] = float("nan")
+            continue
+        listing[col] = float(value) if kind == "float" else int(value)
+    for col, _ in layout["categorical"]:
+        value = record.get(col)
+        if value is None or value == "":
+            if col not in imputable:
+                raise ValueError("Missing value for: {}".format(col))
+            listing[col] = None
+            continue
+        listing[col] = str(value)
+        if max_lengths and col in max_lengths and len(listing[col]) > max_lengths[col]:
+            raise ValueError("Value for {} is longer than {} characters".format(col, max_lengths[col]))
+
+    return listing
+
+def vectorize_listings(listings, layout):
+    '''Write typed listings straight into a preallocated model input matrix
+
+    Unknown categories are encoded as the layout's fallback category when it has one (layouts
+    compiled with a vocabulary) and rejected otherwise.
+
+    Args:
+        listings (list): listings from cast_listing
+        layout (dict): feature layout from compile_feature_layout
+
+    Returns:
+        X (array): float64 matrix of shape (len(listings), layout["n_columns"])
+    '''
+    X = np.zeros((len(listings), layout["n_columns"]), dtype=np.float64)
+
+    for col, offset, _ in layout["numeric"]:
+        X[:, offset] = [listing[col] for listing in listings]
+
+    ordinal = layout.get("encoding") == "ordinal"
+    fallback = layout.get("fallback", {})
+    for j, (col, lookup) in enumerate(layout["categorical"]):
+        for i, listing in enumerate(listings):
+            try:
+                value = lookup[listing[col]]
+            except KeyError:
+                if col not in fallback:
+                    raise ValueError("Found unknown category {!r} for {}".format(listing[col], col))
+                logger.warning("Unknown category %r for %s encoded as %r", listing[col], col, fallback[col])
+                value = lookup[fallback[col]]
+            if ordinal:
+                #ordinal layouts map to the category code, held in the field's own column
+                X[i, len(layout["numeric"]) + j] = value
+            elif value is not None:
+                X[i, value] = 1.0
+
+    return X
+
+def score_listings(predictors, trained_model):
+    '''Score a batch of listings with one predict_proba call
+
+    Args:
+        predictors (dataframe or array): encoded predictors
+        trained_model (classifier): fitted classifier
+
+    Returns:
+        bins (array): predicted reviews_per_month_bin for each listing
+        probabilities (array): class probabilities, columns ordered as trained_model.classes_
+    '''
+    probabilities = trained_model.predict_proba(predictors)
+    bins = trained_model.classes_[np.argmax(probabilities, axis=1)]
+
+    return bins, probabilities
+
+def map_bin(x):
+    '''Map a predicted reviews_per_month_bin to its popularity label'''
+    if x == 1:
+        return "very unpopular"
+    elif x == 2:
+        return "unpopular"
+    elif x == 3:
+        return "popular"
+    elif x == 4:
+        return "very popular"
+    else:
+        return "somethings wrong"
@@ -0,0 +1,123 @@
+import os
+import json
+import inspect
+import hashlib
+import logging
+import datetime
+
+import numpy as np
+
+from src.model_registry import file_digest
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_SUFFIX = ".fingerprint"
+
+def stable_repr(value):
+    '''Convert a config value into a JSON-serializable form that is identical across runs
+
+    Sets are sorted, arrays are listed and frozen scipy distributions are described by their
+    name and parameters (their default repr contains a memory address).
+
+    Args:
+        value: a config value (dict, list, set, array, scipy distribution, datetime, scalar, ...)
+
+    Returns:
+        stable: the value as nested dicts, lists and scalars
+    '''
+    if isinstance(value, dict):
+        return {str(key): stable_repr(val) for key, val in value.items()}
+    if isinstance(value, (set, frozenset)):
+        return sorted((stable_repr(val) for val in value), key=repr)
+    if isinstance(value, (list, tuple)):
+        return [stable_repr(val) for val in value]
+    if isinstance(value, np.ndarray):
+        return {"dtype": str(value.dtype), "values": value.tolist()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if hasattr(value, "dist") and hasattr(value, "args") and hasattr(value, "kwds"):
+        return {"distribution": value.dist.name, "args": stable_repr(value.args), "kwds": stable_repr(value.kwds)}
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+def source_files(*funcs):
+    '''Source files that define the given functions, used to version a stage by its code
+
+    Args:
+        funcs (function): functions called by the stage
+
+    Returns:
+        filepaths (list): sorted, de-duplicated source file paths
+    '''
+    return sorted({inspect.getsourcefile(func) for func in funcs})
+
+def stage_fingerprint(stage, input_filepaths, config_values, code_filepaths):
+    '''Fingerprint a pipeline stage by the content of its inputs, its config and its code
+
+    Input files are identified by content only, so a moved or renamed input with the same bytes
+    gives the same fingerprint. A missing input has no digest (None), and the stage is then
+    never up to date, so it runs and reports the missing file itself.
+
+    Args:
+        stage (str): name of the stage
+        input_filepaths (list): files read by the stage
+        config_values (dict): config name -> value for every setting the stage uses
+        code_filepaths (list): source files of the stage, see source_files
+
+    Returns:
+        fingerprint (dict): stage, per-part digests and the combined "fingerprint" digest
+    '''
+    fingerprint = {
+        "stage": stage,
+        "inputs": [file_digest(filepath) if os.path.exists(filepath) else None for filepath in input_filepaths],
+        "config": hashlib.sha256(json.dumps(stable_repr(config_values), sort_keys=True).encode()).hexdigest()[:12],
+        "code": {os.path.basename(filepath): file_digest(filepath) for filepath in code_filepaths},
+    }
+    fingerprint["fingerprint"] = hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()[:16]
+
+    return fingerprint
+
+def is_up_to_date(fingerprint, output_filepaths, force=False):
+    '''Check whether every output of a stage exists and was produced with the same fingerprint
+
+    Args:
+        fingerprint (dict): fingerprint from stage_fingerprint
+        output_filepaths (list): files written by the stage
+        force (bool): if True, always report the stage as out of date
+
+    Returns:
+        up_to_date (bool): True if the stage can be skipped, never when an input is missing
+    '''
+    if force:
+        return False
+    if None in fingerprint["inputs"]:
+        return False
+    for filepath in output_filepaths:
+        try:
+            with open(filepath + FINGERPRINT_SUFFIX) as f:
+                recorded = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if not os.path.exists(filepath) or recorded.get("fingerprint") != fingerprint["fingerprint"]:
+            return False
+
+    logger.info("Skipping %s, outputs up to date (fingerprint %s): %s", fingerprint["stage"],
+                fingerprint["fingerprint"], ", ".join(output_filepaths))
+    return True
+
+def record_fingerprint(fingerprint, output_filepaths):
+    '''Write the fingerprint next to every output of a stage (<output>.fingerprint)
+
+    Args:
+        fingerprint (dict): fingerprint from stage_fingerprint
+        output_filepaths (list): files written by the stage
+
+    Returns:
+        None
+    '''
+    for filepath in output_filepaths:
+        with open(filepath + FINGERPRINT_SUFFIX, "w") as f:
+            json.dump(fingerprint, f, indent=2, sort_keys=True)
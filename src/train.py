@@ -4,12 +4,14 @@ import logging
 import pandas as pd
 import numpy as np
 import math
+import time
 import pickle
+import json
+import hashlib
+import tempfile
+import functools
 from scipy import stats
-
-#Imputer
-from sklearn.experimental import enable_iterative_imputer
-from sklearn.impute import IterativeImputer
+from scipy import sparse
 
 #Model
 from sklearn.model_selection import train_test_split
@@ -17,123 +19,87 @@ from sklearn.model_selection import cross_val_score
 from sklearn.model_selection import GridSearchCV
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.model_selection import StratifiedKFold
+from sklearn.model_selection import cross_val_predict
+from sklearn.base import clone
+from sklearn.experimental import enable_halving_search_cv
+from sklearn.model_selection import HalvingRandomSearchCV
+from sklearn.experimental import enable_hist_gradient_boosting
 from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
 from sklearn.metrics import roc_auc_score
+from sklearn.metrics import accuracy_score
 from sklearn.preprocessing import OneHotEncoder
+from sklearn.preprocessing import OrdinalEncoder
 
-def get_model_data(features_path, seed):
-    '''Impute missing feature input: security_deposit, cleaning_fee, host_response_time, and host_response_rate
-    
-    Args:
-        features_path (str): a string pointing to features.csv
-        seed (int): a seed to set for random_state to preserve reproducibility
+from src.predict import compile_feature_layout
+from src.impute import fit_imputer, apply_imputer
+from src.artifacts import read_table, write_table
+from src.vocabulary import load_vocabulary, apply_vocabulary, category_codes
+from src.stage_cache import stable_repr
 
-    Returns:
-        df (dataframe object): dataframe with features imputed and ready for model
-    '''
-    df = pd.read_csv(features_path)
-
-    #impute values for security_deposit and cleaning_fee using median
-    df["security_deposit"] = df["security_deposit"].fillna(value = df["security_deposit"].median())
-    df["cleaning_fee"] = df["cleaning_fee"].fillna(value = df["cleaning_fee"].median())
-    df = df.reset_index(drop=True)
-
-    #map host_response_time to numerical values and drop text
-    host_resp_map = {
-        "within an hour": 0,
-        "within a few hours": 1,
-        "within a day": 2,
-        "a few days or more": 3,
-    }
-    inv_host_resp_map = dict([[v,k] for k,v in host_resp_map.items()])
-
-    #impute df to copy values over to original df
-    try:
-        imputed_df = impute_missing(df, seed, host_resp_map)
-    except Exception as e:
-        logger.error(e)
-
-    df = df[[c for c in df if c not in ["reviews_per_month_bin"]] 
-           + ["reviews_per_month_bin"]]
+logger = logging.getLogger(__name__)
 
-    df.loc[:,"host_response_rate"] = imputed_df.loc[:,"host_response_rate"]
-    df.loc[:,"host_response_time"] = imputed_df.loc[:,"host_response_time_mapping"].map(inv_host_resp_map)
+CATEGORICAL_COLUMNS = ["host_response_time",
+                       "room_type",
+                       "property_type_cat",
+                       "neighbourhood_cleansed",
+                       "cancellation_policy"]
 
-    model_df = df
+#listing id carried through featurize and impute (for loading into the database), not a feature
+ID_COLUMN = "id"
 
-    return model_df
+#metrics computed from one predict_proba call: (y_true, class probabilities, classes) -> score
+PROBA_METRICS = {
+    "roc_auc_ovo": lambda y, proba, classes: roc_auc_score(y, proba, multi_class="ovo", average="macro",
+                                                           labels=classes),
+    "accuracy": lambda y, proba, classes: accuracy_score(y, classes[np.argmax(proba, axis=1)]),
+}
 
-def impute_missing(final_df, seed, host_resp_map):
-    '''Helper function to preserve features dataframe while imputing values
+def get_model_data(features_path, seed, imputer_filepath=None, refit=True, max_iter=12, vocab_filepath=None):
+    '''Impute missing feature input: security_deposit, cleaning_fee, host_response_time, and host_response_rate
     
     Args:
-        final_df (dataframe): a dataframe with features that still need imouting
+        features_path (str): a string pointing to the features dataset (csv, parquet or feather)
         seed (int): a seed to set for random_state to preserve reproducibility
-        host_resp_map (dict): a dictionary of values to map host_response_time to numerical
+        imputer_filepath (str): file path to save the fitted imputer to (or to load it from if refit is False)
+        refit (bool): if False, reuse the imputer saved at imputer_filepath instead of fitting a new one
+        max_iter (int): number of IterativeImputer rounds when fitting
+        vocab_filepath (str): if given, the vocabulary the categorical features are cast to
 
     Returns:
-        df (dataframe object): dataframe with features imputed to be transfered to features df
+        df (dataframe object): dataframe with features imputed and ready for model
     '''
-    #one-hot encode categorical variables before imputing
-    final_df = pd.get_dummies(
-        final_df,
-        columns=[
-            "room_type",
-            "property_type_cat",
-            "neighbourhood_cleansed",
-            "cancellation_policy",
-        ],
-        prefix=[
-            "room_type",
-            "property_type",
-            "neighbourhood",
-            "cancellation_policy",
-        ],
-        drop_first=True,
-    )
-
-    final_df.loc[:, "host_response_time_mapping"] = final_df["host_response_time"].map(host_resp_map)
-    final_df = final_df.drop("host_response_time",axis=1)
-    
-
-    #IterativeImputer parameters
-    imputer = IterativeImputer(max_iter = 12,
-                               random_state=seed,
-                               verbose=0,
-                               initial_strategy="most_frequent")
-
-    #Impute columns that aren't response
-    imputation_df = final_df.drop("reviews_per_month_bin",axis=1)
-
-    #Imputation columns
-    imp_columns = imputation_df.columns.tolist()
+    df = read_table(features_path).reset_index(drop=True)
+    vocabulary = load_vocabulary(vocab_filepath)
+    if vocabulary is not None:
+        df = apply_vocabulary(df, vocabulary)
+
+    if refit:
+        start = time.perf_counter()
+        imputer = fit_imputer(df, seed, CATEGORICAL_COLUMNS, max_iter=max_iter)
+        logger.info("Imputer fitted on %d rows in %.2fs", len(df), time.perf_counter() - start)
+        if imputer_filepath is not None:
+            pickle.dump(imputer, open(imputer_filepath, "wb"))
+    else:
+        imputer = pickle.load(open(imputer_filepath, "rb"))
+
+    start = time.perf_counter()
+    df = apply_imputer(df, imputer)
+    logger.info("Missing values imputed for %d rows in %.2fs", len(df), time.perf_counter() - start)
+
+    model_df = df[[c for c in df if c not in ["reviews_per_month_bin"]] 
+           + ["reviews_per_month_bin"]]
 
-    imputed = pd.DataFrame(imputer.fit_transform(imputation_df), columns=imp_columns)
-    
-    #round imputed host_response_time_mapping(categorical):
-    #if greater than 3, round to 3, if less than 0 round to 0
-    imputed.loc[:,"host_response_time_mapping"] = imputed["host_response_time_mapping"].round(decimals=0)
-    imputed.loc[imputed["host_response_time_mapping"] < 0,"host_response_time_mapping"] = 0
-    imputed.loc[imputed["host_response_time_mapping"] > 3,"host_response_time_mapping"] = 3
-
-    #round imputed host_response_rate:
-    #if greater than 1, round to 1, else round to 2 decimal places
-    #if less than 0, round to 0
-    imputed.loc[:,"host_response_rate"] = imputed["host_response_rate"].round(decimals = 2)
-    imputed.loc[imputed["host_response_rate"] > 1,"host_response_rate"] = 1.00
-    imputed.loc[imputed["host_response_rate"] < 0,"host_response_rate"] = 0
-    
-    model_df = pd.merge(imputed, final_df[["reviews_per_month_bin"]].reset_index(drop=True),
-                   left_index=True, right_index=True)
-    
     return model_df
 
 def tune_and_score(imputed_filepath, seed, tuning_grid, 
-                    num_iters, n_jobs, param_scoring, grid_refit, test_size):
+                    num_iters, n_jobs, param_scoring, grid_refit, test_size,
+                    search_mode="random", halving_resource="n_samples", halving_factor=3, engine="gbt",
+                    results_filepath=None, oof_filepath=None, vocab_filepath=None, sparse_design=False):
     '''Train hyperparams on final imputed model data
     
     Args:
-        imputed_filepath (str): file path to final imputed model data
+        imputed_filepath (str): file path to final imputed model data (csv, parquet or feather)
         seed (int): a seed to set for random_state to preserve reproducibility
         tuning_grid(dict): a dictionary for chosen hyperparams
         num_iters (int): number of iterations to run gridsearch
@@ -141,64 +107,344 @@ def tune_and_score(imputed_filepath, seed, tuning_grid,
         param_scoring (str or list): type of scoring methodology
         grid_refit(str): what to refit best parameters on
         test_size(float): between 0 & 1, percentage of obs in test set
-
+        search_mode (str): "random" for RandomizedSearchCV, or "halving" for successive halving,
+            which gives more resources only to the most promising candidates
+        halving_resource (str): resource grown by successive halving, "n_samples" or "n_estimators"
+        halving_factor (int): proportion of candidates kept (1 / halving_factor) at each halving round
+        engine (str): "gbt" or "hist", see make_estimator; tuning_grid uses that engine's parameter names
+        results_filepath (str): if given, file path to save every candidate's cv_results_ (see search_results)
+        oof_filepath (str): if given, file path to save the best candidate's out-of-fold class
+            probabilities on the training split, taken from the search's folds (see out_of_fold_predictions)
+        vocab_filepath (str): if given, the vocabulary the categorical features are encoded with
+        sparse_design (bool): if True, train on a sparse CSR design matrix (gbt engine only)
 
     Returns:
         search_gbt (classifier): to extract best hyperparameters
         cv_auc (float): cross-validation AUC
-        cv_accu (float): cross-validation accuracy
+        cv_accu (float): cross-validation accuracy (None in halving mode, which scores grid_refit only)
         test_auc (float): test AUC
         test_accu (float): test accuracy
+        timings (dict): seconds spent in the search, the refit of the best candidate, held-out scoring and
+            out-of-fold predictions
     '''
-    df = pd.read_csv(imputed_filepath)
-
-    df = one_hot_encode(df)[0]
+    df = read_table(imputed_filepath)
 
     #get predictors and response of the dataset
-    predictors = df.loc[:, df.columns != "reviews_per_month_bin"]
-    response = df.loc[:, "reviews_per_month_bin"]
+    predictors, response, columns = model_inputs(df, engine, load_vocabulary(vocab_filepath), sparse_design)[:3]
 
     X_train, X_test, y_train, y_test = train_test_split(predictors, response, test_size=test_size, random_state=seed)
 
     # Model
-    estimator_gbt = GradientBoostingClassifier(n_iter_no_change=3, random_state=seed)
-
-    # RandomizedSearch with 5-fold (default)
-    clf_gbt = RandomizedSearchCV(estimator_gbt, tuning_grid, n_iter=num_iters, random_state=seed, n_jobs=n_jobs,
-                                 scoring=param_scoring, refit=grid_refit)
-    # Randomized Search on Predictors & Response
+    estimator_gbt = make_estimator(engine, seed, columns)
+
+    #the search's scorer keeps every fold's probabilities, so out-of-fold predictions need no refit
+    fold_cache = tempfile.TemporaryDirectory() if oof_filepath is not None else None
+    clf_gbt = make_search(estimator_gbt, tuning_grid, search_mode, num_iters, seed, n_jobs, param_scoring,
+                          grid_refit, halving_resource, halving_factor,
+                          fold_cache.name if fold_cache is not None else None)
+    # Search on Predictors & Response (the search refits the best candidate on all of X_train)
+    start = time.perf_counter()
     search_gbt = clf_gbt.fit(X_train, y_train)
+    timings = {"search": time.perf_counter() - start - search_gbt.refit_time_, "refit": search_gbt.refit_time_}
+    logger.info("%s search (%s engine) took %.1fs, refit %.1fs", search_mode, engine, timings["search"],
+                timings["refit"])
     print("Best Hyperparameters:", search_gbt.best_params_)
     cv_auc = search_gbt.best_score_
-    cv_accu = max(search_gbt.cv_results_['mean_test_accuracy'])
+    if "mean_test_accuracy" in search_gbt.cv_results_:
+        cv_accu = max(search_gbt.cv_results_['mean_test_accuracy'])
+    else:
+        cv_accu = None
     print("CV AUC:", cv_auc)
     print("CV Accuracy:", cv_accu)
 
-    test_auc, test_accu = test_metrics(search_gbt, X_test, y_test, seed)
-    return search_gbt, cv_auc, cv_accu, test_auc, test_accu
+    start = time.perf_counter()
+    test_auc, test_accu = test_metrics(search_gbt.best_estimator_, X_test, y_test)
+    timings["scoring"] = time.perf_counter() - start
+
+    if results_filepath is not None:
+        write_table(search_results(search_gbt), results_filepath)
+    if oof_filepath is not None:
+        start = time.perf_counter()
+        with fold_cache:
+            write_table(out_of_fold_predictions(search_gbt.best_estimator_, X_train, y_train, n_jobs,
+                                                fold_cache=fold_cache.name), oof_filepath)
+        timings["oof"] = time.perf_counter() - start
+        logger.info("Out-of-fold predictions took %.1fs", timings["oof"])
+    return search_gbt, cv_auc, cv_accu, test_auc, test_accu, timings
+
+def write_scores(scores_filepath, search, tuning_grid, engine, search_mode, cv_auc, cv_accu, test_auc, test_accu,
+                 timings):
+    '''Write the best hyperparameters, scores and stage timings of tune_and_score as text
 
-def one_hot_encode(df):
+    Args:
+        scores_filepath (str): file path to save the scores
+        search (classifier): fitted search from tune_and_score
+        tuning_grid (dict): hyperparameters that were tuned
+        engine (str): model engine
+        search_mode (str): search mode
+        cv_auc (float): cross-validation AUC
+        cv_accu (float): cross-validation accuracy, None in halving mode
+        test_auc (float): test AUC
+        test_accu (float): test accuracy
+        timings (dict): stage timings from tune_and_score; "oof" is only there when out-of-fold
+            predictions were saved
+
+    Returns:
+        None
+    '''
+    with open(scores_filepath, 'w') as f:
+        f.write("Model engine: " + engine + '\n')
+        f.write("Search mode: " + search_mode + '\n')
+        for param in tuning_grid:
+            f.write("Best " + param + ": " + str(search.best_params_[param]) + '\n')
+        f.write("CV AUC: " + str(cv_auc) + "\n")
+        f.write("CV Accuracy: " + (str(cv_accu) if cv_accu is not None else "n/a (halving search scores AUC only)") + "\n")
+        f.write("Test AUC: " + str(test_auc) + "\n")
+        f.write("Test Accuracy: " + str(test_accu) + "\n")
+        f.write("Search time (s): {:.2f}\n".format(timings["search"]))
+        f.write("Refit time (s): {:.2f}\n".format(timings["refit"]))
+        f.write("Scoring time (s): {:.2f}\n".format(timings["scoring"]))
+        if timings.get("oof") is not None:
+            f.write("Out-of-fold prediction time (s): {:.2f}\n".format(timings["oof"]))
+
+def search_results(search):
+    '''Flatten the cv_results_ of a fitted search into a table, one row per candidate (and halving round)
+
+    Keeps the fold scores, mean/std fit and score times and ranks. Each hyperparameter is its own
+    param_<name> column and params holds all of them as JSON.
+
+    Args:
+        search (estimator): fitted RandomizedSearchCV or HalvingRandomSearchCV
+
+    Returns:
+        results (dataframe object): the search results, with is_best marking best_index_
+    '''
+    results = pd.DataFrame(search.cv_results_)
+    for col in [c for c in results if c.startswith("param_")]:
+        values = list(results[col])
+        try:
+            results[col] = pd.to_numeric(values)
+        except (TypeError, ValueError):
+            results[col] = [str(value) for value in values]
+    results["params"] = [json.dumps(params, sort_keys=True, default=lambda value: value.item())
+                         for params in results["params"]]
+    results.insert(0, "candidate", np.arange(len(results)))
+    results["is_best"] = results["candidate"] == search.best_index_
+
+    return results
+
+def out_of_fold_predictions(estimator, predictors, response, n_jobs, n_splits=5, fold_cache=None):
+    '''Class probabilities of every training row from a copy of estimator fit on the other folds
+
+    Uses the same unshuffled stratified folds as the search, so the probabilities can be used to
+    calibrate or compare candidates without re-running it. If fold_cache holds the probabilities
+    the search's scorer computed for estimator's hyperparameters on every fold (see proba_scorer),
+    they are reused; otherwise, e.g. after successive halving, estimator is fit once per fold.
+
+    Args:
+        estimator (classifier): classifier with the chosen hyperparameters, e.g. best_estimator_ (not refit)
+        predictors (dataframe or csr_matrix): predictors of the training split
+        response (series): responses of the training split
+        n_jobs (int): number of CPUs to use
+        n_splits (int): number of folds
+        fold_cache (str): directory of fold probabilities written by the search's scorer
+
+    Returns:
+        oof (dataframe object): row (index in the imputed data), fold, reviews_per_month_bin, predicted
+            and one proba_<class> column per class
+    '''
+    cv = StratifiedKFold(n_splits=n_splits)
+    classes = np.unique(response)
+    folds = [test_index for _, test_index in cv.split(predictors, response)]
+    fold = np.empty(len(response), dtype=np.int64)
+    for i, test_index in enumerate(folds):
+        fold[test_index] = i
+
+    proba = _cached_fold_proba(fold_cache, estimator, response, folds) if fold_cache is not None else None
+    if proba is None:
+        logger.info("Fold probabilities of the best candidate not cached, fitting it on %d folds", n_splits)
+        proba = cross_val_predict(clone(estimator), predictors, response, cv=cv, method="predict_proba",
+                                  n_jobs=n_jobs)
+
+    #a sparse matrix has no index, its rows are labelled by the response
+    rows = predictors.index if hasattr(predictors, "index") else response.index
+    oof = pd.DataFrame({"row": np.asarray(rows), "fold": fold,
+                        "reviews_per_month_bin": np.asarray(response), "predicted": classes[np.argmax(proba, axis=1)]})
+    for i, label in enumerate(classes):
+        oof["proba_" + str(label)] = proba[:, i]
+
+    return oof
+
+def make_search(estimator, tuning_grid, search_mode, num_iters, seed, n_jobs, param_scoring, grid_refit,
+                halving_resource="n_samples", halving_factor=3, fold_cache=None):
+    '''Build the hyperparameter search for tune_and_score
+
+    "random" samples num_iters candidates and fits each on all the training folds (5-fold CV).
+    "halving" (HalvingRandomSearchCV) starts many candidates on a small amount of the resource --
+    training samples or boosting stages (n_estimators, or max_iter for the hist engine) -- and keeps
+    the best 1 / halving_factor of them at each round while multiplying their resource by
+    halving_factor. Halving scores grid_refit only.
+
+    Args:
+        estimator (classifier): estimator to tune
+        tuning_grid (dict): a dictionary for chosen hyperparams
+        search_mode (str): "random" or "halving"
+        num_iters (int): number of candidates for random search
+        seed (int): a seed to set for random_state to preserve reproducibility
+        n_jobs (int): number of CPUs to use
+        param_scoring (str or list): type of scoring methodology (random search), names from PROBA_METRICS
+        grid_refit (str): metric to select and refit the best parameters on
+        halving_resource (str): "n_samples" or "n_estimators"
+        halving_factor (int): halving rate
+        fold_cache (str): if given, directory the random search's scorer saves every fold's class
+            probabilities to, see proba_scorer
+
+    Returns:
+        search (estimator): unfitted search
+    '''
+    if search_mode == "random":
+        # RandomizedSearch with 5-fold (default)
+        return RandomizedSearchCV(estimator, tuning_grid, n_iter=num_iters, random_state=seed, n_jobs=n_jobs,
+                                  scoring=proba_scorer(param_scoring, fold_cache), refit=grid_refit)
+    if search_mode != "halving":
+        raise ValueError("Unknown search mode '{}', use 'random' or 'halving'".format(search_mode))
+
+    halving_grid = dict(tuning_grid)
+    resources = {}
+    if halving_resource == "n_estimators":
+        #boosting stages become the resource: candidates start with few trees and the best get more
+        halving_resource = "max_iter" if isinstance(estimator, HistGradientBoostingClassifier) else "n_estimators"
+        n_estimators = halving_grid.pop(halving_resource)
+        resources = {"min_resources": int(np.min(n_estimators)), "max_resources": int(np.max(n_estimators))}
+    elif halving_resource != "n_samples":
+        raise ValueError("Unknown halving resource '{}', use 'n_samples' or 'n_estimators'".format(halving_resource))
+
+    return HalvingRandomSearchCV(estimator, halving_grid, n_candidates="exhaust", factor=halving_factor,
+                                 resource=halving_resource, random_state=seed, n_jobs=n_jobs,
+                                 scoring=grid_refit, refit=True, **resources)
+
+def make_estimator(engine, seed, columns, **params):
+    '''Unfitted classifier for a model engine
+
+    "gbt" is the exact-split GradientBoostingClassifier on one-hot encoded categoricals. "hist" is
+    HistGradientBoostingClassifier: features are binned into at most 255 histogram bins, splits
+    are found on the histograms using all cores, and the ordinal encoded CATEGORICAL_COLUMNS are
+    split natively as categories. Both stop early after 3 rounds without improvement unless params
+    say otherwise.
+
+    Args:
+        engine (str): "gbt" or "hist"
+        seed (int): a seed to set for random_state to preserve reproducibility
+        columns (list): predictor columns, from encode_features
+        params: hyperparameters of the classifier, overriding the defaults above
+
+    Returns:
+        estimator (classifier): unfitted classifier
+    '''
+    if engine == "gbt":
+        return GradientBoostingClassifier(**dict({"n_iter_no_change": 3, "random_state": seed}, **params))
+    if engine == "hist":
+        categorical_features = np.isin(list(columns), CATEGORICAL_COLUMNS)
+        return HistGradientBoostingClassifier(**dict({"categorical_features": categorical_features,
+                                                      "early_stopping": True, "n_iter_no_change": 3,
+                                                      "random_state": seed}, **params))
+    raise ValueError("Unknown model engine '{}', use 'gbt' or 'hist'".format(engine))
+
+def model_inputs(df, engine, vocabulary=None, sparse_design=False):
+    '''Encoded predictors and response for a model engine
+
+    Args:
+        df (dataframe): dataframe of imputed data, the ID_COLUMN is dropped if present
+        engine (str): "gbt" or "hist", see make_estimator
+        vocabulary (dict): if given, the fixed categories from build_vocabulary
+        sparse_design (bool): if True, the predictors are a CSR matrix from sparse_design_matrix;
+            only the gbt engine accepts sparse input
+
+    Returns:
+        predictors (dataframe or csr_matrix): encoded predictors
+        response (series): reviews_per_month_bin
+        columns (list): predictor column names
+        encoder (OneHotEncoder or OrdinalEncoder): fitted encoder
+    '''
+    start = time.perf_counter()
+    df = df.drop(columns=[ID_COLUMN], errors="ignore")
+    if sparse_design:
+        if engine != "gbt":
+            raise ValueError("The {} engine does not accept a sparse design matrix, use 'gbt'".format(engine))
+        predictors, response, columns, encoder = sparse_design_matrix(df, vocabulary)
+    else:
+        df, encoder = encode_features(df, engine, vocabulary)
+        predictors = df.loc[:, df.columns != "reviews_per_month_bin"]
+        response = df.loc[:, "reviews_per_month_bin"]
+        columns = list(predictors.columns)
+    logger.info("%s design matrix of %d x %d built in %.2fs, %.1f MB", "Sparse" if sparse_design else "Dense",
+                predictors.shape[0], predictors.shape[1], time.perf_counter() - start,
+                matrix_nbytes(predictors) / 1e6)
+
+    return predictors, response, columns, encoder
+
+def encode_features(df, engine, vocabulary=None):
+    '''Encode the categorical features for a model engine, see make_estimator
+
+    Args:
+        df (dataframe): dataframe of imputed data
+        engine (str): "gbt" (one-hot encoding) or "hist" (ordinal encoding)
+        vocabulary (dict): if given, the fixed categories from build_vocabulary
+
+    Returns:
+        encoded_df (dataframe): encoded dataframe, response last
+        encoder (OneHotEncoder or OrdinalEncoder): fitted encoder
+    '''
+    if engine == "hist":
+        return ordinal_encode(df, vocabulary)
+    return one_hot_encode(df, vocabulary)
+
+def ordinal_encode(df, vocabulary=None):
+    '''Ordinal encode the categorical variables for native categorical splits
+
+    The category codes follow the numeric features, in CATEGORICAL_COLUMNS order.
+
+    Args:
+        df(dataframe): dataframe of imputed data
+        vocabulary (dict): if given, the codes are the categoricals' codes in vocabulary order
+            instead of being looked up by a fitted encoder
+
+    Returns:
+        encoded_df (dataframe): ordinal encoded dataframe
+        encoder (OrdinalEncoder): fitted encoder
+    '''
+    if vocabulary is None:
+        encoder = OrdinalEncoder().fit(df[CATEGORICAL_COLUMNS])
+        codes = encoder.transform(df[CATEGORICAL_COLUMNS])
+    else:
+        encoder = _vocabulary_encoder(OrdinalEncoder, vocabulary)
+        codes = category_codes(df, vocabulary, CATEGORICAL_COLUMNS).astype(np.float64)
+
+    df_codes = pd.DataFrame(codes, columns=CATEGORICAL_COLUMNS, index=df.index)
+    encoded_df = df.drop(columns=CATEGORICAL_COLUMNS).join(df_codes)
+
+    encoded_df = encoded_df[[c for c in encoded_df if c not in ["reviews_per_month_bin"]]
+           + ["reviews_per_month_bin"]]
+
+    return encoded_df, encoder
+
+def one_hot_encode(df, vocabulary=None):
     '''A function to one-hot encode certain categorical variables
     
     Args:
         df(dataframe): dataframe of imputed data
+        vocabulary (dict): if given, the one-hot columns are set from the categoricals' codes in
+            vocabulary order instead of being looked up by a fitted encoder
 
     Returns:
         encoded_df (dataframe): one-hot encoded dataframe
     '''
-    categorical_columns = ["host_response_time",
-                            "room_type",
-                            "property_type_cat",
-                          "neighbourhood_cleansed",
-                          "cancellation_policy"]
-    #define encoder
-    encoder = OneHotEncoder(drop="first")
-    #fit to categorical columns
-    encoder = encoder.fit(df[categorical_columns])
+    categorical_columns = CATEGORICAL_COLUMNS
+    onehot, encoder = _one_hot_block(df, vocabulary)
 
     encoded_df = df
     df_onehot = pd.DataFrame(
-        encoder.transform(df[categorical_columns]).toarray(),
+        onehot.toarray(),
         columns = encoder.get_feature_names(categorical_columns)
     )
     encoded_df = encoded_df.join(df_onehot).drop(columns=categorical_columns)
@@ -208,72 +454,175 @@ def one_hot_encode(df):
     
     return encoded_df, encoder
 
-def test_metrics(classifier, predictors, response, seed):
-    '''Score classifier on test set
+def sparse_design_matrix(df, vocabulary=None):
+    '''One-hot encode the categorical variables into a sparse CSR design matrix
+
+    The numeric features are stacked next to the sparse one-hot blocks without densifying them,
+    so the matrix grows with the non-zero values rather than with the number of categories. The
+    columns are those of one_hot_encode, in the same order.
+
+    Args:
+        df(dataframe): dataframe of imputed data
+        vocabulary (dict): if given, the fixed categories from build_vocabulary
+
+    Returns:
+        predictors (csr_matrix): one-hot encoded predictors
+        response (series): reviews_per_month_bin, with the index of df
+        columns (list): predictor column names
+        encoder (OneHotEncoder): fitted encoder
+    '''
+    onehot, encoder = _one_hot_block(df, vocabulary)
+    numeric_columns = [c for c in df if c not in CATEGORICAL_COLUMNS and c != "reviews_per_month_bin"]
+    numeric = sparse.csr_matrix(df[numeric_columns].to_numpy(dtype=np.float64))
+
+    predictors = sparse.hstack([numeric, onehot], format="csr")
+    columns = numeric_columns + list(encoder.get_feature_names(CATEGORICAL_COLUMNS))
+    return predictors, df["reviews_per_month_bin"], columns, encoder
+
+def matrix_nbytes(predictors):
+    '''Memory taken by a design matrix: the data of a dataframe or the three arrays of a CSR matrix'''
+    if sparse.issparse(predictors):
+        return predictors.data.nbytes + predictors.indices.nbytes + predictors.indptr.nbytes
+    return int(predictors.memory_usage(index=False).sum())
+
+def _one_hot_block(df, vocabulary):
+    '''Sparse one-hot columns of CATEGORICAL_COLUMNS (first category dropped) and their encoder'''
+    if vocabulary is None:
+        encoder = OneHotEncoder(drop="first").fit(df[CATEGORICAL_COLUMNS])
+        return encoder.transform(df[CATEGORICAL_COLUMNS]).tocsr(), encoder
+
+    encoder = _vocabulary_encoder(OneHotEncoder, vocabulary, drop="first")
+    codes = category_codes(df, vocabulary, CATEGORICAL_COLUMNS)
+    #the first category of each column is dropped, code c > 0 sets column offset + c - 1
+    offsets = np.cumsum([0] + [len(c) - 1 for c in encoder.categories_])
+    rows, cols = np.nonzero(codes > 0)
+    onehot = sparse.csr_matrix((np.ones(len(rows)), (rows, offsets[cols] + codes[rows, cols] - 1)),
+                               shape=(len(df), offsets[-1]))
+    return onehot, encoder
+
+def _vocabulary_encoder(encoder_class, vocabulary, **params):
+    '''Encoder with the vocabulary's categories; it is fitted on one row since its categories are given'''
+    categories = [vocabulary[col]["categories"] for col in CATEGORICAL_COLUMNS]
+    first_row = pd.DataFrame([[c[0] for c in categories]], columns=CATEGORICAL_COLUMNS)
+    return encoder_class(categories=categories, **params).fit(first_row)
+
+def proba_scorer(metrics, fold_cache=None):
+    '''Scorer that predicts class probabilities once per fold and computes every metric from them
+
+    With fold_cache, the probabilities of each fold are also saved there, keyed by the candidate's
+    hyperparameters and the fold's rows, for out_of_fold_predictions. Files are used rather than
+    memory so that this works with search workers in other processes (n_jobs > 1).
+
+    Args:
+        metrics (str or list): names of metrics in PROBA_METRICS
+        fold_cache (str): directory to save the fold probabilities to, None to not keep them
+
+    Returns:
+        scorer (function): scorer(estimator, X, y) returning a dict of metric name -> score
+    '''
+    metrics = [metrics] if isinstance(metrics, str) else list(metrics)
+    unknown = [metric for metric in metrics if metric not in PROBA_METRICS]
+    if unknown:
+        raise ValueError("Unknown scoring {}, use any of {}".format(unknown, sorted(PROBA_METRICS)))
+    return functools.partial(_score_from_proba, metrics=metrics, fold_cache=fold_cache)
+
+def _score_from_proba(estimator, X, y, metrics, fold_cache=None):
+    '''Compute metrics from a single predict_proba call, see proba_scorer'''
+    proba = estimator.predict_proba(X)
+    if fold_cache is not None and hasattr(y, "index"):
+        np.save(_fold_cache_path(fold_cache, estimator, y.index), proba)
+    return {metric: PROBA_METRICS[metric](y, proba, estimator.classes_) for metric in metrics}
+
+def _fold_cache_path(fold_cache, estimator, rows):
+    '''File of a candidate's probabilities on a fold, named by digests of its hyperparameters and the fold's rows'''
+    params = json.dumps(stable_repr(estimator.get_params(deep=False)), sort_keys=True).encode()
+    return os.path.join(fold_cache, "{}_{}.npy".format(hashlib.sha256(params).hexdigest()[:16],
+                                                      hashlib.sha256(np.asarray(rows).tobytes()).hexdigest()[:16]))
+
+def _cached_fold_proba(fold_cache, estimator, response, folds):
+    '''Out-of-fold probabilities of estimator's hyperparameters from the scorer's files, None if a fold is missing'''
+    proba = None
+    for test_index in folds:
+        filepath = _fold_cache_path(fold_cache, estimator, response.index[test_index])
+        if not os.path.exists(filepath):
+            return None
+        fold_proba = np.load(filepath)
+        if fold_proba.shape[1] != len(np.unique(response)):
+            return None
+        if proba is None:
+            proba = np.empty((len(response), fold_proba.shape[1]))
+        proba[test_index] = fold_proba
+    return proba
+
+def test_metrics(classifier, predictors, response):
+    '''Score the fitted classifier once on the held-out test set
     
     Args:
-        classifier (classifier object): classifier to extract best hyperparams
+        classifier (classifier object): fitted classifier, e.g. the search's best_estimator_
         predictors (dataframe): a dataframe of predictors representing test set
         response (dataframe): a dataframe of responses representing test set
-        seed (int): a seed to maintain reproducibility
 
     Returns:
         test_auc (float): test AUC
         test_accu (float): test accuracy
     '''
-    learning_gbt = classifier.best_params_["learning_rate"]
-    n_estimators_gbt = classifier.best_params_["n_estimators"]
-    max_depth_gbt = classifier.best_params_["max_depth"]
-    subsample_gbt = classifier.best_params_["subsample"]
-
-    final_gbt = GradientBoostingClassifier(
-        learning_rate=learning_gbt,
-        n_estimators=n_estimators_gbt,
-        max_depth=max_depth_gbt,
-        subsample=subsample_gbt,
-        n_iter_no_change=3,
-        random_state = seed
-    )
-
-    results = final_gbt.fit(predictors,response)
-    #Test Metrics
-    resp_prob = results.predict_proba(predictors)
-    test_auc = roc_auc_score(response, resp_prob, multi_class="ovo", average="macro")
-    test_accu = results.score(predictors,response)
+    scores = _score_from_proba(classifier, predictors, response, ["roc_auc_ovo", "accuracy"])
+    test_auc, test_accu = scores["roc_auc_ovo"], scores["accuracy"]
     print("Test AUC: ", test_auc)
     print("Test Accuracy: ", test_accu)
     return test_auc, test_accu
 
-def train_model(imputed_filepath, seed, best_lr, best_numest, best_maxd, best_subsamp, encoder_filepath):
+def train_model(imputed_filepath, seed, best_lr, best_numest, best_maxd, best_subsamp, encoder_filepath,
+                layout_filepath=None, engine="gbt", vocab_filepath=None, sparse_design=False):
     '''Train model on full data and best hyperparameters
     
     Args:
-        imputed_filepath (str): file path to final imputed model data
+        imputed_filepath (str): file path to final imputed model data (csv, parquet or feather)
         seed (int): a seed to set for random_state to preserve reproducibility
         best_lr(float): the best learning rate
         best_numest (int): the best number of estimators
         best_maxd (int): the best max_depth
         best_subsamp (str or list): the best number of sub samples
         encoder_filepath (str): file path to save encoder for predictions
+        layout_filepath (str): file path to save the compiled feature layout for predictions
+        engine (str): "gbt" or "hist", see make_estimator. For "hist", best_numest is the number of
+            boosting iterations (max_iter) and best_subsamp is not used
+        vocab_filepath (str): if given, the vocabulary the categorical features are encoded with;
+            the layout then maps unknown categories at serving time to the vocabulary's fallbacks
+        sparse_design (bool): if True, train on a sparse CSR design matrix (gbt engine only)
 
     Returns:
         trained_model (TMO): trained model object to predict unknowns
     '''
-    df = pd.read_csv(imputed_filepath)
-    df, encoder = one_hot_encode(df)
+    raw_df = read_table(imputed_filepath)
+    vocabulary = load_vocabulary(vocab_filepath)
+    predictors, response, columns, encoder = model_inputs(raw_df, engine, vocabulary, sparse_design)
     pickle.dump(encoder, open(encoder_filepath, "wb"))
 
-    predictors = df.loc[:, df.columns != "reviews_per_month_bin"]
-    response = df.loc[:, "reviews_per_month_bin"]
-
-    best_gbt = GradientBoostingClassifier(
-        learning_rate=best_lr,
-        n_estimators=best_numest,
-        max_depth=best_maxd,
-        subsample=best_subsamp,
-        n_iter_no_change=3,
-        random_state = seed
-    )
-
+    if layout_filepath is not None:
+        feature_columns = [c for c in raw_df.columns if c not in ("reviews_per_month_bin", ID_COLUMN)]
+        float_columns = [c for c in feature_columns if raw_df[c].dtype.kind == "f"]
+        layout = compile_feature_layout(encoder, feature_columns, CATEGORICAL_COLUMNS, float_columns,
+                                        "ordinal" if engine == "hist" else "onehot", vocabulary)
+        if layout["columns"] != columns:
+            raise ValueError("Compiled feature layout does not match the training columns")
+        pickle.dump(layout, open(layout_filepath, "wb"))
+
+    if engine == "hist":
+        best_gbt = make_estimator(engine, seed, columns,
+            learning_rate=best_lr,
+            max_iter=best_numest,
+            max_depth=best_maxd
+        )
+    else:
+        best_gbt = make_estimator(engine, seed, columns,
+            learning_rate=best_lr,
+            n_estimators=best_numest,
+            max_depth=best_maxd,
+            subsample=best_subsamp
+        )
+
+    start = time.perf_counter()
     trained_model = best_gbt.fit(predictors,response)
+    logger.info("%s model fitted on %d rows in %.1fs", engine, predictors.shape[0], time.perf_counter() - start)
     return trained_model
\ No newline at end of file
@@ -0,0 +1,88 @@
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+def build_vocabulary(df, columns):
+    '''Fix the categories of the string features, so every stage encodes them the same way
+
+    Categories are sorted (the order OneHotEncoder and OrdinalEncoder use). The fallback of a
+    column is its most frequent category (the first in sort order on a tie); unknown categories
+    are mapped to it.
+
+    Args:
+        df (dataframe object): features dataset
+        columns (list): string features, e.g. CATEGORICAL_COLUMNS
+
+    Returns:
+        vocabulary (dict): column -> {"categories": sorted list, "fallback": category}
+    '''
+    vocabulary = {}
+    for col in columns:
+        counts = df[col].dropna().astype(str).value_counts()
+        categories = sorted(counts.index)
+        fallback = sorted(counts.index[counts == counts.max()])[0]
+        vocabulary[col] = {"categories": categories, "fallback": fallback}
+
+    return vocabulary
+
+def load_vocabulary(filepath):
+    '''Load a vocabulary saved by the featurize stage, None if filepath is None'''
+    if filepath is None:
+        return None
+    with open(filepath, "rb") as f:
+        return pickle.load(f)
+
+def apply_vocabulary(df, vocabulary):
+    '''Cast the vocabulary's columns to categoricals with exactly its categories
+
+    Unknown categories are replaced by the column's fallback (with a warning), missing values
+    stay missing.
+
+    Args:
+        df (dataframe object): dataset with the vocabulary's columns as strings or categoricals
+        vocabulary (dict): vocabulary from build_vocabulary
+
+    Returns:
+        df (dataframe object): dataset with categorical columns
+    '''
+    df = df.copy()
+    for col, entry in vocabulary.items():
+        values = df[col]
+        dtype = pd.CategoricalDtype(entry["categories"])
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.rename_categories(values.cat.categories.astype(str))
+        elif values.dtype != object:
+            values = values.where(values.isna(), values.astype(str))
+        categorical = values.astype(dtype)
+
+        unknown = values.notna() & categorical.isna()
+        if unknown.any():
+            logger.warning("%d unknown %s categories mapped to %r, e.g. %s", unknown.sum(), col,
+                           entry["fallback"], sorted(values[unknown].astype(str).unique())[:3])
+            categorical[unknown] = entry["fallback"]
+        df[col] = categorical
+
+    return df
+
+def category_codes(df, vocabulary, columns):
+    '''Integer codes of categorical columns in vocabulary order
+
+    Args:
+        df (dataframe object): dataset from apply_vocabulary
+        vocabulary (dict): vocabulary from build_vocabulary
+        columns (list): columns to encode
+
+    Returns:
+        codes (array): int matrix of shape (len(df), len(columns))
+    '''
+    df = apply_vocabulary(df[columns], {col: vocabulary[col] for col in columns})
+    codes = np.column_stack([df[col].cat.codes.to_numpy() for col in columns])
+    if (codes < 0).any():
+        missing = [col for i, col in enumerate(columns) if (codes[:, i] < 0).any()]
+        raise ValueError("Missing values in categorical column(s): {}".format(", ".join(missing)))
+
+    return codes
@@ -0,0 +1,200 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+import sqlalchemy as sql
+
+logger = logging.getLogger(__name__)
+
+class WriteBehindQueue:
+    '''Persist rows from a background thread, in batches, instead of in the request
+
+    Rows are written once batch_size of them are queued or flush_interval seconds after the first
+    one, whichever comes first. A batch that fails with a transient error (the database is
+    unreachable or timed out) is retried until it is written, backing off up to max_retry_interval
+    seconds between attempts; meanwhile the queue fills up and put() writes rows synchronously,
+    which slows callers down to the speed of the database instead of dropping rows. A batch that
+    fails otherwise (e.g. a row violating a constraint) is written again row by row, so one bad
+    row does not hold back the others. Rows that still fail are logged in full and appended to
+    dead_letter_path as JSON lines, as are the rows still pending when close() times out.
+    '''
+
+    def __init__(self, write, batch_size=100, flush_interval=0.5, max_pending=1000, retry_interval=1.0,
+                 max_retry_interval=30.0, dead_letter_path=None,
+                 transient_errors=(sql.exc.OperationalError, sql.exc.TimeoutError)):
+        '''
+        Args:
+            write (function): takes a list of rows (dicts) and inserts them in one transaction
+            batch_size (int): maximum rows per write
+            flush_interval (float): seconds a queued row waits for a batch to fill
+            max_pending (int): queued rows above which put() writes synchronously
+            retry_interval (float): seconds before the first retry of a batch that failed with a transient
+                error, doubled after every failed retry
+            max_retry_interval (float): longest wait between retries
+            dead_letter_path (str): JSON lines file that rows which cannot be written are appended to,
+                None to only log them
+            transient_errors (tuple): exception types retried until the write succeeds, other errors
+                are not retried
+        '''
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.dead_letter_path = dead_letter_path
+        self.transient_errors = transient_errors
+        self._write = write
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._stopping = threading.Event()
+        #set when close() times out: retries stop and the pending rows are dead-lettered
+        self._abandon = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"queued": 0, "written": 0, "batches": 0, "sync_writes": 0, "failed_batches": 0,
+                       "dead_letters": 0, "in_flight": 0}
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def put(self, row):
+        '''Queue a row, or write it now if the queue is full or closed
+
+        Args:
+            row (dict): row to insert
+
+        Returns:
+            queued (bool): False if the row was written synchronously
+        '''
+        if not self._stopping.is_set():
+            try:
+                self._queue.put_nowait(row)
+                self._count("queued", 1)
+                return True
+            except queue.Full:
+                logger.warning("Write-behind queue full (%d rows), writing synchronously", self._queue.maxsize)
+        self._write([row])
+        self._count("sync_writes", 1)
+        return False
+
+    def depth(self):
+        '''Number of rows queued or being written'''
+        return self._queue.qsize() + self._stats["in_flight"]
+
+    def stats(self):
+        '''Queue depth and counts of queued, written and synchronously written rows
+
+        Returns:
+            stats (dict): depth, queued, written, batches, sync_writes, failed_batches and dead_letters
+        '''
+        with self._lock:
+            stats = {key: value for key, value in self._stats.items() if key != "in_flight"}
+        stats["depth"] = self.depth()
+        return stats
+
+    def close(self, timeout=10.0):
+        '''Stop accepting rows and flush the queue, dead-lettering the rows still pending after timeout
+
+        Args:
+            timeout (float): seconds to wait for the queued rows to be written
+
+        Returns:
+            flushed (bool): True if every queued row was written
+        '''
+        self._stopping.set()
+        self._thread.join(timeout)
+        flushed = not self._thread.is_alive()
+        if not flushed:
+            logger.error("Write-behind queue not flushed within %.1fs, dead-lettering %d pending rows",
+                         timeout, self.depth())
+            self._abandon.set()
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error("Write-behind worker still blocked in a write, %d rows not persisted", self.depth())
+                return False
+        #rows queued while the worker was stopping
+        leftover = []
+        while not self._queue.empty():
+            leftover.append(self._queue.get_nowait())
+        if leftover:
+            self._count("in_flight", len(leftover))
+            self._write_batch(leftover)
+        logger.info("Write-behind queue closed, %d rows written", self._stats["written"])
+        return flushed
+
+    def _count(self, key, n):
+        with self._lock:
+            self._stats[key] += n
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write_batch(batch)
+
+    def _next_batch(self):
+        '''Wait for a first row, then collect rows until the batch is full or flush_interval has passed'''
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            #when closing, take what is queued without waiting for the window
+            timeout = 0 if self._stopping.is_set() else deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self._count("in_flight", len(batch))
+        return batch
+
+    def _write_batch(self, batch):
+        '''Write a batch, row by row if it fails with a non-transient error, dead-lettering rows that still fail'''
+        error = self._try_write(batch)
+        failed = batch if error is not None else []
+        if error is not None and len(batch) > 1 and not isinstance(error, self.transient_errors):
+            logger.warning("Write-behind batch of %d rows failed, writing its rows one by one: %s", len(batch), error)
+            failed = [row for row in batch if self._try_write([row]) is not None]
+
+        if failed:
+            self._dead_letter(failed)
+        with self._lock:
+            self._stats["dead_letters"] += len(failed)
+            self._stats["in_flight"] -= len(batch)
+            self._stats["written"] += len(batch) - len(failed)
+            self._stats["batches"] += 1
+        logger.debug("Write-behind batch of %d rows written", len(batch) - len(failed))
+
+    def _try_write(self, rows):
+        '''Write rows, retrying transient errors with exponential backoff until they are written
+
+        Returns:
+            error (Exception): the non-transient error, or the transient one if close() gave up; None if
+                the rows were written
+        '''
+        delay = self.retry_interval
+        while True:
+            try:
+                self._write(rows)
+                return None
+            except Exception as e:
+                self._count("failed_batches", 1)
+                if not isinstance(e, self.transient_errors) or self._abandon.is_set():
+                    return e
+                logger.warning("Write-behind batch of %d rows failed, retrying in %.1fs: %s", len(rows), delay, e)
+                #close() interrupts the wait when it gives up on the queue
+                if self._abandon.wait(delay):
+                    return e
+                delay = min(2 * delay, self.max_retry_interval)
+
+    def _dead_letter(self, rows):
+        '''Log rows that could not be written in full and append them to dead_letter_path'''
+        for row in rows:
+            logger.error("Write-behind row could not be written and was dead-lettered: %s", row)
+        if self.dead_letter_path is None:
+            return
+        try:
+            with open(self.dead_letter_path, "a") as f:
+                for row in rows:
+                    f.write(json.dumps(row, default=str, sort_keys=True) + "\n")
+        except IOError as e:
+            logger.error("Could not append %d dead-lettered rows to %s: %s", len(rows), self.dead_letter_path, e)
@@ -1,15 +1,75 @@
 import numpy as np
 import pandas as pd
 import pytest
+from scipy import stats
+import os
+import pickle
 import datetime
+import gzip
+import zlib
+import shutil
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from datetime import date, timedelta
 
+from config import config
+
 from src.clean import clean_zips
+from src.clean import clean_data
+from src.clean import clean_data_chunked
+from src.clean import parse_currency
 from src.create_features import create_response_variable
 from src.create_features import bool_to_int
 from src.create_features import percent_to_dec
 from src.create_features import years_since
 from src.create_features import extract_str_count
+from src.create_features import apply_bin_spec
+from src.create_features import create_features
+from src.create_features import create_features_incremental
+from src.create_features import featurize_partitions
+from src.model_registry import ArtifactRegistry
+from src.impute import fit_imputer
+from src.impute import apply_imputer
+from src.ingestion import ingest_manifest
+from src.ingestion import stream_to_s3
+from src.predict import listings_frame
+from src.predict import encode_listings
+from src.predict import compile_feature_layout
+from src.predict import cast_listing
+from src.predict import vectorize_listings
+from src.predict import map_bin
+from src.train import one_hot_encode
+from src.train import sparse_design_matrix
+from src.train import model_inputs
+from src.train import tune_and_score
+from src.train import write_scores
+from src.compiled_model import export_compiled_model
+from src.compiled_model import load_compiled_model
+from src.artifacts import read_table
+from src.stage_cache import stage_fingerprint
+from src.stage_cache import is_up_to_date
+from src.stage_cache import record_fingerprint
+from src.artifacts import write_table
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
+from src.train import CATEGORICAL_COLUMNS
+from src.train import make_search
+from src.train import proba_scorer
+from src.train import make_estimator
+from src.train import ordinal_encode
+from src.train import search_results
+from src.train import out_of_fold_predictions
+from sklearn.metrics import roc_auc_score
+from src.db_load import bulk_load
+from run_database import Airbnb, Base, _migrate_abb, STRING_LENGTHS
+from src.db_query import listing_page
+from src.db_metrics import engine_options, QueryTimer
+from src.write_behind import WriteBehindQueue
+from src.vocabulary import build_vocabulary
+from src.vocabulary import apply_vocabulary
+import sqlalchemy as sql
+from sklearn.metrics import get_scorer
+from sklearn.datasets import make_classification
 
 
 def test_clean_zips_happy():
@@ -21,7 +81,7 @@ def test_clean_zips_happy():
 
     df_test = clean_zips(input_df,zips)
 
-    true_df = pd.DataFrame([["91889"],[np.nan]],columns=column_names)
+    true_df = pd.DataFrame({"zipcode": pd.array([91889, None], dtype="Int64")})
 
     assert df_test["zipcode"].equals(true_df["zipcode"])
 
@@ -44,7 +104,7 @@ def test_create_response_happy():
     input_df = pd.DataFrame([[1.7],
                         [0.3]], columns=column_names)
 
-    df_test = create_response_variable(input_df)
+    df_test = create_response_variable(input_df, config.BIN_SPECS)
 
     true_df = pd.DataFrame([[3],[1]],columns=["reviews_per_month_bin"])
 
@@ -56,7 +116,7 @@ def test_create_response_sad():
     input_df = pd.DataFrame([["1.7"],
                         ["0.3"]], columns=column_names)
 
-    df_test = create_response_variable(input_df)
+    df_test = create_response_variable(input_df, config.BIN_SPECS)
 
     true_df = pd.DataFrame([[0],[0]],columns=["reviews_per_month_bin"])
 
@@ -142,3 +202,870 @@ def test_extract_str_count_sad():
     true_df = pd.DataFrame([[26]],columns=["amenities_count"])
 
     assert df_test["amenities_count"].equals(true_df["amenities_count"])
+
+def test_registry_reload_happy(tmp_path):
+    filepath = str(tmp_path / "model.sav")
+    pickle.dump({"version": 1}, open(filepath, "wb"))
+
+    registry = ArtifactRegistry(hot_reload=True)
+    registry.register("model", filepath)
+    first = registry.get("model")
+
+    assert registry.get("model") is first
+
+    pickle.dump({"version": 2}, open(filepath, "wb"))
+    os.utime(filepath, (0, os.stat(filepath).st_mtime + 10))
+
+    assert registry.get("model") == {"version": 2}
+
+def test_registry_missing_sad(tmp_path):
+    registry = ArtifactRegistry()
+    registry.register("model", str(tmp_path / "missing.sav"))
+    registry.preload()
+
+    with pytest.raises(FileNotFoundError):
+        registry.get("model")
+
+def test_listings_frame_happy():
+    records = [{"price": "120.5", "room_type": "Private room", "beds_cat": "2"},
+               {"price": 80, "room_type": "Shared room", "beds_cat": 1}]
+
+    df_test = listings_frame(records, ["price", "room_type", "beds_cat"], ["room_type"], ["price"])
+
+    true_df = pd.DataFrame({"price": [120.5, 80.0],
+                            "room_type": ["Private room", "Shared room"],
+                            "beds_cat": [2, 1]})
+
+    assert df_test.equals(true_df)
+
+def test_listings_frame_sad():
+    records = [{"price": 120.5}]
+
+    with pytest.raises(ValueError):
+        listings_frame(records, ["price", "room_type"], ["room_type"], ["price"])
+
+def _imputed_sample():
+    return pd.DataFrame({
+        "years_as_host": [1.5, 3.25, 7.0],
+        "host_response_time": ["within an hour", "within a day", "within an hour"],
+        "host_listings_count": [1, 4, 2],
+        "room_type": ["Private room", "Entire home/apt", "Shared room"],
+        "property_type_cat": ["House", "Apartment", "Other"],
+        "neighbourhood_cleansed": ["Mission", "Marina", "Mission"],
+        "cancellation_policy": ["flexible", "strict", "moderate"],
+        "reviews_per_month_bin": [1, 3, 4]})
+
+def test_vectorize_listings_happy():
+    df = _imputed_sample()
+    _, encoder = one_hot_encode(df)
+    feature_columns = [c for c in df.columns if c != "reviews_per_month_bin"]
+    layout = compile_feature_layout(encoder, feature_columns, CATEGORICAL_COLUMNS, ["years_as_host"])
+
+    records = df[feature_columns].to_dict(orient="records")
+    true_X = encode_listings(listings_frame(records, feature_columns, CATEGORICAL_COLUMNS, ["years_as_host"]),
+                             encoder, CATEGORICAL_COLUMNS).to_numpy(dtype=np.float64)
+
+    X_test = vectorize_listings([cast_listing(r, layout) for r in records], layout)
+
+    assert X_test.tobytes() == true_X.tobytes()
+
+def test_vectorize_listings_sad():
+    df = _imputed_sample()
+    _, encoder = one_hot_encode(df)
+    feature_columns = [c for c in df.columns if c != "reviews_per_month_bin"]
+    layout = compile_feature_layout(encoder, feature_columns, CATEGORICAL_COLUMNS, ["years_as_host"])
+
+    record = df[feature_columns].to_dict(orient="records")[0]
+    record["room_type"] = "Castle"
+
+    with pytest.raises(ValueError):
+        vectorize_listings([cast_listing(record, layout)], layout)
+
+def test_compiled_model_happy(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(300, 6))
+    y = np.digitize(X[:, 0] + X[:, 1], [-1, 0, 1]) + 1
+    trained_model = GradientBoostingClassifier(n_estimators=20, max_depth=3, random_state=0).fit(X, y)
+
+    filepath = str(tmp_path / "model.npz")
+    export_compiled_model(trained_model, filepath)
+    compiled = load_compiled_model(filepath)
+
+    assert np.abs(compiled.predict_proba(X) - trained_model.predict_proba(X)).max() < 1e-9
+    assert (compiled.predict(X) == trained_model.predict(X)).all()
+
+    #missing numeric and categorical inputs follow each split's missing_go_to_left
+    X[:, 2] = rng.randint(0, 4, len(X))
+    X[rng.rand(*X.shape) < 0.2] = np.nan
+    y = np.where(np.isnan(X[:, 0]), 4, y)
+    hist_model = HistGradientBoostingClassifier(max_iter=20, categorical_features=[2], random_state=0).fit(X, y)
+    export_compiled_model(hist_model, filepath)
+    compiled = load_compiled_model(filepath)
+
+    assert compiled.missing_left.any()
+    assert np.abs(compiled.predict_proba(X) - hist_model.predict_proba(X)).max() < 1e-9
+
+def test_compiled_model_sad(tmp_path):
+    rng = np.random.RandomState(0)
+    X = rng.normal(size=(100, 6))
+    y = (X[:, 0] > 0).astype(int)
+    trained_model = GradientBoostingClassifier(n_estimators=5, random_state=0).fit(X, y)
+
+    filepath = str(tmp_path / "model.npz")
+    export_compiled_model(trained_model, filepath)
+    compiled = load_compiled_model(filepath)
+
+    with pytest.raises(ValueError):
+        compiled.predict_proba(X[:, :5])
+
+def _raw_listings_sample():
+    return pd.DataFrame({
+        "listing_url": ["url1", "url2", "url3", "url4", "url5"],
+        "host_since": ["2015-01-01", np.nan, "2012-05-05", "2018-03-01", "2019-09-09"],
+        "host_response_rate": ["90%", np.nan, "100%", "50%", np.nan],
+        "host_is_superhost": ["t", np.nan, "f", "t", "f"],
+        "host_listings_count": [1, np.nan, 3, 2, 1],
+        "zipcode": ["CA 94110", "94110", "CA", "94103", "91888"],
+        "price": ["$1,200.00", "$80.00", "$95.00", "$150.00", "$60.00"],
+        "weekly_price": [np.nan, np.nan, "$500.00", np.nan, np.nan],
+        "monthly_price": [np.nan, np.nan, np.nan, np.nan, "$2,000.00"],
+        "security_deposit": ["$100.00", np.nan, np.nan, "$0.00", np.nan],
+        "cleaning_fee": ["$50.00", "$20.00", np.nan, "$30.00", np.nan],
+        "extra_people": ["$0.00", "$10.00", "$0.00", "$25.00", "$0.00"],
+        "reviews_per_month": [1.2, 0.5, np.nan, 3.1, 0.2]})
+
+def test_clean_data_chunked_happy(tmp_path):
+    raw_path = str(tmp_path / "listings.csv")
+    output_path = str(tmp_path / "clean.csv")
+    _raw_listings_sample().to_csv(raw_path, index=False)
+    listing_types = {"zipcode": "str", "price": "str"}
+
+    rows = clean_data_chunked(raw_path, output_path, listing_types, {"listing_url"}, {"94110", "94103"}, 2)
+
+    true_df = clean_data(raw_path, listing_types, {"listing_url"}, {"94110", "94103"}).reset_index(drop=True)
+    df_test = pd.read_csv(output_path, dtype={"zipcode": "Int64"})
+
+    assert rows == 3
+    assert df_test.equals(true_df)
+
+def test_clean_data_chunked_sad(tmp_path):
+    raw_path = str(tmp_path / "listings.csv")
+    _raw_listings_sample().to_csv(raw_path, index=False)
+
+    with pytest.raises(ValueError):
+        clean_data_chunked(raw_path, str(tmp_path / "clean.csv"), {}, {"listing_url"}, {"94110"}, 0)
+
+def test_table_roundtrip_happy(tmp_path):
+    df_in = pd.DataFrame({
+        "zipcode": ["94110", "94103"],
+        "price": [80.0, 1200.5],
+        "beds": [1, 3],
+        "room_type": ["Private room", "Entire home/apt"]})
+    filepath = str(tmp_path / "clean.parquet")
+
+    write_table(df_in, filepath)
+    df_test = read_table(filepath)
+
+    assert df_test.equals(df_in)
+    assert df_test.dtypes.equals(df_in.dtypes)
+
+def test_table_roundtrip_sad(tmp_path):
+    with pytest.raises(ValueError):
+        write_table(pd.DataFrame({"beds": [1]}), str(tmp_path / "clean.xlsx"))
+
+def test_apply_bin_spec_happy():
+    input_df = pd.DataFrame({
+        "beds": [0, 2, 7, np.nan],
+        "bedrooms": [2.0, 1.0, 4.0, 0.0]})
+    spec = {"column": "beds", "clip": [None, 5], "missing": [0], "fill_from": "bedrooms", "fill_clip": [1, None]}
+
+    df_test = apply_bin_spec(input_df, "beds_cat", spec)
+
+    true_df = pd.DataFrame([[2], [2], [5], [1]], columns=["beds_cat"])
+
+    assert df_test["beds_cat"].equals(true_df["beds_cat"].astype(float))
+
+def test_apply_bin_spec_sad():
+    input_df = pd.DataFrame([["3"], ["7"]], columns=["accommodates"])
+    spec = {"column": "accommodates", "edges": [2, 4, 6], "labels": [1, 2, 3, 4], "right": True}
+
+    with pytest.raises(TypeError):
+        apply_bin_spec(input_df, "accommodates_cat", spec)
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    files = {}
+    drop_once = set()
+
+    def do_GET(self):
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = int(self.headers["Range"][6:-1]) if self.headers.get("Range") else 0
+        self.send_response(206 if start else 200)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        if self.path in self.drop_once:
+            #close the connection halfway through the body the first time
+            self.drop_once.discard(self.path)
+            self.wfile.write(data[start:(start + len(data)) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+class _LocalS3:
+    def __init__(self, root):
+        self.root = root
+        self.uploads = {}
+        self.aborted = []
+
+    def upload_file(self, filename, bucket, key):
+        dest = os.path.join(self.root, bucket, key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(filename, dest)
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads))
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.uploads[UploadId][PartNumber] = Body
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        dest = os.path.join(self.root, Bucket, Key)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, "wb") as f:
+            for part in MultipartUpload["Parts"]:
+                f.write(self.uploads[UploadId][part["PartNumber"]])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+def _serve(files):
+    _RangeHandler.files = files
+    server = HTTPServer(("127.0.0.1", 0), _RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}".format(server.server_port)
+
+def test_ingest_manifest_happy(tmp_path):
+    csvs = {city: ("id,city\n" + "\n".join("{},{}".format(i, city) for i in range(5000))).encode()
+            for city in ["san-francisco", "oakland"]}
+    paths = {"/us/ca/{}/2020-01-04/data/listings.csv.gz".format(city): gzip.compress(data)
+             for city, data in csvs.items()}
+    server, base = _serve(paths)
+    local_dir = tmp_path / "raw"
+    local_dir.mkdir()
+    #a partial download of oakland is resumed from where it stopped
+    oakland = paths["/us/ca/oakland/2020-01-04/data/listings.csv.gz"]
+    (local_dir / "oakland_2020-01-04_listings.csv.gz.part").write_bytes(oakland[:100])
+
+    results = ingest_manifest([base + path for path in paths], str(local_dir), "bucket", "data/raw",
+                              _LocalS3(str(tmp_path / "s3")), max_workers=2, stream=False)
+    server.shutdown()
+
+    assert [result["ok"] for result in results] == [True, True]
+    assert results[1]["bytes"] == len(oakland) - 100
+    for city, data in csvs.items():
+        assert (tmp_path / "s3" / "bucket" / "data/raw" / city / "2020-01-04" / "listings.csv").read_bytes() == data
+
+def test_ingest_manifest_sad(tmp_path):
+    server, base = _serve({"/us/ca/oakland/2020-01-04/data/listings.csv.gz": gzip.compress(b"id\n1\n")})
+
+    results = ingest_manifest([base + "/us/ca/missing/2020-01-04/data/listings.csv.gz",
+                               base + "/us/ca/oakland/2020-01-04/data/listings.csv.gz"],
+                              str(tmp_path / "raw"), "bucket", "data/raw", _LocalS3(str(tmp_path / "s3")),
+                              retries=2, backoff=0)
+    server.shutdown()
+
+    assert [result["ok"] for result in results] == [False, True]
+    assert "404" in results[0]["error"]
+
+def test_stream_to_s3_happy(tmp_path):
+    data = "".join("{},listing number {}\n".format(i, i * 7919 % 10007) for i in range(400000)).encode()
+    server, base = _serve({"/listings.csv.gz": gzip.compress(data)})
+    _RangeHandler.drop_once.add("/listings.csv.gz")
+    s3 = _LocalS3(str(tmp_path / "s3"))
+
+    stats = stream_to_s3(base + "/listings.csv.gz", "bucket", "listings.csv", s3, part_size=5 * 1024 * 1024,
+                         local_filepath=str(tmp_path / "listings.csv"), backoff=0, chunk_size=65536)
+    server.shutdown()
+
+    parts = list(s3.uploads["0"].values())
+    assert (tmp_path / "s3" / "bucket" / "listings.csv").read_bytes() == data
+    assert (tmp_path / "listings.csv").read_bytes() == data
+    assert stats["parts"] == len(parts) > 1
+    assert all(len(part) == 5 * 1024 * 1024 for part in parts[:-1])
+
+def test_stream_to_s3_sad(tmp_path):
+    server, base = _serve({"/listings.csv.gz": b"not gzipped"})
+    s3 = _LocalS3(str(tmp_path / "s3"))
+
+    with pytest.raises(zlib.error):
+        stream_to_s3(base + "/listings.csv.gz", "bucket", "listings.csv", s3, backoff=0)
+    server.shutdown()
+
+    assert s3.aborted == ["listings.csv"]
+    assert not (tmp_path / "s3").exists()
+
+def test_stage_fingerprint_happy(tmp_path):
+    input_path = tmp_path / "features.csv"
+    input_path.write_text("beds\n1\n")
+    output_path = str(tmp_path / "imputed.csv")
+    open(output_path, "w").close()
+
+    def grid():
+        return {"learning_rate": stats.uniform(loc=0, scale=0.2), "n_estimators": np.arange(25, 750, 25),
+                "zips": {"94110", "94103"}}
+
+    fingerprint = stage_fingerprint("impute", [str(input_path)], grid(), [__file__])
+    record_fingerprint(fingerprint, [output_path])
+
+    assert is_up_to_date(stage_fingerprint("impute", [str(input_path)], grid(), [__file__]), [output_path])
+    assert not is_up_to_date(fingerprint, [output_path], force=True)
+
+def test_stage_fingerprint_sad(tmp_path):
+    input_path = tmp_path / "features.csv"
+    input_path.write_text("beds\n1\n")
+    output_path = str(tmp_path / "imputed.csv")
+    open(output_path, "w").close()
+    record_fingerprint(stage_fingerprint("impute", [str(input_path)], {"RANDOM_STATE": 1414}, [__file__]),
+                       [output_path])
+
+    changed_config = stage_fingerprint("impute", [str(input_path)], {"RANDOM_STATE": 1}, [__file__])
+    input_path.write_text("beds\n2\n")
+    changed_input = stage_fingerprint("impute", [str(input_path)], {"RANDOM_STATE": 1414}, [__file__])
+
+    assert not is_up_to_date(changed_config, [output_path])
+    assert not is_up_to_date(changed_input, [output_path])
+    assert not is_up_to_date(changed_input, [str(tmp_path / "missing.csv")])
+    #a missing input does not raise, the stage is out of date and reports it when it runs
+    input_path.unlink()
+    missing_input = stage_fingerprint("impute", [str(input_path)], {"RANDOM_STATE": 1414}, [__file__])
+    record_fingerprint(missing_input, [output_path])
+    assert not is_up_to_date(missing_input, [output_path])
+
+def _features_with_missing():
+    rng = np.random.RandomState(0)
+    n = 200
+    df = pd.DataFrame({
+        "host_response_time": rng.choice(["within an hour", "within a few hours", "within a day"], n),
+        "host_response_rate": rng.randint(50, 101, n) / 100,
+        "host_listings_count": rng.randint(1, 10, n),
+        "price": rng.uniform(50, 500, n).round(0),
+        "security_deposit": rng.uniform(0, 500, n).round(0),
+        "cleaning_fee": rng.uniform(0, 100, n).round(0),
+        "room_type": rng.choice(["Private room", "Entire home/apt"], n),
+        "reviews_per_month_bin": rng.randint(1, 5, n)})
+    df.loc[::7, "host_response_rate"] = np.nan
+    df.loc[::9, "host_response_time"] = np.nan
+    df.loc[::11, "cleaning_fee"] = np.nan
+    return df
+
+def test_apply_imputer_happy():
+    df = _features_with_missing()
+    imputer = fit_imputer(df, 1414, ["host_response_time", "room_type"])
+
+    df_test = apply_imputer(df, imputer)
+    #a new batch is imputed with the same fitted imputer, without refitting
+    new_batch = apply_imputer(df.iloc[:20].copy(), imputer)
+
+    complete = df["host_response_rate"].notna() & df["host_response_time"].notna()
+    assert not df_test[imputer["imputable"]].isna().any().any()
+    assert df_test.loc[complete, "host_response_rate"].equals(df.loc[complete, "host_response_rate"])
+    assert df_test["host_response_rate"].between(0, 1).all()
+    assert set(df_test["host_response_time"]) <= {"within an hour", "within a few hours", "within a day",
+                                                    "a few days or more"}
+    assert (df_test.loc[df["cleaning_fee"].isna(), "cleaning_fee"] == df["cleaning_fee"].median()).all()
+    assert new_batch.equals(df_test.iloc[:20])
+    #the other categorical features are one-hot predictors; unseen categories are encoded as none of them
+    assert any(col.startswith("room_type_") for col in imputer["columns"])
+    assert not apply_imputer(df.iloc[:20].assign(room_type="Castle"), imputer)[imputer["imputable"]].isna().any().any()
+
+def test_apply_imputer_sad():
+    df = _features_with_missing()
+    imputer = fit_imputer(df, 1414, ["host_response_time", "room_type"])
+
+    with pytest.raises(KeyError):
+        apply_imputer(df.drop(columns=["price"]), imputer)
+
+def test_make_search_happy():
+    predictors, response = make_classification(n_samples=300, n_features=6, n_informative=4, n_classes=3,
+                                               random_state=1414)
+    tuning_grid = {"learning_rate": stats.uniform(loc=0, scale=0.2), "n_estimators": np.arange(5, 50, 5), "max_depth": [2, 3]}
+    search = make_search(GradientBoostingClassifier(random_state=1414), tuning_grid, "halving", 4, 1414, 1,
+                         ["roc_auc_ovo", "accuracy"], "roc_auc_ovo", "n_estimators", 3)
+
+    search.fit(predictors, response)
+    #the best candidate is refit with the full budget of boosting stages
+    assert search.best_estimator_.n_estimators == 45
+    assert search.best_score_ > 0.5
+
+def test_make_search_sad():
+    with pytest.raises(ValueError):
+        make_search(GradientBoostingClassifier(), {"max_depth": [2, 3]}, "grid", 4, 1414, 1,
+                    ["roc_auc_ovo", "accuracy"], "roc_auc_ovo")
+
+def test_proba_scorer_happy():
+    predictors, response = make_classification(n_samples=300, n_features=6, n_informative=4, n_classes=3,
+                                               random_state=1414)
+    classifier = GradientBoostingClassifier(n_estimators=10, random_state=1414).fit(predictors, response)
+
+    scores = proba_scorer(["roc_auc_ovo", "accuracy"])(classifier, predictors, response)
+    assert scores["roc_auc_ovo"] == pytest.approx(get_scorer("roc_auc_ovo")(classifier, predictors, response))
+    assert scores["accuracy"] == pytest.approx(get_scorer("accuracy")(classifier, predictors, response))
+
+def test_proba_scorer_sad():
+    with pytest.raises(ValueError):
+        proba_scorer(["roc_auc_ovo", "f1"])
+
+def test_hist_engine_happy(tmp_path):
+    df = pd.concat([_imputed_sample()] * 40, ignore_index=True)
+    df["years_as_host"] += np.arange(len(df)) % 7
+    encoded_df, encoder = ordinal_encode(df)
+    feature_columns = [c for c in df.columns if c != "reviews_per_month_bin"]
+    layout = compile_feature_layout(encoder, feature_columns, CATEGORICAL_COLUMNS, ["years_as_host"], "ordinal")
+    predictors = encoded_df.drop(columns=["reviews_per_month_bin"])
+    trained_model = make_estimator("hist", 1414, predictors.columns, max_iter=10, early_stopping=False)
+    trained_model.fit(predictors, encoded_df["reviews_per_month_bin"])
+
+    filepath = str(tmp_path / "model.npz")
+    export_compiled_model(trained_model, filepath)
+    compiled = load_compiled_model(filepath)
+    X = vectorize_listings([cast_listing(r, layout) for r in df[feature_columns].to_dict(orient="records")], layout)
+
+    assert X.tobytes() == predictors.to_numpy(dtype=np.float64).tobytes()
+    assert np.abs(compiled.predict_proba(X) - trained_model.predict_proba(predictors)).max() < 1e-9
+
+def test_hist_engine_sad():
+    with pytest.raises(ValueError):
+        make_estimator("xgboost", 1414, ["years_as_host"])
+
+def test_search_artifacts_happy(tmp_path, monkeypatch):
+    predictors, response = make_classification(n_samples=300, n_features=6, n_informative=4, n_classes=3,
+                                               random_state=1414)
+    predictors, response = pd.DataFrame(predictors), pd.Series(response)
+    tuning_grid = {"learning_rate": stats.uniform(loc=0, scale=0.2), "n_estimators": [5, 10], "max_depth": [2, 3]}
+    fold_cache = tmp_path / "folds"
+    fold_cache.mkdir()
+    search = make_search(GradientBoostingClassifier(random_state=1414), tuning_grid, "random", 3, 1414, 1,
+                         ["roc_auc_ovo", "accuracy"], "roc_auc_ovo", fold_cache=str(fold_cache))
+    search.fit(predictors, response)
+
+    filepath = str(tmp_path / "cv_results.parquet")
+    write_table(search_results(search), filepath)
+    results = read_table(filepath)
+    oof = out_of_fold_predictions(search.best_estimator_, predictors, response, 1)
+
+    assert len(results) == 3 and results["is_best"].sum() == 1
+    assert results["param_n_estimators"].dtype.kind == "i"
+    best = results[results["is_best"]].iloc[0]
+    #out-of-fold probabilities reproduce the search's fold scores of the best candidate
+    for fold, rows in oof.groupby("fold"):
+        proba = rows[["proba_0", "proba_1", "proba_2"]]
+        assert roc_auc_score(rows["reviews_per_month_bin"], proba, multi_class="ovo") == \
+            pytest.approx(best["split{}_test_roc_auc_ovo".format(fold)])
+
+    #the search's fold probabilities are reused without fitting the best candidate again
+    monkeypatch.setattr("src.train.cross_val_predict", None)
+    cached = out_of_fold_predictions(search.best_estimator_, predictors, response, 1, fold_cache=str(fold_cache))
+    pd.testing.assert_frame_equal(cached, oof)
+
+def test_search_artifacts_sad():
+    search = make_search(GradientBoostingClassifier(), {"max_depth": [2, 3]}, "random", 2, 1414, 1,
+                         ["roc_auc_ovo", "accuracy"], "roc_auc_ovo")
+
+    with pytest.raises(AttributeError):
+        search_results(search)
+
+def test_write_scores_happy(tmp_path):
+    df = pd.concat([_imputed_sample()] * 40, ignore_index=True)
+    df["years_as_host"] += np.arange(len(df)) % 7
+    imputed_path = str(tmp_path / "imputed.parquet")
+    write_table(df, imputed_path)
+    tuning_grid = {"n_estimators": [5, 10], "max_depth": [2]}
+
+    #without an out-of-fold path there is no out-of-fold timing, and the scores are still written
+    search, cv_auc, cv_accu, test_auc, test_accu, timings = tune_and_score(
+        imputed_path, 1414, tuning_grid, 2, 1, ["roc_auc_ovo", "accuracy"], "roc_auc_ovo", 0.2)
+    scores_path = str(tmp_path / "scores.txt")
+    write_scores(scores_path, search, tuning_grid, "gbt", "random", cv_auc, cv_accu, test_auc, test_accu, timings)
+    with open(scores_path) as f:
+        scores = f.read()
+
+    assert "oof" not in timings
+    assert "Best n_estimators: " in scores and "Scoring time (s): " in scores
+    assert "Out-of-fold" not in scores
+
+def test_bulk_load_happy(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    Base.metadata.create_all(engine)
+    df = pd.concat([_imputed_sample()] * 4, ignore_index=True)
+    df.insert(0, "id", np.arange(len(df)) + 100)
+    filepath = str(tmp_path / "scored.csv")
+    write_table(df, filepath)
+
+    rows = bulk_load(engine, Airbnb.__table__, filepath, batch_size=5)
+    #reloading the same listings with a new response updates them in place
+    write_table(df.assign(reviews_per_month_bin=2), filepath)
+    bulk_load(engine, Airbnb.__table__, filepath, batch_size=5, upsert=True)
+    loaded = pd.read_sql("SELECT listing_id, room_type, reviews_per_month_bin FROM abb_feat_and_resp", engine)
+
+    assert rows == 12
+    assert len(loaded) == 12 and set(loaded["listing_id"]) == set(df["id"])
+    assert (loaded["reviews_per_month_bin"] == "unpopular").all()
+    assert bulk_load(engine, Airbnb.__table__, filepath, replace=True) == 12
+    assert pd.read_sql("SELECT COUNT(*) AS n FROM abb_feat_and_resp", engine)["n"][0] == 12
+
+def test_bulk_load_sad(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    Base.metadata.create_all(engine)
+    filepath = str(tmp_path / "imputed.csv")
+    write_table(_imputed_sample(), filepath)
+
+    with pytest.raises(ValueError):
+        bulk_load(engine, Airbnb.__table__, filepath, upsert=True)
+
+def test_bulk_load_imputed_output_happy(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    Base.metadata.create_all(engine)
+    feature_args = (config.HOST_FEATURES, config.PROPERTY_FEATURES, config.BOOKING_FEATURES,
+                    config.RESPONSE_VARIABLE, config.BIN_SPECS)
+    clean_path = str(tmp_path / "clean.parquet")
+    imputed_path = str(tmp_path / "imputed.csv")
+    write_table(_clean_listings_sample(), clean_path)
+
+    #the listing id is carried through featurize and impute, so the imputed file can be upserted
+    for price in [80.0, 90.0]:
+        write_table(_clean_listings_sample().assign(price=[price, 1200.0, 95.0, 150.0]), clean_path)
+        df = create_features(clean_path, datetime.datetime(2020, 1, 4), *feature_args)
+        write_table(apply_imputer(df, fit_imputer(df, 1414, CATEGORICAL_COLUMNS, max_iter=2)), imputed_path)
+        bulk_load(engine, Airbnb.__table__, imputed_path, upsert=True)
+    loaded = pd.read_sql("SELECT listing_id, price FROM abb_feat_and_resp ORDER BY listing_id", engine)
+
+    assert "id" not in model_inputs(df, "gbt")[0].columns
+    assert loaded["listing_id"].tolist() == df["id"].tolist() == [11, 12, 14]
+    assert loaded["price"].tolist() == [90.0, 1200.0, 150.0]
+
+def test_migrate_abb_happy(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    #original schema: no listing_id, free-text categorical columns and no indexes
+    engine.execute("CREATE TABLE abb_feat_and_resp (id INTEGER PRIMARY KEY, room_type VARCHAR(100), "
+                   "neighbourhood_cleansed VARCHAR(100), host_is_superhost INTEGER, reviews_per_month_bin VARCHAR(100))")
+    engine.execute("INSERT INTO abb_feat_and_resp VALUES (1, 'Private room', 'Mission', 1, 'popular')")
+    engine.execute("INSERT INTO abb_feat_and_resp VALUES (2, 'Castle', 'Mission', 0, 'popular')")
+
+    _migrate_abb(engine)
+    indexes = {index["name"] for index in sql.inspect(engine).get_indexes("abb_feat_and_resp")}
+    loaded = pd.read_sql("SELECT * FROM abb_feat_and_resp", engine)
+
+    assert indexes >= {index.name for index in Airbnb.__table__.indexes}
+    assert list(loaded["room_type"]) == ["Private room", "Castle"]
+    assert "listing_id" in loaded.columns and loaded["listing_id"].isna().all()
+
+def test_migrate_abb_sad(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    Base.metadata.create_all(engine)
+
+    #reviews_per_month_bin is an enum of the popularity labels, values outside it are rejected
+    with pytest.raises(sql.exc.IntegrityError):
+        engine.execute(Airbnb.__table__.insert(), {"reviews_per_month_bin": "viral"})
+
+def test_persist_unknown_room_type_happy(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    #a table created when room_type was an enum and listing_id 32 bits is migrated to a sized string and 64 bits
+    engine.execute("CREATE TABLE abb_feat_and_resp (id INTEGER PRIMARY KEY, listing_id INTEGER UNIQUE, "
+                   "room_type VARCHAR(15) "
+                   "CHECK (room_type IN ('Entire home/apt', 'Private room', 'Shared room', 'Hotel room')))")
+    _migrate_abb(engine)
+    columns = {col["name"]: col["type"] for col in sql.inspect(engine).get_columns("abb_feat_and_resp")}
+
+    df = _imputed_sample()
+    vocabulary = build_vocabulary(df, CATEGORICAL_COLUMNS)
+    feature_columns = [c for c in df.columns if c != "reviews_per_month_bin"]
+    layout = compile_feature_layout(one_hot_encode(df, vocabulary)[1], feature_columns, CATEGORICAL_COLUMNS,
+                                    ["years_as_host"], vocabulary=vocabulary)
+    listing = cast_listing(dict(df[feature_columns].iloc[0], room_type="Castle"), layout, max_lengths=STRING_LENGTHS)
+
+    #scored as the fallback room type, stored as entered
+    assert vectorize_listings([listing], layout).shape[0] == 1
+    engine.execute(Airbnb.__table__.insert(), [dict(listing, listing_id=2 ** 40, reviews_per_month_bin=map_bin(2))])
+    loaded = pd.read_sql("SELECT listing_id, room_type FROM abb_feat_and_resp", engine)
+
+    assert isinstance(columns["listing_id"], sql.BigInteger)
+    assert loaded["room_type"].tolist() == ["Castle"] and loaded["listing_id"].tolist() == [2 ** 40]
+    #values longer than their column are rejected before they are scored or inserted
+    with pytest.raises(ValueError):
+        cast_listing(dict(df[feature_columns].iloc[0], room_type="C" * 33), layout, max_lengths=STRING_LENGTHS)
+
+def test_listing_page_happy(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    Base.metadata.create_all(engine)
+    engine.execute(Airbnb.__table__.insert(), [{"room_type": room_type, "neighbourhood_cleansed": "Mission"}
+                                               for room_type in ["Private room", "Shared room"] * 5])
+
+    pages, cursor = [], None
+    while True:
+        rows, cursor = listing_page(engine, Airbnb.__table__, ["room_type"], {"room_type": "Private room"}, cursor, 2)
+        pages.append(rows)
+        if cursor is None:
+            break
+
+    assert [len(rows) for rows in pages] == [2, 2, 1]
+    assert [row["id"] for rows in pages for row in rows] == [9, 7, 5, 3, 1]
+    assert set(pages[0][0]) == {"id", "room_type"}
+    #a filtered page is read from the (column, id) index, without scanning or sorting the table
+    plan = str(engine.execute("EXPLAIN QUERY PLAN SELECT id, room_type FROM abb_feat_and_resp "
+                              "WHERE room_type = 'Private room' AND id < 9 ORDER BY id DESC LIMIT 3").fetchall())
+    assert "ix_abb_room_id" in plan and "TEMP B-TREE" not in plan
+
+def test_listing_page_sad(tmp_path):
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"))
+    Base.metadata.create_all(engine)
+
+    with pytest.raises(ValueError):
+        listing_page(engine, Airbnb.__table__, ["room_type"], {"host_name": "Tom"})
+
+def test_query_timer_happy(tmp_path):
+    options = engine_options("mysql+pymysql://user:pw@localhost:3306/airbnb", pool_size=3, max_overflow=1)
+    #a pooled SQLite file stands in for MySQL, which is not available to the tests
+    engine = sql.create_engine("sqlite:///" + str(tmp_path / "airbnb.db"), poolclass=sql.pool.QueuePool, **options)
+    Base.metadata.create_all(engine)
+    timer = QueryTimer()
+    timer.listen(engine)
+
+    engine.execute("SELECT COUNT(*) FROM abb_feat_and_resp")
+    timer.start()
+    listing_page(engine, Airbnb.__table__, ["room_type"])
+    engine.execute("SELECT COUNT(*) FROM abb_feat_and_resp")
+    timing = timer.stop()
+    summary = timer.summary()
+
+    assert engine.pool.size() == 3 and options["pool_pre_ping"]
+    assert timing["queries"] == 2 and 0 < timing["db_seconds"] <= timing["request_seconds"]
+    assert summary["requests"] == 1 and summary["queries"] == 2
+    assert "Pool size: 3" in summary["pools"][0]
+
+def test_query_timer_sad():
+    timer = QueryTimer()
+
+    assert engine_options("sqlite:///data/airbnb_db.db", pool_size=3) == {}
+    assert timer.stop() is None
+    assert timer.summary()["requests"] == 0
+
+def test_write_behind_happy():
+    batches = []
+    write_behind = WriteBehindQueue(batches.append, batch_size=4, flush_interval=5.0)
+    for i in range(10):
+        write_behind.put({"listing_id": i})
+
+    assert write_behind.close()
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert [row["listing_id"] for batch in batches for row in batch] == list(range(10))
+    assert write_behind.stats()["depth"] == 0 and write_behind.stats()["written"] == 10
+
+def test_write_behind_sad():
+    stalled = threading.Event()
+    written = []
+
+    def write(rows):
+        #the background worker stalls until the test releases it, synchronous writes go through
+        if threading.current_thread().name == "write-behind":
+            stalled.wait()
+        written.extend(rows)
+
+    write_behind = WriteBehindQueue(write, batch_size=1, flush_interval=0.01, max_pending=2)
+    queued = [write_behind.put({"listing_id": i}) for i in range(6)]
+    stalled.set()
+
+    assert write_behind.close()
+    assert queued.count(False) >= 3 and write_behind.stats()["sync_writes"] == queued.count(False)
+    assert sorted(row["listing_id"] for row in written) == list(range(6))
+
+def test_write_behind_poison_row_sad(tmp_path):
+    written = []
+    outage = [2]
+
+    def write(rows):
+        #listing 3 always violates a constraint, the database is down for the first two writes of listing 7
+        if any(row["listing_id"] == 3 for row in rows):
+            raise sql.exc.IntegrityError("INSERT", {}, Exception("CHECK constraint failed"))
+        if any(row["listing_id"] == 7 for row in rows) and outage[0]:
+            outage[0] -= 1
+            raise sql.exc.OperationalError("INSERT", {}, Exception("server has gone away"))
+        written.extend(rows)
+
+    dead_letter_path = str(tmp_path / "dead_letters.jsonl")
+    write_behind = WriteBehindQueue(write, batch_size=4, flush_interval=5.0, retry_interval=0.01,
+                                    dead_letter_path=dead_letter_path)
+    for i in range(10):
+        write_behind.put({"listing_id": i})
+
+    assert write_behind.close(timeout=5.0)
+    assert sorted(row["listing_id"] for row in written) == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert pd.read_json(dead_letter_path, lines=True)["listing_id"].tolist() == [3]
+    assert write_behind.stats()["dead_letters"] == 1 and write_behind.stats()["depth"] == 0
+
+    #the database never comes back: rows still pending when close() gives up are kept on disk
+    def unreachable(rows):
+        raise sql.exc.OperationalError("INSERT", {}, Exception("server has gone away"))
+
+    write_behind = WriteBehindQueue(unreachable, batch_size=4, flush_interval=0.01, retry_interval=0.01,
+                                    dead_letter_path=dead_letter_path)
+    for i in range(10, 16):
+        write_behind.put({"listing_id": i})
+
+    assert not write_behind.close(timeout=0.2)
+    assert pd.read_json(dead_letter_path, lines=True)["listing_id"].tolist() == [3] + list(range(10, 16))
+
+def test_parse_currency_happy():
+    values = pd.Series(["$1,200.00", "$80.00", np.nan, "95"], index=[3, 4, 7, 9])
+
+    parsed = parse_currency(values, "price")
+
+    assert parsed.dtype == np.float64 and list(parsed.index) == [3, 4, 7, 9]
+    assert parsed.fillna(-1).tolist() == [1200.0, 80.0, -1, 95.0]
+
+def test_parse_currency_sad(caplog):
+    values = pd.Series(["$1,200.00", "call host", "$8O.00"])
+
+    parsed = parse_currency(values, "price")
+
+    assert parsed[0] == 1200.0 and parsed[1:].isna().all()
+    assert "2 malformed price values" in caplog.text
+
+def test_vocabulary_happy():
+    df = _imputed_sample()
+    vocabulary = build_vocabulary(df, CATEGORICAL_COLUMNS)
+    categorical = apply_vocabulary(df, vocabulary)
+
+    onehot_test, encoder = one_hot_encode(categorical, vocabulary)
+    ordinal_test = ordinal_encode(categorical, vocabulary)[0]
+
+    assert vocabulary["neighbourhood_cleansed"] == {"categories": ["Marina", "Mission"], "fallback": "Mission"}
+    assert all(categorical[col].dtype == "category" for col in CATEGORICAL_COLUMNS)
+    assert onehot_test.equals(one_hot_encode(df)[0])
+    assert ordinal_test.equals(ordinal_encode(df)[0])
+    assert [list(c) for c in encoder.categories_] == [vocabulary[col]["categories"] for col in CATEGORICAL_COLUMNS]
+
+def test_vocabulary_sad():
+    df = _imputed_sample()
+    vocabulary = build_vocabulary(df, CATEGORICAL_COLUMNS)
+    feature_columns = [c for c in df.columns if c != "reviews_per_month_bin"]
+    layout = compile_feature_layout(one_hot_encode(df, vocabulary)[1], feature_columns, CATEGORICAL_COLUMNS,
+                                    ["years_as_host"], vocabulary=vocabulary)
+    unknown = df.assign(room_type=["Castle", "Private room", "Treehouse"])
+    listings = [cast_listing(r, layout) for r in unknown[feature_columns].to_dict(orient="records")]
+
+    #unknown categories become the most frequent category (the first in sort order on a tie)
+    assert list(apply_vocabulary(unknown, vocabulary)["room_type"]) == ["Entire home/apt", "Private room",
+                                                                         "Entire home/apt"]
+    assert vectorize_listings(listings, layout).tobytes() == vectorize_listings(
+        [dict(listing, room_type="Entire home/apt") if listing["room_type"] != "Private room" else listing
+         for listing in listings], layout).tobytes()
+    with pytest.raises(ValueError):
+        one_hot_encode(df.assign(room_type=[None, "Private room", "Shared room"]), vocabulary)
+
+def test_sparse_design_matrix_happy():
+    df = _imputed_sample()
+    encoded = one_hot_encode(df)[0]
+    dense = encoded.loc[:, encoded.columns != "reviews_per_month_bin"]
+    predictors, response, columns, _ = sparse_design_matrix(df, build_vocabulary(df, CATEGORICAL_COLUMNS))
+
+    #same columns and values as the dense one-hot layout, without densifying
+    assert predictors.format == "csr"
+    assert columns == list(dense.columns)
+    assert np.array_equal(predictors.toarray(), dense.to_numpy(dtype=np.float64))
+    assert list(response) == list(df["reviews_per_month_bin"])
+
+def test_sparse_design_matrix_sad():
+    df = _imputed_sample()
+
+    #the hist engine does not accept sparse input
+    with pytest.raises(ValueError):
+        model_inputs(df, "hist", sparse_design=True)
+
+def _clean_listings_sample():
+    return pd.DataFrame({
+        "id": [11, 12, 13, 14],
+        "host_since": ["2015-01-01", "2012-05-05", "2018-03-01", "2019-09-09"],
+        "host_response_time": ["within an hour", "within a day", np.nan, "within an hour"],
+        "host_response_rate": ["90%", "100%", np.nan, "50%"],
+        "host_is_superhost": ["t", "f", "t", "f"],
+        "host_has_profile_pic": ["t", "t", "t", "f"],
+        "host_identity_verified": ["f", "t", "t", "f"],
+        "host_listings_count": [1, 3, 2, 1],
+        "room_type": ["Private room", "Entire home/apt", "Shared room", "Private room"],
+        "property_type": ["House", "Apartment", "Boat", "Loft"],
+        "accommodates": [2, 4, 1, 6],
+        "bathrooms": [1.0, 2.5, np.nan, 1.0],
+        "bedrooms": [1.0, 2.0, 1.0, np.nan],
+        "beds": [1.0, 3.0, 0.0, 2.0],
+        "guests_included": [1, 2, 0, 4],
+        "extra_people": [0.0, 10.0, 0.0, 25.0],
+        "price": [80.0, 1200.0, 95.0, 150.0],
+        "security_deposit": [100.0, np.nan, np.nan, 0.0],
+        "cleaning_fee": [50.0, 20.0, np.nan, 30.0],
+        "amenities": ["{Wifi,Kitchen}", "{Wifi}", "{}", "{Wifi,TV,Heating}"],
+        "neighbourhood_cleansed": ["Mission", "Marina", "Mission", "Bayview"],
+        "minimum_nights": [1, 3, 30, 2],
+        "maximum_nights": [30, 365, 1125, 7],
+        "instant_bookable": ["t", "f", "t", "f"],
+        "cancellation_policy": ["flexible", "super_strict_30", "moderate", "strict_14_with_grace_period"],
+        "require_guest_phone_verification": ["f", "f", "t", "f"],
+        "require_guest_profile_picture": ["f", "t", "f", "f"],
+        "reviews_per_month": [1.2, 0.5, np.nan, 3.1]})
+
+def test_create_features_incremental_happy(tmp_path, caplog):
+    feature_args = (config.HOST_FEATURES, config.PROPERTY_FEATURES, config.BOOKING_FEATURES,
+                    config.RESPONSE_VARIABLE, config.BIN_SPECS)
+    clean_path = str(tmp_path / "clean.parquet")
+    write_table(_clean_listings_sample(), clean_path)
+    state = create_features_incremental(clean_path, None, "v1", datetime.datetime(2020, 1, 4), *feature_args)[1]
+
+    #a month later: one listing changed, one new, one removed and every reviews_per_month moved
+    next_df = _clean_listings_sample()
+    next_df.loc[1, "price"] = 1100.0
+    next_df.loc[3, "id"] = 15
+    next_df = next_df.drop(index=0).assign(reviews_per_month=next_df["reviews_per_month"] * 2)
+    write_table(next_df, clean_path)
+    scrape_date = datetime.datetime(2020, 2, 4)
+    df_test, next_state = create_features_incremental(clean_path, state, "v1", scrape_date, *feature_args)
+
+    true_df = create_features(clean_path, scrape_date, *feature_args)
+
+    #another month: only availability and review counts moved, so every listing is reused
+    write_table(next_df.assign(availability_30=[0, 12, 30], number_of_reviews=[5, 40, 1]), clean_path)
+    with caplog.at_level("INFO", logger="src.create_features"):
+        create_features_incremental(clean_path, next_state, "v1", datetime.datetime(2020, 3, 4), *feature_args)
+
+    pd.testing.assert_frame_equal(df_test, true_df)
+    assert sorted(next_state["features"]["id"]) == [12, 15]
+    assert "0 listings recomputed, 2 reused" in caplog.text
+
+def test_create_features_incremental_sad(tmp_path):
+    clean_path = str(tmp_path / "clean.parquet")
+    write_table(_clean_listings_sample().assign(id=[11, 12, 12, 14]), clean_path)
+
+    with pytest.raises(ValueError):
+        create_features_incremental(clean_path, None, "v1", datetime.datetime(2020, 1, 4), config.HOST_FEATURES,
+                                    config.PROPERTY_FEATURES, config.BOOKING_FEATURES, config.RESPONSE_VARIABLE,
+                                    config.BIN_SPECS)
+
+def test_featurize_partitions_happy():
+    scrape_date = datetime.datetime(2020, 1, 4)
+    clean_df = _clean_listings_sample()
+    true_df = featurize_partitions(clean_df.copy(), scrape_date, config.BIN_SPECS)
+
+    #same features, in the original row order, however the listings are split (missing keys form a partition)
+    for n_jobs, partition_by in ((2, None), (3, "neighbourhood_cleansed"), (2, "host_response_time")):
+        df_test = featurize_partitions(clean_df.copy(), scrape_date, config.BIN_SPECS, n_jobs, partition_by)
+        pd.testing.assert_frame_equal(df_test, true_df)
+
+def test_featurize_partitions_sad():
+    with pytest.raises(ValueError):
+        featurize_partitions(_clean_listings_sample(), datetime.datetime(2020, 1, 4), config.BIN_SPECS, 2, "city")